@@ -1,9 +1,35 @@
-import pbr.version
+import sys
 
-version_info = pbr.version.VersionInfo('rdopkg')
-try:
-    __version__ = version_info.version_string()
-except AttributeError:
-    __version__ = None
 
-__all__ = ['__version__']
+def _load_version():
+    global version_info, __version__
+    import pbr.version
+    version_info = pbr.version.VersionInfo('rdopkg')
+    try:
+        __version__ = version_info.version_string()
+    except AttributeError:
+        __version__ = None
+
+
+def get_version():
+    """
+    Return rdopkg version string, it's only computed on first use.
+    """
+    if 'version_info' not in globals():
+        _load_version()
+    return __version__
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # pbr imports setuptools which takes longer than the rest of rdopkg
+        # CLI startup so version is loaded lazily on access (PEP 562)
+        if name in ('__version__', 'version_info'):
+            _load_version()
+            return globals()[name]
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name))
+else:
+    _load_version()
+
+__all__ = ['__version__', 'get_version']
@@ -0,0 +1,202 @@
+"""
+Local mirrors of remote git repositories used as a shared object store.
+
+Bare mirrors are kept in HOME_DIR/mirrors, one per remote URL. Clones and
+fetches borrow objects from them and dissociate afterwards so that
+resulting repositories don't depend on the mirrors which can be refreshed
+and pruned at any time.
+"""
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import time
+
+from rdopkg.conf import cfg
+from rdopkg import exception
+from rdopkg.utils import log
+from rdopkg.utils.git import git
+
+
+# touched on every use of a mirror, used for pruning
+USED_STAMP = 'rdopkg-used'
+# touched on every successful update of a mirror from remote
+FETCHED_STAMP = 'rdopkg-fetched'
+# branches and tags only, not gerrit refs/changes/*
+MIRROR_REFSPECS = [
+    '+refs/heads/*:refs/heads/*',
+    '+refs/tags/*:refs/tags/*',
+]
+
+
+def enabled():
+    return bool(cfg['MIRRORS'])
+
+
+def mirrors_dir():
+    return os.path.join(cfg['HOME_DIR'], 'mirrors')
+
+
+def mirror_path(url):
+    """
+    Return path to a bare mirror of remote url.
+    """
+    url = url.rstrip('/')
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+    name = re.sub(r'\.git$', '', url.rpartition('/')[2])
+    name = re.sub(r'[^\w.-]', '_', name) or 'repo'
+    return os.path.join(mirrors_dir(), '%s-%s.git' % (name, key))
+
+
+def _touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
+
+def _age(path):
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+@contextlib.contextmanager
+def _locked(path):
+    # serialize access to a mirror by parallel rdopkg runs
+    os.makedirs(mirrors_dir(), exist_ok=True)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def update_mirror(url, period=None):
+    """
+    Create or refresh a bare mirror of url and return its path.
+
+    Existing mirror is only fetched when it wasn't updated in last `period`
+    seconds (cfg['FETCH_PERIOD'] by default).
+    """
+    if period is None:
+        period = cfg['FETCH_PERIOD']
+    path = mirror_path(url)
+    with _locked(path):
+        age = _age(os.path.join(path, FETCHED_STAMP))
+        if not os.path.isdir(path):
+            log.info("Creating local mirror of %s" % url)
+            tmp_path = path + '.tmp'
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            git('init', '--bare', '--quiet', tmp_path)
+            git('--git-dir', tmp_path, 'config', 'remote.origin.url', url)
+            for refspec in MIRROR_REFSPECS:
+                git('--git-dir', tmp_path, 'config', '--add',
+                    'remote.origin.fetch', refspec)
+            git('--git-dir', tmp_path, 'fetch', '--prune', '--quiet',
+                'origin')
+            os.rename(tmp_path, path)
+        elif age is None or age > period:
+            git('--git-dir', path, 'fetch', '--prune', '--quiet', 'origin')
+        _touch(os.path.join(path, FETCHED_STAMP))
+        _touch(os.path.join(path, USED_STAMP))
+    return path
+
+
+def get_mirror(url):
+    """
+    Return path to an up to date mirror of url or None when mirrors are
+    disabled or it can't be updated.
+
+    Failure to update a mirror isn't fatal, operations which use mirrors
+    work without them, only slower.
+    """
+    if not enabled() or not url:
+        return None
+    try:
+        return update_mirror(url)
+    except (exception.CommandFailed, IOError, OSError) as ex:
+        log.warn("Unable to update local mirror of %s: %s" % (url, ex))
+        return None
+
+
+def clone(url, path):
+    """
+    git clone url into path borrowing objects from a local mirror.
+    """
+    mirror = get_mirror(url)
+    if mirror:
+        git('clone', '--reference-if-able', mirror, '--dissociate',
+            url, path)
+        prune_mirrors()
+    else:
+        git('clone', url, path)
+
+
+@contextlib.contextmanager
+def borrowed_objects(urls, git_dir='.git'):
+    """
+    Borrow objects from mirrors of urls for the duration of the context
+    using alternates and dissociate afterwards like `git clone --dissociate`.
+
+    Objects present in mirrors aren't transferred by `git fetch` in the
+    context.
+    """
+    mirrors = [m for m in (get_mirror(url) for url in urls) if m]
+    if not mirrors:
+        yield
+        return
+    alternates = os.path.join(git_dir, 'objects', 'info', 'alternates')
+    if os.path.exists(alternates):
+        # don't mess with existing alternates
+        yield
+        return
+    with open(alternates, 'w') as f:
+        for m in mirrors:
+            f.write(os.path.join(os.path.abspath(m), 'objects') + '\n')
+    try:
+        yield
+    finally:
+        # objects fetched in the context might only be in the mirrors so
+        # alternates can only be removed after they're copied
+        try:
+            git('--git-dir', git_dir, 'repack', '-a', '-d', '-q',
+                log_cmd=False)
+        except exception.CommandFailed:
+            log.warn("Failed to copy objects from local mirrors, keeping "
+                     "%s - run `git repack -a -d` and remove it to "
+                     "dissociate." % alternates)
+        else:
+            os.remove(alternates)
+
+
+def prune_mirrors(max_age=None):
+    """
+    Remove mirrors not used in last `max_age` seconds
+    (cfg['MIRRORS_MAX_AGE'] by default).
+    """
+    if max_age is None:
+        max_age = cfg['MIRRORS_MAX_AGE']
+    if max_age is None:
+        return []
+    try:
+        names = os.listdir(mirrors_dir())
+    except OSError:
+        return []
+    pruned = []
+    for name in sorted(names):
+        path = os.path.join(mirrors_dir(), name)
+        if not name.endswith('.git') or not os.path.isdir(path):
+            continue
+        with _locked(path):
+            age = _age(os.path.join(path, USED_STAMP))
+            if age is not None and age <= max_age:
+                continue
+            log.info("Removing unused local mirror: %s" % path)
+            shutil.rmtree(path, ignore_errors=True)
+        # lock file is kept, removing it would allow two processes to hold
+        # locks on different inodes of the same lock file
+        pruned.append(path)
+    return pruned
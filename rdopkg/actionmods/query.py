@@ -3,37 +3,55 @@ from distroinfo.query import get_distrepos
 import re
 
 from rdopkg.actionmods import rdoinfo
+from rdopkg import exception
 from rdopkg.utils import log
 from rdopkg.utils.cmd import run
-from rdopkg.utils.specfile import nvrcmp
+from rdopkg.utils.cmd import run_many
+from rdopkg.utils.specfile import nvr_key
 
 
-def repoquery(repo_url, repo_name, package, verbose=False):
+def _repoquery_cmd(repo_url, repo_name, package):
     repo_id = "rdopkg_%s" % re.sub('[^\w]', '_', repo_name)
-    cmd = ["repoquery", "--nvr",
-           "--repofrompath=%s,%s" % (repo_id, repo_url),
-           "--repoid=%s" % repo_id, "-q", package]
+    return ["repoquery", "--nvr",
+            "--repofrompath=%s,%s" % (repo_id, repo_url),
+            "--repoid=%s" % repo_id, "-q", package]
+
+
+def _repoquery_version(o):
+    if not o.success:
+        return None
+    lines = o.strip().split("\n")
+    return lines[0] or None
+
+
+def repoquery(repo_url, repo_name, package, verbose=False):
+    cmd = _repoquery_cmd(repo_url, repo_name, package)
     try:
         o = run(*cmd, log_cmd=verbose, log_fail=verbose)
     except Exception:
         return None
-    lines = o.strip().split("\n")
-    return lines[0] or None
+    return _repoquery_version(o)
 
 
 def query_repos(distrepos, package, verbose=False):
     if not distrepos:
         return []
+    cmds = [_repoquery_cmd(repo['url'], repo['name'], package)
+            for repo in distrepos]
+    try:
+        outs = run_many(cmds, fatal=False, log_cmd=verbose,
+                        log_fail=verbose)
+    except exception.CommandNotFound:
+        outs = [None] * len(cmds)
     versions = []
-    for repo in distrepos:
+    for repo, o in zip(distrepos, outs):
         repo_name = repo['name']
-        repo_url = repo['url']
-        version = repoquery(repo_url, repo_name, package, verbose=verbose)
+        version = o and _repoquery_version(o)
         if version:
             versions.append((repo_name, version))
         if verbose:
             log.info("%s: %s", repo_name, version or 'N/A')
-    versions.sort(cmp=lambda x, y: nvrcmp(x[0], y[0]), reverse=True)
+    versions.sort(key=lambda x: nvr_key(x[1]), reverse=True)
     return versions
 
 
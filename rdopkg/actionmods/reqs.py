@@ -13,6 +13,10 @@ from rdopkg.utils import specfile
 from rdopkg import helpers
 
 
+# requirements.txt content by commit hash
+_reqs_txt_cache = {}
+
+
 class DiffReq(object):
 
     def __init__(self, name, vers):
@@ -139,22 +143,22 @@ def parse_reqs_txt(txt, py_vers):
 
 
 def get_upstream_first_ref_of_stable_releases_before(timestamp=None):
+    branches = [b for b in git.remote_branches() if 'upstream/stable' in b]
+    first_commits = git.get_first_commits_of_branches(branches)
     upstream = list()
-    for branch in git.remote_branches():
-        if 'upstream/stable' in branch:
-            commits = git.get_commits_of_branch(branch)
-            try:
-                if (commits[0]['timestamp'] < timestamp or timestamp is None):
-                    upstream.append(commits[0]['hash'])
-            except IndexError:
-                pass
+    for branch in branches:
+        commit = first_commits.get(branch)
+        if not commit:
+            continue
+        if timestamp is None or int(commit['timestamp']) < int(timestamp):
+            upstream.append(commit['hash'])
     return upstream
 
 
 def get_reqs_present_in_upstream_before(timestamp, py_version):
     reqs = list()
     for ref in get_upstream_first_ref_of_stable_releases_before(timestamp):
-        reqs += get_reqs_from_ref(ref, py_version)
+        reqs += parse_reqs_txt(get_reqs_txt_from_commit(ref), py_version)
     return reqs
 
 
@@ -170,12 +174,36 @@ def get_pkgs_present_in_upstream_before(timestamp, py_version):
 
 def get_reqs_from_ref(ref, py_version):
     try:
-        o = git('show', '%s:requirements.txt' % ref, log_cmd=False)
+        o = git.get_file_content(ref, 'requirements.txt')
     except Exception:
         o = ''
     return parse_reqs_txt(o, py_version)
 
 
+def get_reqs_txt_from_commit(commit):
+    """
+    Return requirements.txt content of a commit (hash) or '' when missing.
+
+    Content is read through persistent git cat-file --batch and cached by
+    commit hash as it can't change.
+    """
+    txt = _reqs_txt_cache.get(commit)
+    if txt is None:
+        o = git.cat_file('%s:requirements.txt' % commit, contents=True)
+        if o is False:
+            # cat-file --batch not available
+            try:
+                txt = git.get_file_content(commit, 'requirements.txt')
+            except Exception:
+                txt = ''
+        elif o and o[1] == 'blob':
+            txt = o[3].decode('utf-8')
+        else:
+            txt = ''
+        _reqs_txt_cache[commit] = txt
+    return txt
+
+
 def get_reqs_from_path(path, py_version):
     o = open(path).read()
     return parse_reqs_txt(o, py_version)
@@ -150,6 +150,9 @@ ACTIONS = [
                    help="only bump .spec to new version a la rpmdev-bumpspec"),
                Arg('no_diff', shortcut='-d', action='store_true',
                    help="don't show git/requirements diff"),
+               Arg('no_fetch', action='store_true',
+                   help="don't fetch upstream and patches branch, "
+                        "use local refs"),
                Arg('new_sources', shortcut='-N', action='store_true',
                    help=("run `fedpkg new-sources`"
                          " (default: depends on branch name)")),
@@ -173,6 +176,7 @@ ACTIONS = [
            ],
            steps=[
                Action('get_package_env'),
+               Action('fetch_new_version_remotes'),
                Action('ensure_patches_base_ref'),
                Action('new_version_setup'),
                Action('diff'),
@@ -6,25 +6,36 @@ from distroinfo.query import get_package
 import itertools
 import os
 import re
+import shutil
 import six
 from six.moves import input
 import sys
+import tempfile
 
 from rdopkg.conf import cfg, cfg_files
 from rdopkg import exception
 from rdopkg import guess
+from rdopkg.actionmods import mirror
 from rdopkg.actionmods import rdoinfo
 from rdopkg.actionmods import rpmfactory
 from rdopkg.actions.reqs.actions import reqdiff
 from rdopkg.utils import log
 from rdopkg.utils.cmd import run
+from rdopkg.utils.git import Fetch
 from rdopkg.utils.git import git
+from rdopkg.utils.git import RE_PATCH_FROM_LINE
+from rdopkg.utils.git import RE_PATCH_INDEX_LINE
 from rdopkg.utils.issues import search_bug_references
 from rdopkg.utils import specfile
 from rdopkg.utils import tidy_ssh_user
 from rdopkg import helpers
 
 FEDPKG = ['fedpkg']
+# remotes only used to send reviews which don't need fetching
+REVIEW_REMOTES = ('review-origin', 'review-patches',
+                  'gerrit-origin', 'gerrit-patches')
+# remotes whose tags are fetched, see guess.upstream_branch()
+UPSTREAM_REMOTES = ('upstream', 'openstack')
 
 
 def get_package_env(version=None, release=None, dist=None, branch=None,
@@ -363,7 +374,7 @@ def clone(
     review_patches = pkg.get('review-patches')
     review_origin = pkg.get('review-origin')
 
-    git('clone', distgit, package)
+    mirror.clone(distgit, package)
     with helpers.cdir(package):
         if gerrit_remotes:
             log.info('Adding gerrit-origin remote...')
@@ -388,7 +399,15 @@ def clone(
                      extra_repo=extra_repo, extra_dg=extra_url))
             git('remote', 'add', extra_repo, extra_url)
         if patches or upstream or extra_repo:
-            git('fetch', '--all')
+            remotes = {}
+            if patches:
+                remotes['patches'] = patches
+            if upstream:
+                remotes['upstream'] = upstream
+            if extra_repo:
+                remotes[extra_repo] = extra_url
+            with mirror.borrowed_objects(list(remotes.values())):
+                fetch_remotes(get_fetch_plan(list(remotes)), period=0)
 
         if not review_user:
             # USERNAME is an env var used by gerrit
@@ -488,8 +507,67 @@ def _is_same_commit(ref1, ref2):
     return h1 and h1 == h2
 
 
+def get_fetch_plan(remotes=None, branches=None):
+    """
+    Return a list of git.Fetch needed to update remotes.
+
+    Only upstream remotes are fetched with tags.
+
+    :param remotes: remotes to fetch, all except review ones by default
+    :param branches: {remote: [branch, ...]} to only fetch some branches
+    """
+    if remotes is None:
+        remotes = [r for r in git.remotes() if r not in REVIEW_REMOTES]
+    branches = branches or {}
+    plan = []
+    for remote in remotes:
+        refspecs = ['+refs/heads/%s:refs/remotes/%s/%s' % (b, remote, b)
+                    for b in branches.get(remote, [])]
+        plan.append(Fetch(remote, refspecs, remote in UPSTREAM_REMOTES))
+    return plan
+
+
+def fetch_remotes(fetches, period=None):
+    """
+    Run planned fetches in parallel skipping those done in last `period`
+    seconds (cfg['FETCH_PERIOD'] by default).
+    """
+    if period is None:
+        period = cfg['FETCH_PERIOD']
+    return git.fetch_many(fetches, jobs=cfg['FETCH_JOBS'], period=period)
+
+
 def fetch_all():
-    git('fetch', '--all', direct=True)
+    fetch_remotes(get_fetch_plan())
+
+
+def fetch_new_version_remotes(patches_branch=None, local_patches=False,
+                              bump_only=False, no_fetch=False):
+    """
+    Fetch upstream branch with tags and remote patches branch needed by
+    new-version. Failure to fetch isn't fatal, local refs are used then.
+
+    Nothing is fetched with --no-fetch or --bump-only which is a local-only
+    operation.
+    """
+    if no_fetch or bump_only:
+        return
+    remotes = git.remotes()
+    branches = {}
+    if patches_branch and not local_patches:
+        remote, branch = git.remote_branch_split(patches_branch, fatal=False)
+        if remote:
+            branches[remote] = [branch]
+    for remote in UPSTREAM_REMOTES:
+        if remote in remotes:
+            branches.setdefault(remote, []).append('master')
+            break
+    if not branches:
+        return
+    try:
+        fetch_remotes(get_fetch_plan(sorted(branches), branches))
+    except exception.CommandFailed as ex:
+        log.warn("Failed to fetch remotes, using local refs: %s" % ex)
 
 
 def prep_new_patches_branch(new_version,
@@ -586,6 +664,45 @@ def rebase_patches_branch(new_version, local_patches_branch,
             pass
 
 
+def _new_patches(patches, old_patches, from_revision, to_revision):
+    """
+    Return patches (hash, subject, bzs) from git which aren't among
+    old_patches (file name, hash, subject) from patch files.
+
+    Patches are matched by stable patch ID which survives rebases and
+    rewording, by hash and as a fallback by subject. All of them are looked
+    up in sets so this is linear in number of patches.
+    """
+    if not patches:
+        return []
+    commit_ids = git.get_commit_patch_ids(from_revision, to_revision)
+    old_ids = set(git.get_patch_ids_of_files(
+        [fn for fn, _, _ in old_patches]))
+    old_ids.discard(None)
+    # git hashes are abbreviated, index old full hashes by their prefixes
+    hash_lens = set(len(hsh) for hsh, _, _ in patches)
+    old_hashes = set(old_hash[:n] for _, old_hash, _ in old_patches
+                     if old_hash for n in hash_lens)
+    old_subjs = set(helpers.strip_patch_subject(old_subj)
+                    for _, _, old_subj in old_patches if old_subj)
+    commit_ids_by_hash = {}
+    for commit, patch_id in commit_ids.items():
+        for n in hash_lens:
+            commit_ids_by_hash[commit[:n]] = patch_id
+
+    new_patches = []
+    for patch in patches:
+        hsh, subj, _ = patch
+        if commit_ids_by_hash.get(hsh) in old_ids:
+            continue
+        if hsh in old_hashes:
+            continue
+        if subj is not None and helpers.strip_patch_subject(subj) in old_subjs:
+            continue
+        new_patches.append(patch)
+    return new_patches
+
+
 def check_new_patches(version, local_patches_branch,
                       patches_style=None, local_patches=False,
                       patches_branch=None, changes=None,
@@ -630,17 +747,7 @@ def check_new_patches(version, local_patches_branch,
             n_git_patches, n_skip_patches, n_ignore_patches))
 
         if changelog == 'detect':
-            # detect new/old patches by hash/subject
-            def _patch_filter(c):
-                hash, subj, bzs = c
-                for _, old_hash, old_subj in old_patches:
-                    if helpers.is_same_hash(hash, old_hash):
-                        return False
-                    if helpers.is_same_subject(subj, old_subj):
-                        # maybe more relaxed match on subjects?
-                        return False
-                return True
-            patches = filter(_patch_filter, patches)
+            patches = _new_patches(patches, old_patches, version_tag, head)
 
         elif changelog == 'count':
             # assume no removed patches, include new ones in changelog
@@ -899,6 +1006,68 @@ def flatten(list_of_lists):
     return list(itertools.chain(*list_of_lists))
 
 
+def _comparable_patch(patch):
+    # git format-patch output without parts which change on every rebase
+    patch = RE_PATCH_FROM_LINE.sub(b'', patch, count=1)
+    header, sep, diff = patch.partition(b'\n---\n')
+    return header + sep + RE_PATCH_INDEX_LINE.sub(b'', diff)
+
+
+def _export_patches(ranges, old_patch_fns):
+    """
+    Export patch ranges using git format-patch and return a list of patch
+    file names.
+
+    Patches are exported into a temporary directory first and only new or
+    changed patches are moved into place. Existing patch files with the same
+    name which only differ in commit hash and blob hashes of `index` lines
+    are left untouched so that rebased patches don't cause needless churn.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='rdopkg-patches-')
+    try:
+        patch_fns = []
+        new_paths = []
+        for patch_range in ranges:
+            start_commit, _title = patch_range[0]
+            end_commit, _title = patch_range[-1]
+            start_number = len(patch_fns) + 1
+
+            rng = git.rev_range(start_commit + '~', end_commit)
+            format_patch_cmd = ['-c', 'core.abbrev=7',
+                                'format-patch', '--no-renames',
+                                '--no-signature', '-N', '--ignore-submodules',
+                                '--stat=80', '--summary',
+                                '--start-number', str(start_number),
+                                '-o', tmpdir, rng]
+
+            o = git(*format_patch_cmd)
+            for path in git._parse_output(o):
+                new_paths.append(path)
+                patch_fns.append(os.path.basename(path))
+
+        old_fns = set(old_patch_fns)
+        unchanged = set()
+        for i, pfn in enumerate(patch_fns):
+            if pfn not in old_fns or not os.path.isfile(pfn):
+                continue
+            with open(new_paths[i], 'rb') as f:
+                new_patch = f.read()
+            with open(pfn, 'rb') as f:
+                old_patch = f.read()
+            if _comparable_patch(new_patch) == _comparable_patch(old_patch):
+                unchanged.add(i)
+
+        for i, pfn in enumerate(patch_fns):
+            if i not in unchanged:
+                shutil.move(new_paths[i], pfn)
+        if unchanged:
+            log.info("%d of %d patches unchanged." % (
+                len(unchanged), len(patch_fns)))
+        return patch_fns
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
 def update_patches(branch, local_patches_branch, bump_only=False,
                    version=None, new_version=None, version_tag_style=None):
     if bump_only:
@@ -924,9 +1093,7 @@ def update_patches(branch, local_patches_branch, bump_only=False,
         raise exception.OnlyPatchesIgnoreUsed()
         pass
 
-    patch_fns = spec.get_patch_fns()
-    for pfn in patch_fns:
-        git('rm', '-f', '--ignore-unmatch', pfn)
+    old_patch_fns = spec.get_patch_fns()
     patch_fns = []
 
     if n_excluded > 0:
@@ -963,25 +1130,13 @@ def update_patches(branch, local_patches_branch, bump_only=False,
             log.info("%s  %s" % (log.term.green(hsh), title))
 
         log.info("")
-        patch_fns = []
-        for patch_range in ranges:
-            start_commit, _title = patch_range[0]
-            end_commit, _title = patch_range[-1]
-            start_number = len(patch_fns) + 1
-
-            rng = git.rev_range(start_commit + '~', end_commit)
-            format_patch_cmd = ['-c', 'core.abbrev=7',
-                                'format-patch', '--no-renames',
-                                '--no-signature', '-N', '--ignore-submodules',
-                                '--stat=80', '--summary',
-                                '--start-number', str(start_number), rng]
-
-            o = git(*format_patch_cmd)
-            range_files = git._parse_output(o)
-            patch_fns.extend(range_files)
+        patch_fns = _export_patches(ranges, old_patch_fns)
 
-        for pfn in patch_fns:
-            git('add', pfn)
+    removed_fns = [pfn for pfn in old_patch_fns if pfn not in patch_fns]
+    if removed_fns:
+        git('rm', '-f', '--ignore-unmatch', '--', *removed_fns)
+    if patch_fns:
+        git('add', '--', *patch_fns)
 
     spec.set_new_patches(patch_fns)
     patches_branch_ref = git('rev-parse', local_patches_branch, log_cmd=False)
@@ -4,8 +4,8 @@ from rdopkg.action import Action, Arg
 ACTIONS = [
     Action('lint', help="check for common .spec problems",
            optional_args=[
-               Arg('spec_fn', positional=True, nargs='?',
-                   help="a .spec file to check"),
+               Arg('spec_fn', positional=True, nargs='*',
+                   help=".spec file(s) to check"),
                Arg('lint_checks', metavar='CHECKS',
                    help="comma-separated lists of checks to perform "
                         "(checks: sanity, rpmlint, all)"),
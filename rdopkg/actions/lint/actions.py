@@ -12,5 +12,9 @@ def lint(spec_fn=None, lint_checks=None, error_level='E'):
         checks = lint_checks.split(',')
     else:
         checks = None
-    hints = _lint.lint(spec_fn, checks=checks)
+    if isinstance(spec_fn, list):
+        # multiple .spec files are checked in parallel
+        hints = _lint.lint_many(spec_fn, checks=checks)
+    else:
+        hints = _lint.lint(spec_fn, checks=checks)
     _lint.lint_report(hints, error_level=error_level)
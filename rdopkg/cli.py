@@ -1,6 +1,6 @@
 import sys
 
-from . import __version__
+from . import get_version
 from rdopkg.action import ActionManager
 from rdopkg.core import ActionRunner
 from rdopkg import shell
@@ -38,7 +38,7 @@ def rdopkg(*cargs):
     return shell.run(runner,
                      cargs=cargs,
                      prog='rdopkg',
-                     version=__version__)
+                     version=get_version)
 
 
 def main():
@@ -42,7 +42,21 @@ cfg = Config({
     'RDOINFO_RAW_URL': ('https://raw.githubusercontent.com/'
                         'redhat-openstack/rdoinfo/master/'),
     'FETCH_PERIOD': 600,
+    # number of git remotes fetched in parallel
+    'FETCH_JOBS': 4,
     'REQCHECK_PY_VERSION': '3.9',
+    # cache of .spec data parsed by rpm in HOME_DIR/cache/spec and patch
+    # headers in HOME_DIR/cache/patches
+    'SPEC_CACHE': True,
+    'SPEC_CACHE_MAX_SIZE': 16 * 1024 * 1024,
+    'SPEC_CACHE_MAX_AGE': 30 * 24 * 3600,
+    # cache of rpmlint results in HOME_DIR/cache/rpmlint
+    'RPMLINT_CACHE': True,
+    # borrow objects from local mirrors of remotes in HOME_DIR/mirrors
+    # when cloning, mirrors are refreshed after FETCH_PERIOD and removed
+    # when unused for MIRRORS_MAX_AGE
+    'MIRRORS': False,
+    'MIRRORS_MAX_AGE': 30 * 24 * 3600,
 })
 cfg_files = []
 
@@ -10,6 +10,8 @@ from rdopkg import const
 from rdopkg import exception
 from rdopkg import helpers
 from rdopkg.utils import log
+from rdopkg.utils.runcache import run_cache
+from rdopkg.utils.trace import tracer
 
 
 def default_action_manager():
@@ -203,13 +205,20 @@ class ActionRunner(object):
         self.action_manager.ensure_leaf_action(self.action,
                                                on_change_callback=_save_state)
 
+        # memoize pure commands for the duration of the action
+        with run_cache.session():
+            self._engage(continuable)
+
+    def _engage(self, continuable):
         abort = False
         while self.action:
             new_args = None
             select_next = True
             step = self.action[-1]
             try:
-                new_args = self.action_manager.run_action(step, self.args)
+                with tracer.step(step.name):
+                    new_args = self.action_manager.run_action(step,
+                                                              self.args)
             except exception.ActionRequired as ex:
                 helpers.action_required(str(ex))
                 new_args = ex.kwargs.get('args', None)
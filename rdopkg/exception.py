@@ -62,6 +62,10 @@ class SpecFileParseError(RdopkgException):
     msg_fmt = "Error parsing .spec file '%(spec_fn)s': %(error)s"
 
 
+class UnsupportedMacro(RdopkgException):
+    msg_fmt = "Unable to expand macro without rpm: %(macro)s"
+
+
 class ModuleNotAvailable(RdopkgException):
     msg_fmt = "Module %(module)s is not available. Unable to continue."
 
@@ -206,7 +206,7 @@ def upstream_version(branch=None):
 
 
 def user():
-    user = git('config', 'user.name', log_cmd=False, fatal=False)
+    user = git.config_get('user.name')
     if not user:
         raise exception.CantGuess(what="user name",
                                   why='git config user.name not set')
@@ -214,7 +214,7 @@ def user():
 
 
 def email():
-    email = git('config', 'user.email', log_cmd=False, fatal=False)
+    email = git.config_get('user.email')
     if not email:
         raise exception.CantGuess(what="user email",
                                   why='git config user.email not set')
@@ -6,7 +6,6 @@ import six
 from six.moves import input
 from six import string_types
 import sys
-import yaml
 
 from rdopkg import exception
 from rdopkg.utils import log
@@ -189,6 +188,8 @@ class DictPrinter(object):
                 continue
             last_items.append((key, dd.pop(key)))
         if dd:
+            # yaml is slow to import, only load it when needed
+            import yaml
             print(yaml.dump(dd, default_flow_style=False).rstrip())
         for key, val in last_items:
             print_keyval(key, val)
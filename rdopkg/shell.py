@@ -4,6 +4,8 @@ import argparse
 
 from rdopkg import exception
 from rdopkg.utils import log
+from rdopkg.utils.runcache import run_cache
+from rdopkg.utils.trace import tracer
 
 
 ARGCOMPLETE_AVAILABLE = False
@@ -33,6 +35,27 @@ def get_action_args(action, args):
     return aargs
 
 
+class VersionAction(argparse.Action):
+    """
+    argparse --version action which accepts a callable returning version
+    so that it's only computed when requested.
+    """
+    def __init__(self, option_strings, version=None, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super(VersionAction, self).__init__(
+            option_strings=option_strings, dest=dest, default=default,
+            nargs=0, help=help)
+        self.version = version
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        version = self.version
+        if callable(version):
+            version = version()
+        print(version)
+        parser.exit()
+
+
 def get_parser(runner, prog='rdopkg', version=None):
     parser = argparse.ArgumentParser(
         prog=prog,
@@ -41,7 +64,15 @@ def get_parser(runner, prog='rdopkg', version=None):
     parser.add_argument('-c', '--continue', action='store_true',
                         help='continue running current action')
     if version:
-        parser.add_argument('--version', action='version', version=version)
+        parser.add_argument('--version', action=VersionAction,
+                            version=version)
+    # handled by pop_profile_args() so that they work with --continue too
+    parser.add_argument('--profile', action='store_true',
+                        help='print time spent in external commands '
+                             'by action step')
+    parser.add_argument('--profile-trace', metavar='FILE',
+                        help='save trace of external commands as Chrome '
+                             'trace event JSON')
     for action in runner.action_manager.actions:
         cmd = action2cmd(action.name)
         action_parser = subparsers.add_parser(
@@ -62,7 +93,55 @@ def get_parser(runner, prog='rdopkg', version=None):
     return parser
 
 
+def pop_profile_args(cargs):
+    """
+    Remove global --profile and --profile-trace FILE options preceding
+    action from cargs.
+
+    Return (cargs, profile, profile_trace).
+    """
+    cargs = list(cargs)
+    profile = False
+    profile_trace = None
+    i = 0
+    while i < len(cargs) and cargs[i].startswith('-'):
+        arg = cargs[i]
+        if arg == '--profile':
+            profile = True
+            del cargs[i]
+        elif arg == '--profile-trace' and i + 1 < len(cargs):
+            profile_trace = cargs[i + 1]
+            del cargs[i:i + 2]
+        elif arg.startswith('--profile-trace='):
+            profile_trace = arg.partition('=')[2]
+            del cargs[i]
+        else:
+            i += 1
+    return tuple(cargs), profile, profile_trace
+
+
 def run(action_runner, cargs, prog='rdopkg', version=None):
+    cargs, profile, profile_trace = pop_profile_args(cargs)
+    if not (profile or profile_trace):
+        return _run(action_runner, cargs, prog=prog, version=version)
+    tracer.reset()
+    tracer.enabled = True
+    run_cache.reset_stats()
+    try:
+        return _run(action_runner, cargs, prog=prog, version=version)
+    finally:
+        tracer.enabled = False
+        if profile:
+            log.info('')
+            log.info(log.term.bold('Profile:'))
+            log.info(tracer.summary())
+            log.info(run_cache.summary())
+        if profile_trace:
+            tracer.save_chrome_trace(profile_trace)
+            log.info('Trace saved to: %s' % profile_trace)
+
+
+def _run(action_runner, cargs, prog='rdopkg', version=None):
     parser = get_parser(action_runner, prog=prog, version=version)
     if ARGCOMPLETE_AVAILABLE:
         argcomplete.autocomplete(parser)
@@ -0,0 +1,151 @@
+"""
+Simple on-disk cache of JSON serializable values.
+
+Values are stored in separate files named by their (content-addressed) keys
+so that entries can't go stale - a different input means a different key.
+Old entries are evicted by age and total cache size.
+"""
+import hashlib
+import json
+import os
+import time
+
+
+def digest(*parts):
+    """
+    Return a cache key (hex digest) of supplied parts.
+
+    Parts can be strings, bytes or any JSON serializable values.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            data = part
+        elif isinstance(part, str):
+            data = part.encode('utf-8')
+        else:
+            data = json.dumps(part, sort_keys=True).encode('utf-8')
+        # length prefix prevents collisions of different splits
+        h.update(str(len(data)).encode('ascii') + b':')
+        h.update(data)
+    return h.hexdigest()
+
+
+class FileCache(object):
+    """
+    Directory of JSON files keyed by digest().
+
+    :param path: cache directory, created on first write
+    :param max_size: evict least recently used entries above this size
+                     (in bytes), None for no limit
+    :param max_age: evict entries not used for this many seconds, None for
+                    no limit
+    :param enabled: when False, nothing is read nor written
+    """
+    SUFFIX = '.json'
+
+    def __init__(self, path, max_size=None, max_age=None, enabled=True):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.enabled = enabled
+
+    def _fn(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        fn = self._fn(key)
+        try:
+            with open(fn, 'r') as f:
+                value = json.load(f)
+            mtime = os.path.getmtime(fn)
+        except (IOError, OSError, ValueError):
+            return default
+        now = time.time()
+        if self.max_age is not None and now - mtime > self.max_age:
+            return default
+        try:
+            # mtime is the last use for eviction purposes
+            os.utime(fn, (now, now))
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        fn = self._fn(key)
+        tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+        try:
+            # parallel writers may race to create the directory
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_fn, 'w') as f:
+                json.dump(value, f)
+            os.rename(tmp_fn, fn)
+        except (IOError, OSError):
+            # cache is an optimization, don't fail on unwritable cache
+            try:
+                os.remove(tmp_fn)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._fn(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        """
+        Return a list of (mtime, size, path) of cache entries, oldest first.
+        """
+        entries = []
+        try:
+            fns = os.listdir(self.path)
+        except OSError:
+            return entries
+        for fn in fns:
+            if not fn.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.path, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """
+        Remove entries older than max_age and least recently used entries
+        until total size is below max_size.
+        """
+        if self.max_age is None and self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        oldest = None
+        if self.max_age is not None:
+            oldest = time.time() - self.max_age
+        for mtime, size, path in entries:
+            expired = oldest is not None and mtime < oldest
+            too_big = self.max_size is not None and total > self.max_size
+            if not (expired or too_big):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -1,12 +1,28 @@
 # -*- encoding: utf-8 -*-
 from __future__ import unicode_literals
 
+import collections
 import json
+import resource
 import six
 import subprocess
+import sys
+import threading
+import time
 
 from rdopkg import exception
 from rdopkg.utils import log
+from rdopkg.utils.runcache import run_cache
+from rdopkg.utils.trace import tracer
+
+
+# default max number of commands run_many() runs at once
+RUN_MANY_JOBS = 8
+# max size of output chunks read by run_iter()
+RUN_ITER_CHUNK_SIZE = 64 * 1024
+# number of last stdout records and stderr lines run_iter() keeps for
+# failure reporting
+RUN_ITER_TAIL = 50
 
 
 class _CommandOutput(six.text_type):
@@ -43,74 +59,265 @@ def log_cmd_fail(cmd, cout, fail_log_fun=log.warn, out_log_fun=log.info):
         out_log_fun('')
 
 
+class _RunOptions(object):
+    """
+    Parsed run() arguments shared by run() and run_async().
+    """
+    def __init__(self, cmd, params, kwargs):
+        self.fatal = kwargs.get('fatal', True)
+        self.direct = kwargs.get('direct', False)
+        self.log_cmd = kwargs.get('log_cmd', True)
+        self.log_fail = kwargs.get('log_fail', True)
+        self.print_stdout = kwargs.get('print_stdout', False)
+        self.print_stderr = kwargs.get('print_stderr', False)
+        if kwargs.get('print_output', False):
+            self.print_stdout = True
+            self.print_stderr = True
+        self.env = kwargs.get('env', None)
+        # True: pure command, result can be memoized by run_cache
+        # False: read-only command, doesn't invalidate run_cache
+        # None: unknown command which might change anything
+        self.memoize = kwargs.get('memoize', None)
+
+        cmd = [cmd]
+        cmd.extend(p if isinstance(p, six.string_types) else six.text_type(p)
+                   for p in params)
+        self.cmd_str = ' '.join(cmd)
+        self.cmd = list(map(encode, cmd))
+
+        input = kwargs.get('input')
+        if input:
+            self.stdin = subprocess.PIPE
+            if isinstance(input, bytes):
+                self.input = input
+            else:
+                self.input = input.encode('utf-8')
+        else:
+            self.stdin = None
+            self.input = None
+
+        if self.direct:
+            self.stdout = None
+            self.stderr = None
+        else:
+            self.stdout = subprocess.PIPE
+            self.stderr = subprocess.PIPE
+
+        self.start = None
+        self.usage = None
+
+    def started(self):
+        if self.log_cmd:
+            log.command(log.term.cmd(self.cmd_str))
+        if tracer.enabled:
+            self.start = time.time()
+            self.usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def finished(self, return_code, out, err, out_bytes=None,
+                 err_bytes=None):
+        """
+        Return _CommandOutput of finished command or raise CommandFailed.
+
+        out_bytes and err_bytes are total output sizes when out and err
+        are only parts of the output.
+        """
+        if self.start is not None:
+            wall = time.time() - self.start
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            if out_bytes is None:
+                out_bytes = len(out or b'')
+            if err_bytes is None:
+                err_bytes = len(err or b'')
+            tracer.record(self.cmd_str, self.start, wall,
+                          cpu_user=usage.ru_utime - self.usage.ru_utime,
+                          cpu_sys=usage.ru_stime - self.usage.ru_stime,
+                          return_code=return_code,
+                          out_bytes=out_bytes, err_bytes=err_bytes)
+
+        if out:
+            out = out.rstrip()
+            if self.print_stdout:
+                log.info(out)
+        else:
+            out = b''
+
+        if err:
+            err = err.rstrip()
+            if self.print_stderr:
+                log.info(err)
+        else:
+            err = b''
+
+        cout = _CommandOutput(out.decode('utf-8'))
+        cout.stderr = err
+        cout.return_code = return_code
+        cout.cmd = self.cmd_str
+        if return_code != 0:
+            if self.log_fail:
+                log_cmd_fail(self.cmd_str, cout)
+            if self.fatal:
+                raise exception.CommandFailed(cmd=self.cmd, out=cout)
+        return cout
+
+
 def run(cmd, *params, **kwargs):
-    fatal = kwargs.get('fatal', True)
-    direct = kwargs.get('direct', False)
-    log_cmd = kwargs.get('log_cmd', True)
-    log_fail = kwargs.get('log_fail', True)
-    input = kwargs.get('input')
-    print_stdout = kwargs.get('print_stdout', False)
-    print_stderr = kwargs.get('print_stderr', False)
-    print_output = kwargs.get('print_output', False)
-    env = kwargs.get('env', None)
-
-    cmd = [cmd]
-    cmd.extend(p if isinstance(p, six.string_types) else six.text_type(p)
-               for p in params)
-    cmd_str = ' '.join(cmd)
-
-    if log_cmd:
-        log.command(log.term.cmd(cmd_str))
-
-    if print_output:
-        print_stdout = True
-        print_stderr = True
-
-    if input:
-        stdin = subprocess.PIPE
-        input = input.encode('utf-8')
-    else:
-        stdin = None
-
-    if direct:
-        stdout = None
-        stderr = None
-    else:
-        stdout = subprocess.PIPE
-        stderr = subprocess.PIPE
-
-    cmd = list(map(encode, cmd))
+    opts = _RunOptions(cmd, params, kwargs)
+    cache_key = None
+    if (run_cache.enabled and opts.memoize
+            and not opts.direct and opts.input is None):
+        cache_key = run_cache.key(opts.cmd, opts.env)
+        cached = run_cache.get(cache_key)
+        if cached is not None:
+            return opts.finished(*cached)
+    opts.started()
+    try:
+        prc = subprocess.Popen(opts.cmd, stdin=opts.stdin,
+                               stdout=opts.stdout, stderr=opts.stderr,
+                               env=opts.env)
+    except OSError:
+        raise exception.CommandNotFound(cmd=opts.cmd[0])
+    out, err = prc.communicate(input=opts.input)
+    if cache_key:
+        run_cache.set(cache_key, prc.returncode, out, err)
+    elif opts.memoize is None:
+        run_cache.invalidate()
+    return opts.finished(prc.returncode, out, err)
+
+
+def run_iter(cmd, *params, **kwargs):
+    """
+    Run a command and yield its decoded output records as they arrive.
+
+    Unlike run(), output isn't collected in memory. Only the last
+    RUN_ITER_TAIL stdout records and stderr lines are kept for failure
+    reporting. The command is only read as fast as the generator is
+    consumed, and it is killed when the generator is closed early.
+
+    :param sep: output record separator, '\\n' (lines) by default
+    :param tail: number of last records and stderr lines to keep
+    :param kwargs: run() arguments except direct, input and print_*
+
+    With fatal=True (default), CommandFailed is raised after the last
+    record. Its output contains only the kept tail.
+    """
+    sep = kwargs.pop('sep', '\n').encode('utf-8')
+    tail = kwargs.pop('tail', RUN_ITER_TAIL)
+    opts = _RunOptions(cmd, params, kwargs)
+    opts.started()
     try:
-        prc = subprocess.Popen(cmd, stdin=stdin, stdout=stdout,
-                               stderr=stderr, env=env)
+        prc = subprocess.Popen(opts.cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=opts.env)
     except OSError:
-        raise exception.CommandNotFound(cmd=cmd[0])
-    out, err = prc.communicate(input=input)
-
-    if out:
-        out = out.rstrip()
-        if print_stdout:
-            log.info(out)
-    else:
-        out = b''
-
-    if err:
-        err = err.rstrip()
-        if print_stderr:
-            log.info(err)
-    else:
-        err = b''
-
-    cout = _CommandOutput(out.decode('utf-8'))
-    cout.stderr = err
-    cout.return_code = prc.returncode
-    cout.cmd = cmd_str
-    if prc.returncode != 0:
-        if log_fail:
-            log_cmd_fail(cmd_str, cout)
-        if fatal:
-            raise exception.CommandFailed(cmd=cmd, out=cout)
-    return cout
+        raise exception.CommandNotFound(cmd=opts.cmd[0])
+    out_tail = collections.deque(maxlen=tail)
+    err_tail = collections.deque(maxlen=tail)
+    sizes = {'out': 0, 'err': 0}
+
+    def _drain_stderr():
+        # stderr must be read concurrently or a chatty command blocks
+        for line in prc.stderr:
+            sizes['err'] += len(line)
+            err_tail.append(line)
+
+    drain = threading.Thread(target=_drain_stderr)
+    drain.daemon = True
+    drain.start()
+    finished = False
+    try:
+        buf = b''
+        while True:
+            chunk = prc.stdout.read1(RUN_ITER_CHUNK_SIZE)
+            if not chunk:
+                break
+            sizes['out'] += len(chunk)
+            records = (buf + chunk).split(sep)
+            buf = records.pop()
+            for record in records:
+                out_tail.append(record)
+                yield record.decode('utf-8', 'replace')
+        if buf:
+            out_tail.append(buf)
+            yield buf.decode('utf-8', 'replace')
+        finished = True
+    finally:
+        if not finished:
+            # stopped early
+            prc.kill()
+        prc.stdout.close()
+        drain.join()
+        prc.stderr.close()
+        prc.wait()
+        if opts.memoize is None:
+            run_cache.invalidate()
+    opts.finished(prc.returncode, sep.join(out_tail), b''.join(err_tail),
+                  out_bytes=sizes['out'], err_bytes=sizes['err'])
+
+
+async def run_async(cmd, *params, **kwargs):
+    """
+    asyncio coroutine version of run() with the same arguments and results.
+
+    Results aren't memoized.
+    """
+    # asyncio is slow to import and not needed by most rdopkg runs
+    import asyncio
+    opts = _RunOptions(cmd, params, kwargs)
+    opts.started()
+    try:
+        prc = await asyncio.create_subprocess_exec(
+            *opts.cmd, stdin=opts.stdin, stdout=opts.stdout,
+            stderr=opts.stderr, env=opts.env)
+    except OSError:
+        raise exception.CommandNotFound(cmd=opts.cmd[0])
+    out, err = await prc.communicate(input=opts.input)
+    if opts.memoize is None:
+        run_cache.invalidate()
+    return opts.finished(prc.returncode, out, err)
+
+
+def run_many(cmds, jobs=RUN_MANY_JOBS, **kwargs):
+    """
+    Run commands concurrently and return a list of their results in order.
+
+    :param cmds: iterable of commands, each a sequence of (cmd, params...)
+    :param jobs: maximum number of commands running at once
+    :param kwargs: run() arguments used for all commands
+
+    All commands are run to completion. With fatal=True (default)
+    CommandFailed of the first failed command in order is raised after
+    that, same for CommandNotFound.
+    """
+    import asyncio
+    cmds = [list(c) for c in cmds]
+    if not cmds:
+        return []
+    fatal = kwargs.pop('fatal', True)
+
+    async def _run_all():
+        semaphore = asyncio.Semaphore(jobs)
+
+        async def _run_one(cmd):
+            async with semaphore:
+                return await run_async(*cmd, fatal=False, **kwargs)
+
+        return await asyncio.gather(*[_run_one(c) for c in cmds],
+                                    return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    try:
+        if sys.version_info < (3, 8):
+            # older child watcher needs to know the loop (main thread only)
+            asyncio.get_child_watcher().attach_loop(loop)
+        results = loop.run_until_complete(_run_all())
+    finally:
+        loop.close()
+    for cmd, result in zip(cmds, results):
+        if isinstance(result, Exception):
+            raise result
+        if fatal and result.return_code != 0:
+            raise exception.CommandFailed(cmd=list(map(encode, cmd)),
+                                          out=result)
+    return results
 
 
 class ShellCommand(object):
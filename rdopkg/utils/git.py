@@ -1,15 +1,105 @@
 # -*- encoding: utf-8 -*-
 from __future__ import unicode_literals
 
+import atexit
+from collections import defaultdict
+from collections import namedtuple
+from collections import OrderedDict
 import contextlib
+from concurrent import futures
+import json
 import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
 
 from rdopkg import exception
+from rdopkg.utils.cmd import _CommandOutput
+from rdopkg.utils.cmd import _RunOptions
 from rdopkg.utils.cmd import run
+from rdopkg.utils.cmd import run_iter
 from rdopkg.utils.cmd import ShellCommand
+from rdopkg.utils import log
+from rdopkg.utils.runcache import run_cache
 from rdopkg.utils.issues import search_bug_references
 
 
+# revision expressions which aren't plain ref names
+RE_REF_EXPRESSION = re.compile(r'[:^~@{}\s*?\[\\]')
+# git commands which don't change refs
+READ_ONLY_COMMANDS = frozenset([
+    'blame', 'cat-file', 'config', 'describe', 'diff', 'for-each-ref',
+    'format-patch', 'log', 'ls-files', 'ls-remote', 'ls-tree', 'merge-base',
+    'name-rev', 'patch-id', 'rev-list', 'rev-parse', 'shortlog', 'show',
+    'show-ref', 'status', 'var',
+])
+# read-only commands which also don't depend on the work tree so their
+# results can be memoized until a command which changes refs is run
+# (format-patch doesn't change refs but it writes files)
+PURE_COMMANDS = READ_ONLY_COMMANDS - frozenset([
+    'blame', 'config', 'diff', 'format-patch', 'ls-files', 'status',
+])
+# git config options which change the configuration
+CONFIG_WRITE_OPTIONS = frozenset([
+    '--add', '--replace-all', '--unset', '--unset-all', '--rename-section',
+    '--remove-section', '--edit', '-e',
+])
+# git remote subcommands which don't change remotes
+REMOTE_READ_SUBCOMMANDS = frozenset(['-v', '--verbose', 'get-url'])
+OBJECT_TYPES = ('blob', 'tree', 'commit', 'tag')
+RE_SHA = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
+RE_COMMITTER_TIMESTAMP = re.compile(br'^committer .* (\d+) [+-]\d{4}$',
+                                    flags=re.M)
+# first line of git format-patch output identifying the commit
+RE_PATCH_FROM_LINE = re.compile(br'^From [0-9a-f]{40} [^\n]*\n')
+# blob hashes of a file diff in git format-patch output
+RE_PATCH_INDEX_LINE = re.compile(br'^index [0-9a-f]+\.\.[0-9a-f]+( \d+)?\n',
+                                 flags=re.M)
+
+
+# git log format placeholders of fields available in log records
+LOG_FIELDS = {
+    'hash': '%H',
+    'short_hash': '%h',
+    'parents': '%P',
+    'subject': '%s',
+    'body': '%b',
+    'author': '%an <%ae>',
+    'author_name': '%an',
+    'timestamp': '%ct',
+}
+# file in git dir with times of last fetches by fetch_many()
+FETCH_TIMES_FILE = 'rdopkg-fetch-times.json'
+# remote and refspecs to fetch, tags=False fetches with --no-tags
+Fetch = namedtuple('Fetch', ['remote', 'refspecs', 'tags'])
+_log_record_types = {}
+
+
+def log_record_type(fields):
+    """
+    Return a namedtuple class of git log records with fields.
+    """
+    record = _log_record_types.get(fields)
+    if record is None:
+        record = namedtuple('LogRecord', fields)
+        _log_record_types[fields] = record
+    return record
+
+
+def config_key(name):
+    """
+    Normalize git config key: section and variable names are case
+    insensitive, subsection isn't.
+    """
+    section, _, rest = name.partition('.')
+    subsection, _, var = rest.rpartition('.')
+    if subsection:
+        return '%s.%s.%s' % (section.lower(), subsection, var.lower())
+    return '%s.%s' % (section.lower(), var.lower())
+
+
 @contextlib.contextmanager
 def git_branch(branch):
     if branch:
@@ -36,8 +126,356 @@ def git_revision(gitrev):
         yield
 
 
+class CatFileBatch(object):
+    """
+    Long-lived `git cat-file --batch(-check)` coprocess of a repository.
+
+    Object lookups cost a pipe round-trip instead of fork+exec of a new git
+    process. IOError is raised when the coprocess dies.
+    """
+    def __init__(self, cwd, contents=False, command='git'):
+        self.cwd = cwd
+        self.contents = contents
+        mode = '--batch' if contents else '--batch-check'
+        self.proc = subprocess.Popen(
+            [command, 'cat-file', mode], cwd=cwd,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        self.lock = threading.Lock()
+
+    def query(self, obj):
+        """
+        Return (sha, type, size, contents) of an object or None when it
+        doesn't exist. contents is None for --batch-check.
+        """
+        with self.lock:
+            try:
+                self.proc.stdin.write(obj.encode('utf-8') + b'\n')
+                self.proc.stdin.flush()
+                header = self.proc.stdout.readline()
+            except (IOError, OSError, ValueError) as ex:
+                self.close()
+                raise IOError("git cat-file failed: %s" % ex)
+            if not header:
+                self.close()
+                raise IOError("git cat-file exited")
+            parts = header.decode('utf-8', 'replace').rstrip('\n').split(' ')
+            if len(parts) != 3 or parts[1] not in OBJECT_TYPES:
+                # missing or ambiguous
+                return None
+            sha, type_, size = parts[0], parts[1], int(parts[2])
+            contents = None
+            if self.contents:
+                contents = self.proc.stdout.read(size + 1)[:size]
+            return sha, type_, size, contents
+
+    def close(self):
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc.stdout.close()
+
+
+def command_kind(params):
+    """
+    Classify git command with `params` for memoization purposes.
+
+    Return True for pure commands, False for other commands which don't
+    change refs (including config writes) and None for commands which
+    might change the repository.
+    """
+    if not params or params[0] not in READ_ONLY_COMMANDS:
+        if params and params[0] == 'remote' and (
+                len(params) == 1 or params[1] in REMOTE_READ_SUBCOMMANDS
+                # without remote names, `git remote show` just lists them
+                or tuple(params[1:]) == ('show',)):
+            return True
+        return None
+    if params[0] == 'config':
+        args = [p for p in params[1:] if not p.startswith('-')]
+        if CONFIG_WRITE_OPTIONS.intersection(params) or len(args) > 1:
+            return False
+        return True
+    return params[0] in PURE_COMMANDS
+
+
+class UnsupportedRefs(Exception):
+    """
+    Raised by RefReader when git needs to be asked instead.
+    """
+
+
+class RefReader(object):
+    """
+    Resolve refs of a repository by reading its files without running git.
+
+    HEAD, symbolic refs, loose refs, packed-refs and linked worktrees are
+    supported. Anything else (reftable, environment overrides, bare
+    repositories, broken refs, ...) raises UnsupportedRefs internally and
+    public methods return None so that callers can fall back to git.
+    """
+    MAX_SYMREF_DEPTH = 5
+    # refs stored per worktree in git dir, all other are in common dir
+    PER_WORKTREE_PREFIXES = ('refs/bisect/', 'refs/worktree/',
+                             'refs/rewritten/')
+    # environment which changes repository discovery or layout
+    ENV_OVERRIDES = ('GIT_DIR', 'GIT_WORK_TREE', 'GIT_COMMON_DIR',
+                     'GIT_CEILING_DIRECTORIES',
+                     'GIT_DISCOVERY_ACROSS_FILESYSTEM', 'GIT_REF_STORAGE')
+    # git rev-parse rules to expand short ref names, see abbrev()
+    SHORT_REF_RULES = ('%s', 'refs/%s', 'refs/tags/%s', 'refs/heads/%s',
+                       'refs/remotes/%s', 'refs/remotes/%s/HEAD')
+
+    def __init__(self, git_dir, common_dir=None):
+        self.git_dir = git_dir
+        self.common_dir = common_dir or git_dir
+        self._packed = None
+        self._packed_stat = None
+
+    @classmethod
+    def discover(cls, path):
+        """
+        Return RefReader of a repository with work tree containing path or
+        None when git discovery isn't trivial.
+        """
+        if any(var in os.environ for var in cls.ENV_OVERRIDES):
+            return None
+        try:
+            path = os.path.abspath(path)
+            dev = os.stat(path).st_dev
+            while True:
+                dotgit = os.path.join(path, '.git')
+                git_dir = None
+                if os.path.isdir(dotgit):
+                    git_dir = dotgit
+                elif os.path.isfile(dotgit):
+                    with open(dotgit) as f:
+                        line = f.readline().strip()
+                    if not line.startswith('gitdir:'):
+                        return None
+                    git_dir = os.path.join(path, line[7:].strip())
+                if git_dir and os.path.isfile(os.path.join(git_dir, 'HEAD')):
+                    return cls._open(git_dir)
+                if os.path.isfile(os.path.join(path, 'HEAD')):
+                    # inside git dir or bare repository
+                    return None
+                parent = os.path.dirname(path)
+                if parent == path or os.stat(parent).st_dev != dev:
+                    return None
+                path = parent
+        except (IOError, OSError, ValueError):
+            return None
+
+    @classmethod
+    def _open(cls, git_dir):
+        git_dir = os.path.normpath(git_dir)
+        common_dir = git_dir
+        commondir_fn = os.path.join(git_dir, 'commondir')
+        if os.path.isfile(commondir_fn):
+            with open(commondir_fn) as f:
+                common_dir = os.path.normpath(
+                    os.path.join(git_dir, f.read().strip()))
+        if os.path.exists(os.path.join(common_dir, 'reftable')):
+            return None
+        if os.stat(common_dir).st_uid != os.geteuid():
+            # let git deal with safe.directory
+            return None
+        return cls(git_dir, common_dir)
+
+    def _loose_path(self, name):
+        if (name.startswith('main-worktree/')
+                or name.startswith('worktrees/')):
+            raise UnsupportedRefs(name)
+        if (not name.startswith('refs/')
+                or name.startswith(self.PER_WORKTREE_PREFIXES)):
+            return os.path.join(self.git_dir, name)
+        return os.path.join(self.common_dir, name)
+
+    def packed_refs(self):
+        """
+        Return {refname: sha} of packed-refs, reread only when it changes.
+        """
+        fn = os.path.join(self.common_dir, 'packed-refs')
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return {}
+        stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stat != self._packed_stat:
+            packed = {}
+            with open(fn, 'rb') as f:
+                for line in f:
+                    if line.startswith((b'#', b'^')):
+                        continue
+                    sha, _, name = line.decode('utf-8').rstrip().partition(
+                        ' ')
+                    packed[name] = sha
+            self._packed = packed
+            self._packed_stat = stat
+        return self._packed
+
+    def read_ref(self, name):
+        """
+        Return (sha, None) or (None, symref target) of a ref or None when
+        it doesn't exist.
+        """
+        if ('..' in name or '//' in name or '/.' in name
+                or name.startswith(('/', '.')) or name.endswith(('/', '.lock'))
+                or RE_REF_EXPRESSION.search(name)):
+            raise UnsupportedRefs(name)
+        try:
+            with open(self._loose_path(name), 'rb') as f:
+                content = f.read().decode('utf-8').strip()
+        except (IOError, OSError):
+            # missing or a directory of refs
+            content = None
+        if content is not None:
+            if content.startswith('ref:'):
+                return None, content[4:].strip()
+            if RE_SHA.match(content):
+                return content, None
+            raise UnsupportedRefs(name)
+        if name.startswith('refs/'):
+            sha = self.packed_refs().get(name)
+            if sha:
+                return sha, None
+        return None
+
+    def resolve(self, name):
+        """
+        Return sha a ref points to following symbolic refs or None when it
+        doesn't exist.
+        """
+        for _ in range(self.MAX_SYMREF_DEPTH):
+            ref = self.read_ref(name)
+            if not ref:
+                return None
+            sha, target = ref
+            if sha:
+                return sha
+            name = target
+        raise UnsupportedRefs(name)
+
+    def _call(self, fun, *args):
+        try:
+            return fun(*args)
+        except (UnsupportedRefs, IOError, OSError, ValueError):
+            return None
+
+    def ref_exists(self, name):
+        """
+        Return True/False whether ref exists or None if unsupported.
+        """
+        return self._call(lambda n: self.resolve(n) is not None, name)
+
+    def head_commit(self):
+        """
+        Return sha of HEAD, None if unsupported or unborn.
+        """
+        return self._call(self.resolve, 'HEAD')
+
+    def head_abbrev(self):
+        """
+        Return the same as `git rev-parse --abbrev-ref HEAD`: current
+        branch name or HEAD when detached. Return None when unsupported,
+        unborn or the short name is ambiguous.
+        """
+        return self._call(self._head_abbrev)
+
+    def _head_abbrev(self):
+        ref = self.read_ref('HEAD')
+        if not ref:
+            return None
+        sha, target = ref
+        if sha:
+            return 'HEAD'
+        if not target.startswith('refs/heads/'):
+            return None
+        if self.resolve(target) is None:
+            return None
+        branch = target[len('refs/heads/'):]
+        for rule in self.SHORT_REF_RULES:
+            other = rule % branch
+            if other != target and self.resolve(other) is not None:
+                return None
+        return branch
+
+
 class Git(ShellCommand):
     command = "git"
+    # max number of cat-file coprocesses running
+    max_batches = 16
+    # set to False to always run one-shot git processes
+    use_batch = True
+    # set to False to always ask git about refs instead of RefReader
+    use_ref_reader = True
+    # cwd -> {refname: sha} snapshots shared by all instances
+    _refs = {}
+    # (cwd, env) -> {key: [(origin, value)]} config snapshots
+    _config = {}
+
+    def __init__(self):
+        super(Git, self).__init__()
+        # (cwd, contents) -> CatFileBatch, least recently used first
+        self._batches = OrderedDict()
+        self._batches_lock = threading.Lock()
+        atexit.register(self.close_batches)
+        # cwd -> RefReader
+        self._ref_readers = {}
+        # commands not run through this instance might change the repo
+        run_cache.add_listener(self.invalidate_snapshots)
+
+    def _batch(self, contents=False):
+        """
+        Return CatFileBatch of current directory or None if unavailable.
+        """
+        if not self.use_batch:
+            return None
+        key = (os.getcwd(), contents)
+        with self._batches_lock:
+            batch = self._batches.pop(key, None)
+            if batch is None or batch.proc.poll() is not None:
+                try:
+                    batch = CatFileBatch(key[0], contents=contents,
+                                         command=self.command)
+                except OSError:
+                    return None
+            self._batches[key] = batch
+            while len(self._batches) > self.max_batches:
+                _, old = self._batches.popitem(last=False)
+                old.close()
+        return batch
+
+    def cat_file(self, obj, contents=False):
+        """
+        Query an object through cat-file coprocess.
+
+        Return (sha, type, size, contents) tuple, None when the object
+        doesn't exist or False when the coprocess isn't available and
+        a one-shot command should be used instead.
+        """
+        if '\n' in obj:
+            return False
+        batch = self._batch(contents=contents)
+        if batch is None:
+            return False
+        try:
+            return batch.query(obj)
+        except IOError:
+            return False
+
+    def close_batches(self):
+        with self._batches_lock:
+            while self._batches:
+                _, batch = self._batches.popitem()
+                batch.close()
 
     def __call__(self, *params, **kwargs):
         # allows us to run git in isolated mode, avoiding interaction with user
@@ -47,8 +485,52 @@ class Git(ShellCommand):
             env['GIT_CONFIG_NOSYSTEM'] = '1'
             env['GIT_CONFIG_NOGLOBAL'] = '1'
             kwargs['env'] = env
+        kind = command_kind(params)
+        if kind is None:
+            # refs and config might have changed, run() invalidates
+            # snapshots through run_cache after the command too
+            self.invalidate_snapshots()
+        elif params[0] == 'config' and '--list' not in params:
+            self.invalidate_config()
+            if not kind:
+                # config changed, refs didn't
+                run_cache.invalidate(listeners=False)
+        kwargs.setdefault('memoize', kind)
         return run(self.command, *params, **kwargs)
 
+    def invalidate_snapshots(self):
+        """
+        Drop ref and config snapshots and ref readers.
+        """
+        self.invalidate_refs()
+        self.invalidate_config()
+        self._ref_readers.clear()
+
+    def refs(self):
+        """
+        Return {refname: sha} of all refs in current repository loaded
+        once by for-each-ref or None when not available.
+
+        The snapshot is invalidated by any git command not known to be
+        read-only.
+        """
+        key = os.getcwd()
+        refs = self._refs.get(key)
+        if refs is None:
+            out = self('for-each-ref', '--format=%(objectname) %(refname)',
+                       log_cmd=False, log_fail=False, fatal=False)
+            if not out.success:
+                return None
+            refs = {}
+            for line in out.splitlines():
+                sha, _, name = line.partition(' ')
+                refs[name] = sha
+            self._refs[key] = refs
+        return refs
+
+    def invalidate_refs(self):
+        self._refs.clear()
+
     def create_branch_from_remote(self, branch, remote_branch=None):
         lbr = self.local_branches()
         if branch in lbr or remote_branch in lbr:
@@ -71,24 +553,60 @@ class Git(ShellCommand):
         output = [o for o in self._parse_output(out) if o.find('HEAD') < 0]
         return output
 
+    def _ref_names(self, prefix):
+        # names of refs under prefix in refname order excluding *HEAD*
+        refs = self.refs()
+        if refs is None:
+            return None
+        n = len(prefix)
+        return [r[n:] for r in sorted(refs)
+                if r.startswith(prefix) and r.find('HEAD', n) < 0]
+
     def remote_branches(self, remote=""):
-        res = self("branch", "-r", "--no-color", log_cmd=False)
-        branches = self._parse_branch_output(res)
-        branches = [b.replace("remotes/", "")
-                    for b in branches if b.startswith(remote)]
-        return branches
+        branches = self._ref_names('refs/remotes/')
+        if branches is None:
+            res = self("branch", "-r", "--no-color", log_cmd=False)
+            branches = self._parse_branch_output(res)
+            branches = [b.replace("remotes/", "") for b in branches]
+        return [b for b in branches if b.startswith(remote)]
 
     def local_branches(self):
-        res = self("branch")
-        res = self._parse_branch_output(res)
-        res = [b.replace("* ", "") for b in res]
+        res = self._ref_names('refs/heads/')
+        if res is None:
+            res = self("branch")
+            res = self._parse_branch_output(res)
+            res = [b.replace("* ", "") for b in res]
         return res
 
+    def ref_reader(self):
+        """
+        Return RefReader of current repository or None if not supported.
+        """
+        if not self.use_ref_reader:
+            return None
+        key = os.getcwd()
+        reader = self._ref_readers.get(key)
+        if reader is None:
+            reader = RefReader.discover(key)
+            if reader is not None:
+                self._ref_readers[key] = reader
+        return reader
+
     def current_branch(self):
+        reader = self.ref_reader()
+        if reader:
+            branch = reader.head_abbrev()
+            if branch:
+                return _CommandOutput(branch)
         branch = self('rev-parse', '--abbrev-ref', 'HEAD', log_cmd=False)
         return branch
 
     def current_commit(self):
+        reader = self.ref_reader()
+        if reader:
+            commit = reader.head_commit()
+            if commit:
+                return _CommandOutput(commit)
         commit = self('rev-parse', 'HEAD', log_cmd=False)
         return commit
 
@@ -105,6 +623,15 @@ class Git(ShellCommand):
         return ref
 
     def ref_exists(self, ref):
+        if ref.startswith('refs/') and not RE_REF_EXPRESSION.search(ref):
+            reader = self.ref_reader()
+            if reader:
+                exists = reader.ref_exists(ref)
+                if exists is not None:
+                    return exists
+            refs = self.refs()
+            if refs is not None:
+                return ref in refs
         o = self('show-ref', '--verify', '--quiet', ref,
                  fatal=False, log_cmd=False, log_fail=False)
         return o.success
@@ -113,6 +640,9 @@ class Git(ShellCommand):
         return self.ref_exists('refs/heads/%s' % branch)
 
     def object_type(self, ref):
+        o = self.cat_file(ref)
+        if o is not False:
+            return o and o[1]
         o = self('cat-file', '-t', ref,
                  fatal=False, log_cmd=False, log_fail=False)
         if not o:
@@ -129,6 +659,79 @@ class Git(ShellCommand):
         res = self("remote", "show", log_cmd=False)
         return self._parse_branch_output(res)
 
+    def _fetch_times_path(self):
+        git_dir = self('rev-parse', '--git-common-dir', log_cmd=False)
+        return os.path.join(git_dir, FETCH_TIMES_FILE)
+
+    def fetch_many(self, fetches, jobs=4, period=0):
+        """
+        Fetch Fetch(remote, refspecs, tags) tuples concurrently.
+
+        At most `jobs` fetches run in parallel and fetches done in last
+        `period` seconds are skipped. Fetches with tags run one after
+        another as parallel updates of the same tags would clash.
+
+        Return a list of fetches which were run.
+        """
+        times_path = self._fetch_times_path()
+        try:
+            with open(times_path) as f:
+                times = json.load(f)
+        except (IOError, OSError, ValueError):
+            times = {}
+        now = time.time()
+        todo = []
+        for fetch in fetches:
+            key = ' '.join([fetch.remote] + list(fetch.refspecs)
+                           + (['--tags'] if fetch.tags else []))
+            if now - times.get(key, 0) < period:
+                log.info("Skipping recent fetch of %s" % fetch.remote)
+                continue
+            todo.append((key, fetch))
+        if not todo:
+            return []
+
+        chains = [[f] for f in todo if not f[1].tags]
+        tagged = [f for f in todo if f[1].tags]
+        if tagged:
+            chains.insert(0, tagged)
+        # show git progress unless fetches run in parallel
+        direct = len(chains) == 1
+
+        def _fetch(chain):
+            # return a list of (key, error) of fetches in chain
+            results = []
+            for key, fetch in chain:
+                cmd = ['fetch', '--tags' if fetch.tags else '--no-tags',
+                       fetch.remote]
+                cmd.extend(fetch.refspecs)
+                if not direct:
+                    log.info("Fetching %s" % fetch.remote)
+                try:
+                    self(*cmd, direct=direct)
+                    results.append((key, None))
+                except exception.CommandFailed as ex:
+                    results.append((key, ex))
+            return results
+
+        errors = []
+        with futures.ThreadPoolExecutor(
+                max_workers=max(1, min(jobs, len(chains)))) as pool:
+            for results in pool.map(_fetch, chains):
+                for key, error in results:
+                    if error:
+                        errors.append(error)
+                    else:
+                        times[key] = now
+        try:
+            with open(times_path, 'w') as f:
+                json.dump(times, f)
+        except (IOError, OSError):
+            pass
+        if errors:
+            raise errors[0]
+        return [fetch for _, fetch in todo]
+
     def remote_branch_split(self, branch, fatal=True):
         parts = branch.split('/')
         n_parts = len(parts)
@@ -191,21 +794,42 @@ class Git(ShellCommand):
             rng += to_revision
         return rng
 
+    def log_records(self, *params, **kwargs):
+        """
+        Stream `git log` output as commit records.
+
+        Yield a namedtuple with requested fields per commit as soon as it's
+        read so callers can stop early without reading the whole history.
+
+        :param params: git log parameters such as revision range
+        :param fields: LOG_FIELDS to include, ('hash', 'subject') by default
+        :param fatal: raise CommandFailed when git log fails (default)
+        """
+        fields = tuple(kwargs.get('fields', ('hash', 'subject')))
+        fatal = kwargs.get('fatal', True)
+        record = log_record_type(fields)
+        # separator in free text ends up in the last field
+        maxsplit = len(fields) - 1
+        fmt = '%x1f'.join(LOG_FIELDS[f] for f in fields)
+        for r in run_iter(self.command, 'log', '-z', '--format=%s' % fmt,
+                          *params, sep='\0', fatal=fatal, log_cmd=False,
+                          log_fail=False, memoize=False):
+            yield record(*r.split('\x1f', maxsplit))
+
     def get_commits(self, from_revision, to_revision=None):
         rng = self.rev_range(from_revision, to_revision)
-        log_out = self('log', '--format=%h %s', rng, log_cmd=False)
-        commits = self._parse_output(log_out)
-        return map(lambda x: tuple(x.split(' ', 1)), commits)
+        return ((c.short_hash, c.subject.strip()) for c in self.log_records(
+            rng, fields=('short_hash', 'subject')))
 
     def get_commit_subjects(self, from_revision, to_revision=None):
         rng = self.rev_range(from_revision, to_revision)
-        log_out = self('log', '--format=%s', rng, log_cmd=False)
-        return self._parse_output(log_out)
+        return [c.subject.strip() for c in self.log_records(
+            rng, fields=('subject',))]
 
     def get_commit_hashes(self, from_revision, to_revision=None):
         rng = self.rev_range(from_revision, to_revision)
-        log_out = self('log', '--format=%h', rng, log_cmd=False)
-        return self._parse_output(log_out)
+        return [c.short_hash for c in self.log_records(
+            rng, fields=('short_hash',))]
 
     def get_commit_bzs(self, from_revision, to_revision=None):
         """
@@ -213,25 +837,95 @@ class Git(ShellCommand):
         bz_list). bz_list is a (possibly zero-length) list of numbers.
         """
         rng = self.rev_range(from_revision, to_revision)
-        GIT_COMMIT_FIELDS = ['id', 'subject', 'body']
-        GIT_LOG_FORMAT = ['%h', '%s', '%b']
-        GIT_LOG_FORMAT = '%x1f'.join(GIT_LOG_FORMAT) + '%x1e'
-        log_out = self('log', '--format=%s' % GIT_LOG_FORMAT, '--no-merges',
-                       rng, log_cmd=False, fatal=False)
-        if not log_out:
-            return []
-
-        log = log_out.strip('\n\x1e').split("\x1e")
-        log = [row.strip('\n\t ').split("\x1f") for row in log]
-        log = [dict(zip(GIT_COMMIT_FIELDS, row)) for row in log]
         result = []
-        for commit in log:
-            bzs = search_bug_references(commit['subject'])
-            bzs.extend(search_bug_references(commit['body']))
-            result.append((commit['id'], commit['subject'], bzs))
+        for c in self.log_records('--no-merges', rng,
+                                  fields=('short_hash', 'subject', 'body'),
+                                  fatal=False):
+            bzs = search_bug_references(c.subject)
+            bzs.extend(search_bug_references(c.body))
+            result.append((c.short_hash, c.subject, bzs))
         return result
 
+    def get_patch_ids(self, patches):
+        """
+        Return a list of stable patch IDs of supplied patches (bytes) using
+        a single `git patch-id --stable` call.
+
+        Patch ID is None for patches without a diff.
+        """
+        if not patches:
+            return []
+        # tag each patch with its index in place of commit hash
+        stream = b''.join(
+            b'From %040x Mon Sep 17 00:00:00 2001\n' % (i + 1)
+            + RE_PATCH_FROM_LINE.sub(b'', patch, count=1)
+            for i, patch in enumerate(patches))
+        out = self('patch-id', '--stable', input=stream,
+                   log_cmd=False, log_fail=False)
+        ids = [None] * len(patches)
+        for line in out.splitlines():
+            patch_id, _, tag = line.partition(' ')
+            ids[int(tag, 16) - 1] = patch_id
+        return ids
+
+    def get_commit_patch_ids(self, from_revision, to_revision=None):
+        """
+        Return {commit hash: stable patch ID} of non-merge commits in range
+        computed by `git log -p | git patch-id --stable` in one go.
+        """
+        rng = self.rev_range(from_revision, to_revision)
+        # options used for logging, tracing and errors like with run()
+        run_kwargs = {'log_cmd': False, 'log_fail': False}
+        log_opts = _RunOptions(self.command, [
+            'log', '-p', '--no-merges', '--no-color', '--no-ext-diff',
+            '--format=commit %H', rng], run_kwargs)
+        opts = _RunOptions(self.command, ['patch-id', '--stable'],
+                           run_kwargs)
+        log_opts.started()
+        opts.started()
+        # git log stderr goes to a file so that it can't block the pipeline
+        with tempfile.TemporaryFile() as log_err_file:
+            try:
+                log_proc = subprocess.Popen(log_opts.cmd,
+                                            stdout=subprocess.PIPE,
+                                            stderr=log_err_file)
+                proc = subprocess.Popen(opts.cmd, stdin=log_proc.stdout,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+            except OSError:
+                raise exception.CommandNotFound(cmd=self.command)
+            # patch-id owns the pipe now
+            log_proc.stdout.close()
+            out, err = proc.communicate()
+            log_proc.wait()
+            log_err_file.seek(0)
+            log_err = log_err_file.read()
+        log_opts.finished(log_proc.returncode, b'', log_err)
+        out = opts.finished(proc.returncode, out, err)
+        ids = {}
+        for line in out.splitlines():
+            patch_id, _, commit = line.partition(' ')
+            ids[commit] = patch_id
+        return ids
+
+    def get_patch_ids_of_files(self, paths):
+        """
+        Return a list of stable patch IDs of patch files, None for files
+        which don't exist or don't contain a diff.
+        """
+        patches = []
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    patches.append(f.read())
+            except (IOError, OSError):
+                patches.append(b'')
+        return self.get_patch_ids(patches)
+
     def get_latest_commit_hash(self, ref=None):
+        o = self.cat_file('%s^{commit}' % (ref or 'HEAD'))
+        if o is not False:
+            return o[0] if o else ''
         cmd = ['log', '-n', '1', '--format=%H']
         if ref:
             cmd.append(ref)
@@ -240,20 +934,55 @@ class Git(ShellCommand):
 
     def get_commits_of_branch(self, branch=None,
                               master='remotes/upstream/master'):
-        cmd = ['log', master + '..' + branch, '--oneline', '--reverse',
-               '--format="%H %ct"']
         if not branch:
             return []
-        out = self(*cmd, log_cmd=False, log_fail=False, fatal=False)
-        out = out.replace('"', '')
-        if not out:
-            return []
-        else:
-            commits = list()
-            for c in out.split('\n'):
-                commits.append({'hash': c.split(" ")[0],
-                                'timestamp': c.split(" ")[1]})
-            return commits
+        return [{'hash': c.hash, 'timestamp': c.timestamp}
+                for c in self.log_records(
+                    master + '..' + branch, '--reverse',
+                    fields=('hash', 'timestamp'), fatal=False)]
+
+    def get_first_commits_of_branches(self, branches,
+                                      master='remotes/upstream/master'):
+        """
+        Return {branch: {'hash': ..., 'timestamp': ...}} of first commits
+        of branches since they diverged from master.
+
+        This is the same as get_commits_of_branch(branch)[0] for each branch
+        but all branches are read by a single git log. Branches without
+        commits on top of master are omitted.
+        """
+        branches = list(branches)
+        if not branches:
+            return {}
+        commits = {}
+        order = {}
+        for i, c in enumerate(self.log_records(
+                '^' + master, *branches,
+                fields=('hash', 'timestamp', 'parents'), fatal=False)):
+            commits[c.hash] = c
+            order[c.hash] = i
+        if not commits:
+            return {}
+        tips = self('rev-parse', *branches, log_cmd=False).split('\n')
+        first_commits = {}
+        for branch, tip in zip(branches, tips):
+            # walk branch commits not in master, first one is output last
+            first = None
+            seen = set()
+            todo = [tip]
+            while todo:
+                commit = todo.pop()
+                if commit in seen or commit not in commits:
+                    continue
+                seen.add(commit)
+                if first is None or order[commit] > order[first]:
+                    first = commit
+                todo.extend(commits[commit].parents.split())
+            if first:
+                first_commits[branch] = {
+                    'hash': first,
+                    'timestamp': commits[first].timestamp}
+        return first_commits
 
     def get_latest_tag(self, branch=None):
         cmd = ['describe', '--abbrev=0', '--tags']
@@ -274,13 +1003,51 @@ class Git(ShellCommand):
 
     def get_file_content(self, rev, path):
         obj = '%s:%s' % (rev, path)
+        o = self.cat_file(obj, contents=True)
+        if o and o[1] == 'blob':
+            # same as git show output
+            return _CommandOutput(o[3].decode('utf-8').rstrip())
         return self('show', obj, log_cmd=False)
 
+    def config(self):
+        '''Return {key: [(origin, value), ...]} of git configuration of
+        current repository loaded once by `git config --list` or None when
+        not available. Keys are normalized by config_key().'''
+        key = self._config_snapshot_key()
+        config = self._config.get(key)
+        if config is None:
+            out = self('config', '--list', '-z', '--show-origin',
+                       log_cmd=False, log_fail=False, fatal=False)
+            if out.return_code != 0:
+                return None
+            config = defaultdict(list)
+            fields = out.split('\0')
+            for origin, entry in zip(fields[0::2], fields[1::2]):
+                name, _, value = entry.partition('\n')
+                config[config_key(name)].append((origin, value))
+            self._config[key] = config
+        return config
+
+    def _config_snapshot_key(self):
+        # config depends on repository and environment
+        env = tuple(sorted((k, v) for k, v in os.environ.items()
+                           if k == 'HOME' or k.startswith('GIT_CONFIG')))
+        return os.getcwd(), env
+
+    def invalidate_config(self):
+        self._config.clear()
+
     def config_get(self, param, default=None):
         '''Return the value of a git configuration option.  This will
         return the value of the default parameter (which defaults to
         None) if the given option does not exist.'''
-
+        config = self.config()
+        if config is not None:
+            values = config.get(config_key(param))
+            if not values:
+                return default
+            # last value wins like with git config --get
+            return values[-1][1]
         try:
             return self("config", "--get", param,
                         log_fail=False, log_cmd=False)
@@ -291,7 +1058,21 @@ class Git(ShellCommand):
         params = [param, value]
         if is_global:
             params.insert(0, '--global')
-        return self("config", *params)
+        # run directly to keep the snapshot
+        out = run(self.command, "config", *params, memoize=False)
+        run_cache.invalidate(listeners=False)
+        # write through to the snapshot when the result is obvious
+        config = self._config.get(self._config_snapshot_key())
+        if config is not None:
+            key = config_key(param)
+            values = config.get(key, [])
+            if is_global and values or any(
+                    o.startswith('command line:') for o, _ in values):
+                # overridden by local or command line value
+                self.invalidate_config()
+            else:
+                config[key] = [('rdopkg:config_set', value)]
+        return out
 
     def checkout(self, branch):
         self("checkout", branch, log_cmd=False)
@@ -301,6 +1082,11 @@ class Git(ShellCommand):
              '--committer-date-is-author-date')
 
     def get_timestamp_by_ref(self, ref):
+        o = self.cat_file('%s^{commit}' % ref, contents=True)
+        if o:
+            m = RE_COMMITTER_TIMESTAMP.search(o[3])
+            if m:
+                return m.group(1).decode('ascii')
         timestamp = self('show', '-s', '--oneline', '--format="%ct"',
                          ref, log_cmd=False)
         return timestamp.replace('"', '')
@@ -3,18 +3,22 @@ Check for common .spec problems
 """
 
 from collections import defaultdict
+from concurrent import futures
+import glob
+import os
 import re
+import shutil
+
+import six
 
 from rdopkg import exception
+from rdopkg.conf import cfg
+from rdopkg.utils import cache
 from rdopkg.utils import log
 from rdopkg.utils.cmd import run
 from rdopkg import helpers
 
 
-class StopLookingForRELine(Exception):
-    pass
-
-
 class LintHint(object):
     def __init__(self, location, level, msg):
         self.location = location
@@ -50,100 +54,298 @@ RE_RPMLINT_TO_BE_IGNORED = [r'\=* rpmlint session starts \=*',
                             r'    /etc/xdg/.*',
                             r'checks: \d+, packages: \d+',
                             r'\=* \d+ packages and \d+ specfiles .*']
+# compiled once for all output lines
+RE_RPMLINT_HINT_COMPILED = re.compile(RE_RPMLINT_HINT)
+RE_RPMLINT_IGNORED = re.compile(
+    '|'.join('(?:%s)' % rule for rule in RE_RPMLINT_TO_BE_IGNORED))
+# rpmlint exit codes of a successful run (with or without problems found)
+RPMLINT_SUCCESS_CODES = (0, 64, 66)
+RPMLINT_WORKERS = 8
+# user and system rpmlint configuration (1.x and 2.x)
+RPMLINT_CONFIG_FILES = [
+    '/usr/share/rpmlint/config', '/usr/share/rpmlint/*.toml',
+    '/etc/rpmlint/*', '/etc/xdg/rpmlint/*',
+    '~/.config/rpmlint', '~/.config/rpmlint/*', '~/.rpmlintrc',
+]
+# rpmlintrc files loaded by rpmlint from directory of checked files
+RPMLINTRC_FILES = ['*rpmlintrc']
+_rpmlint_version = None
 
 
-def rpmlint_check(*args):
-    # run rpmlint and return linting hints it found
+def rpmlint_version():
+    """
+    Return an identification of installed rpmlint for use in cache keys
+    or None when rpmlint isn't available.
+
+    Package metadata and rpmlint executable are inspected because running
+    `rpmlint --version` is as slow as the checks.
+    """
+    global _rpmlint_version
+    if _rpmlint_version is None:
+        path = shutil.which('rpmlint')
+        if not path:
+            return None
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        version = None
+        try:
+            from importlib import metadata
+            version = metadata.version('rpmlint')
+        except Exception:
+            pass
+        _rpmlint_version = [path, st.st_mtime, st.st_size, version]
+    return _rpmlint_version
+
+
+def rpmlint_cache_key(args):
+    """
+    Return a key of rpmlint results for args or None if they can't be
+    cached.
+
+    The key covers rpmlint version, arguments, contents of files passed
+    as arguments and of rpmlintrc files next to them, and rpmlint
+    configuration files.
+    """
+    version = rpmlint_version()
+    if not version:
+        return None
+    config = []
+    for pattern in RPMLINT_CONFIG_FILES:
+        for path in sorted(glob.glob(os.path.expanduser(pattern))):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            config.append([path, st.st_mtime, st.st_size])
+    paths = [arg for arg in args if os.path.isfile(arg)]
+    dirs = sorted(set(os.path.dirname(os.path.abspath(p)) for p in paths))
+    for d in dirs:
+        for pattern in RPMLINTRC_FILES:
+            paths += sorted(glob.glob(os.path.join(d, pattern)))
+    files = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            files.append(f.read())
+    return cache.digest('rpmlint', version, config, list(args), paths,
+                        *files)
+
+
+def get_rpmlint_cache():
+    return cache.FileCache(os.path.join(cfg['HOME_DIR'], 'cache', 'rpmlint'),
+                           max_size=cfg['SPEC_CACHE_MAX_SIZE'],
+                           max_age=cfg['SPEC_CACHE_MAX_AGE'],
+                           enabled=cfg['RPMLINT_CACHE'])
+
+
+def parse_rpmlint_output(out):
+    # return linting hints found in rpmlint output
     hints = []
-    cmd = ['rpmlint']
-    if args:
-        cmd += args
-    try:
-        out = run(*cmd, fatal=False, log_fail=False)
-    except exception.CommandNotFound:
-        raise exception.CommandNotFound(
-            msg="Unable to run rpmlint checks because rpmlint is missing.")
     for line in out.splitlines():
         if line == '':
             continue
-        m = re.match(RE_RPMLINT_HINT, line)
+        m = RE_RPMLINT_HINT_COMPILED.match(line)
         if m:
             hints.append(LintHint(location=m.group(1),
                                   level=m.group(2),
                                   msg=m.group(3)))
             continue
-        try:
-            for rule in RE_RPMLINT_TO_BE_IGNORED:
-                m = re.match(rule, line)
-                if m:
-                    # ignore rpmlint header
-                    raise StopLookingForRELine()
-        except StopLookingForRELine:
+        if RE_RPMLINT_IGNORED.match(line):
+            # ignore rpmlint header
             continue
         hints.append(LintHint(location='rpmlint', level='W', msg=(
             'Failed to parse rpmlint output: %s' % line)))
     return hints
 
 
-def sanity_check_buildarch(txt):
+def rpmlint_check(*args):
+    # run rpmlint and return linting hints it found
+    # results are cached by rpmlint version and checked files contents
+    rpmlint_cache = get_rpmlint_cache()
+    key = None
+    if rpmlint_cache.enabled:
+        key = rpmlint_cache_key(args)
+    out = None
+    if key:
+        out = rpmlint_cache.get(key)
+    if out is None:
+        cmd = ['rpmlint']
+        if args:
+            cmd += args
+        try:
+            out = run(*cmd, fatal=False, log_fail=False)
+        except exception.CommandNotFound:
+            raise exception.CommandNotFound(
+                msg="Unable to run rpmlint checks because rpmlint is "
+                    "missing.")
+        if key and out.return_code in RPMLINT_SUCCESS_CODES:
+            rpmlint_cache.set(key, six.text_type(out))
+    return parse_rpmlint_output(out)
+
+
+class SanityCheck(object):
+    """
+    Base class of rdopkg sanity checks.
+
+    All registered checks are fed by a single traversal of .spec line index
+    (see run_sanity_checks) so a new check doesn't need another pass over
+    the file. Checks implement handlers of events they're interested in:
+
+        on_tag(lineno, tag)
+        on_section(lineno, section)
+        on_magic_comment(lineno, name)
+
+    and return found problems from hints().
+    """
+    def __init__(self, spec_fn):
+        self.spec_fn = spec_fn
+
+    def hints(self):
+        return []
+
+
+SANITY_CHECKS = []
+
+
+def register_sanity_check(check):
+    """
+    Register a SanityCheck subclass (usable as a class decorator).
+    """
+    SANITY_CHECKS.append(check)
+    return check
+
+
+@register_sanity_check
+class BuildArchBeforeSources(SanityCheck):
     # make sure BuildArch is AFTER SourceX and PatchX lines,
     # otherwise %{patches} macro is empty which causes trouble
-    bm = re.search(r'^BuildArch:', txt, flags=re.M)
-    if not bm:
-        return True
-    bi = bm.start()
-    sm = re.search(r'^Source\d+:', txt, flags=re.M)
-    if sm:
-        si = sm.start()
-        if bi < si:
-            return False
-    pm = re.search(r'^Patch\d+:', txt, flags=re.M)
-    if pm:
-        pi = pm.start()
-        if bi < pi:
-            return False
-    return True
+    RE_SOURCE_PATCH = re.compile(r'(Source|Patch)\d+$')
 
+    def __init__(self, spec_fn):
+        super(BuildArchBeforeSources, self).__init__(spec_fn)
+        self.buildarch = False
+        self.seen = set()
+        self.ok = True
 
-def sanity_check_patches_base(txt):
-    # duplicate patches_base might lead to unexpected behavior
-    bases = re.findall(r'^#\s*patches_base', txt, flags=re.M)
-    if len(bases) > 1:
-        return False
-    return True
-
+    def on_tag(self, lineno, tag):
+        if tag == 'BuildArch':
+            self.buildarch = True
+            return
+        m = self.RE_SOURCE_PATCH.match(tag)
+        if m and m.group(1) not in self.seen:
+            # first SourceX or PatchX
+            self.seen.add(m.group(1))
+            if self.buildarch:
+                self.ok = False
 
-def sanity_check(spec_fn):
-    # perform rdopkg sanity checks for common problems
-    hints = []
-    try:
-        txt = open(spec_fn, 'r').read()
-    except Exception as e:
-        hints.append(LintHint(
-            spec_fn, 'E', str(e)))
-        return hints
-    if not sanity_check_buildarch(txt):
-        hints.append(LintHint(spec_fn, 'E', (
+    def hints(self):
+        if self.ok:
+            return []
+        return [LintHint(self.spec_fn, 'E', (
             "buildarch-before-sources: Due to mysterious"
             "ways of rpm, BuildArch needs to be placed "
             "AFTER SourceX and PatchX lines in .spec file, "
             "otherwise %{patches} macro will be empty "
             "and both %autosetup and `git am %{patches}` will fail. "
-            "Please move BuildArch AFTER SourceX and PatchX lines.")))
-    if not sanity_check_patches_base(txt):
-        hints.append(LintHint(spec_fn, 'E', (
+            "Please move BuildArch AFTER SourceX and PatchX lines."))]
+
+
+@register_sanity_check
+class DuplicatePatchesBase(SanityCheck):
+    # duplicate patches_base might lead to unexpected behavior
+    def __init__(self, spec_fn):
+        super(DuplicatePatchesBase, self).__init__(spec_fn)
+        self.n_bases = 0
+
+    def on_magic_comment(self, lineno, name):
+        if name == 'patches_base':
+            self.n_bases += 1
+
+    def hints(self):
+        if self.n_bases <= 1:
+            return []
+        return [LintHint(self.spec_fn, 'E', (
             "duplicate-patches-base: Please make sure to only have one "
-            "# patches_base= entry in .spec file to avoid problems.")))
+            "# patches_base= entry in .spec file to avoid problems."))]
+
+
+SANITY_EVENTS = {
+    # event: SpecIndex attribute providing it
+    'tag': 'tags',
+    'section': 'sections',
+    'magic_comment': 'magic_comments',
+}
+
+
+def run_sanity_checks(index, spec_fn, checks=None):
+    """
+    Run sanity checks over a SpecIndex in a single traversal.
+
+    :param checks: SanityCheck classes to run, all registered by default
+    """
+    if checks is None:
+        checks = SANITY_CHECKS
+    checks = [check(spec_fn) for check in checks]
+    handlers = {}
+    events = []
+    for event, attr in SANITY_EVENTS.items():
+        hs = [getattr(c, 'on_' + event) for c in checks
+              if hasattr(c, 'on_' + event)]
+        if not hs:
+            continue
+        handlers[event] = hs
+        entries = getattr(index, attr)
+        if isinstance(entries, dict):
+            for key, lines in entries.items():
+                events += [(i, event, key) for i in lines]
+        else:
+            events += [(i, event, key) for i, key in entries]
+    events.sort()
+    for lineno, event, key in events:
+        for handler in handlers[event]:
+            handler(lineno, key)
+    hints = []
+    for check in checks:
+        hints += check.hints()
     return hints
 
 
+def _sanity_check_txt(txt, check):
+    from rdopkg.utils import specfile
+    return not run_sanity_checks(specfile.SpecIndex(txt), None, [check])
+
+
+def sanity_check_buildarch(txt):
+    return _sanity_check_txt(txt, BuildArchBeforeSources)
+
+
+def sanity_check_patches_base(txt):
+    return _sanity_check_txt(txt, DuplicatePatchesBase)
+
+
+def sanity_check(spec_fn, spec=None):
+    # perform rdopkg sanity checks for common problems
+    # imported here because specfile uses lint
+    from rdopkg.utils import specfile
+    if spec is not None:
+        index = spec.index
+    else:
+        try:
+            txt = open(spec_fn, 'r').read()
+        except Exception as e:
+            return [LintHint(spec_fn, 'E', str(e))]
+        index = specfile.SpecIndex(txt)
+    return run_sanity_checks(index, spec_fn)
+
+
 LINT_CHECKS = {
     'sanity': sanity_check,
     'rpmlint': rpmlint_check,
 }
 
 
-def lint(spec_fn, checks=None):
+def lint(spec_fn, checks=None, spec=None):
+    # spec: optional specfile.Spec to run sanity checks on without reading
+    # the file again
     if not checks or checks == 'all':
         # use all checks by default
         checks = LINT_CHECKS.keys()
@@ -153,10 +355,28 @@ def lint(spec_fn, checks=None):
             check = LINT_CHECKS[ch]
         except KeyError:
             raise exception.InvalidLintCheck(check=ch)
-        hints += check(spec_fn)
+        if check is sanity_check:
+            hints += check(spec_fn, spec=spec)
+        else:
+            hints += check(spec_fn)
     return hints
 
 
+def lint_many(spec_fns, checks=None):
+    """
+    lint() multiple .spec files in parallel.
+
+    Hints are returned in order of spec_fns.
+    """
+    if len(spec_fns) < 2:
+        return [h for fn in spec_fns for h in lint(fn, checks=checks)]
+    workers = min(RPMLINT_WORKERS, len(spec_fns))
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda fn: lint(fn, checks=checks),
+                                spec_fns))
+    return [h for hints in results for h in hints]
+
+
 def lint_report(hints, error_level=None):
     # print a linting report based on passed hints
     # optionally raise error depending on error_level:
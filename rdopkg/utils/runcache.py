@@ -0,0 +1,120 @@
+"""
+Memoization of pure commands during a single rdopkg run.
+
+Actions ask for the same facts about a repository over and over again
+(current branch, remotes, config, refs, ...) from guess.* functions and
+action steps. Commands run with memoize=True are only run once per
+session and their results are reused until something invalidates them -
+any command which isn't known to be read-only and writes of files which
+might affect command results (Spec.save).
+"""
+import contextlib
+import os
+import threading
+
+
+# environment variables which might affect outputs of memoized commands
+ENV_KEYS = frozenset(['HOME', 'PATH', 'LANG', 'LC_ALL', 'EMAIL', 'USER'])
+ENV_PREFIXES = ('GIT_',)
+
+
+def _env_key(env):
+    if env is None:
+        env = os.environ
+    return tuple(sorted((k, v) for k, v in env.items()
+                        if k in ENV_KEYS or k.startswith(ENV_PREFIXES)))
+
+
+class RunCache(object):
+    """
+    In-memory cache of command results keyed by (argv, cwd, environment).
+
+    Only active inside session() which ActionRunner.engage() opens for
+    the duration of an action.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.listeners = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Memoize commands in the context.
+        """
+        prev_enabled = self.enabled
+        self.enabled = True
+        try:
+            yield
+        finally:
+            self.enabled = prev_enabled
+            if not self.enabled:
+                self.clear()
+
+    def key(self, cmd, env=None):
+        return tuple(cmd), os.getcwd(), _env_key(env)
+
+    def get(self, key):
+        """
+        Return cached (return_code, stdout, stderr) or None.
+        """
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    def set(self, key, return_code, out, err):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.entries[key] = (return_code, out, err)
+
+    def add_listener(self, fun):
+        """
+        Call fun() on every invalidation, even outside of a session.
+
+        Used to drop other caches of repository state such as Git ref and
+        config snapshots when a command which might change it is run.
+        """
+        self.listeners.append(fun)
+
+    def invalidate(self, listeners=True):
+        """
+        Drop all cached results and notify listeners unless disabled.
+        """
+        with self.lock:
+            if self.entries:
+                self.invalidations += 1
+                self.entries.clear()
+        if listeners:
+            for fun in self.listeners:
+                fun()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'entries': len(self.entries),
+        }
+
+    def summary(self):
+        return ('memoized commands: %(hits)d hits, %(misses)d misses, '
+                '%(invalidations)d invalidations' % self.stats())
+
+
+run_cache = RunCache()
@@ -1,13 +1,23 @@
 from __future__ import unicode_literals
 
+import bisect
 import codecs
 from collections import defaultdict
+from concurrent import futures
+import email.errors
+import email.header
+import functools
+import glob
 import os
 import re
+import stat
 import time
 
 from rdopkg import exception
+from rdopkg.conf import cfg
+from rdopkg.utils import cache
 from rdopkg.utils import lint
+from rdopkg.utils.runcache import run_cache
 
 RPM_AVAILABLE = False
 try:
@@ -34,26 +44,28 @@ def split_filename(filename):
     This function replaces rpmUtils.miscutils.splitFilename, see
     https://bugzilla.redhat.com/1452801
     """
-
-    # Remove .rpm suffix
     if filename.endswith('.rpm'):
-        filename = filename.split('.rpm')[0]
-
-    # is there an epoch?
-    components = filename.split(':')
-    if len(components) > 1:
-        epoch = components[0]
-    else:
+        filename = filename[:-4]
+    arch_index = filename.rfind('.')
+    arch = filename[arch_index + 1:]
+    rel_index = filename.rfind('-', 0, arch_index)
+    release = filename[rel_index + 1:arch_index]
+    ver_index = filename.rfind('-', 0, rel_index)
+    version = filename[ver_index + 1:rel_index]
+    epoch_index = filename.find(':')
+    if epoch_index == -1:
         epoch = ''
+    else:
+        epoch = filename[:epoch_index]
+    name = filename[epoch_index + 1:ver_index]
+    return name, version, release, epoch, arch
 
-    # Arch is the last item after .
-    arch = filename.rsplit('.')[-1]
-    remaining = filename.rsplit('.%s' % arch)[0]
-    release = remaining.rsplit('-')[-1]
-    version = remaining.rsplit('-')[-2]
-    name = '-'.join(remaining.rsplit('-')[:-2])
 
-    return name, version, release, epoch, arch
+def split_filenames(filenames):
+    """
+    split_filename() for a whole list of rpm file names (repo listing).
+    """
+    return [split_filename(fn) for fn in filenames]
 
 
 def string_to_version(verstring):
@@ -90,25 +102,132 @@ def spec_fn(spec_dir='.'):
     return specs[0]
 
 
-def get_patches_from_files(patches_dir='.'):
-    patches_fns = [f for f in os.listdir(patches_dir)
-                   if os.path.isfile(f) and f.endswith('.patch')]
-    if not patches_fns:
-        return []
+RE_PATCH_HASH = re.compile(r'From ([a-z0-9]+)')
+RE_MAIL_HEADER = re.compile(r'[\w-]+:')
+PATCH_SCAN_WORKERS = 8
+# (path, mtime, size) -> (hash, subject)
+_patch_headers = {}
+
+
+def read_patch_header(path):
+    """
+    Return (hash, subject) of a git format-patch file.
+
+    Only mail headers are read so size of the patch doesn't matter. Folded
+    and RFC 2047 encoded Subject is decoded. None is returned for missing
+    values.
+    """
+    hash = None
+    subject = None
+    in_subject = False
+    with codecs.open(path, 'r', encoding='utf-8', errors='replace') as fp:
+        for line in fp:
+            line = line.rstrip('\r\n')
+            if in_subject and line[:1] in (' ', '\t'):
+                # folded Subject
+                subject.append(line)
+                continue
+            in_subject = False
+            if not line:
+                # end of headers
+                break
+            if line.startswith('From '):
+                m = RE_PATCH_HASH.match(line)
+                if m and hash is None:
+                    hash = m.group(1)
+            elif RE_MAIL_HEADER.match(line):
+                if subject is None and line[:8].lower() == 'subject:':
+                    subject = [line[8:]]
+                    in_subject = True
+            elif line[:1] not in (' ', '\t'):
+                # not a mail header
+                break
+    if subject is not None:
+        subject = ''.join(subject)
+        if '=?' in subject:
+            try:
+                subject = str(email.header.make_header(
+                    email.header.decode_header(subject)))
+            except (email.errors.HeaderParseError, LookupError,
+                    UnicodeDecodeError):
+                pass
+        subject = subject.strip()
+    return hash, subject
+
+
+def get_patches_cache(enabled=None):
+    """
+    Return cache of patch headers read by get_patches_from_files().
+    """
+    if enabled is None:
+        enabled = cfg['SPEC_CACHE']
+    return cache.FileCache(os.path.join(cfg['HOME_DIR'], 'cache', 'patches'),
+                           max_size=cfg['SPEC_CACHE_MAX_SIZE'],
+                           max_age=cfg['SPEC_CACHE_MAX_AGE'],
+                           enabled=enabled)
+
+
+def patches_cache_key(patches_dir):
+    return cache.digest('patches', os.path.realpath(patches_dir))
+
+
+def get_patches_from_files(patches_dir='.', cache=None):
+    """
+    Return a list of (file name, hash, subject) of *.patch files.
+
+    Patch headers are read in parallel and cached by (path, mtime, size) in
+    memory and in HOME_DIR/cache/patches.
+
+    :param cache: use on-disk cache, cfg['SPEC_CACHE'] if not provided
+    """
     patches = []
-    for pfn in patches_fns:
-        with codecs.open(pfn, 'r', encoding='utf-8') as fp:
-            txt = fp.read()
-        hash = None
-        m = re.search(r'^From ([a-z0-9]+)', txt, flags=re.M)
-        if m:
-            hash = m.group(1)
-        subj = None
-        m = re.search(r'^Subject:\w*(.+)$', txt, flags=re.M)
-        if m:
-            subj = m.group(1)
-        patches.append((pfn, hash, subj))
-    return patches
+    for fn in os.listdir(patches_dir):
+        if not fn.endswith('.patch'):
+            continue
+        path = os.path.join(patches_dir, fn)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        patches.append((fn, path, st.st_mtime, st.st_size))
+    if not patches:
+        return []
+
+    disk_cache = get_patches_cache(enabled=cache)
+    key = patches_cache_key(patches_dir)
+    cached = disk_cache.get(key) or {}
+    headers = {}
+    missing = []
+    for fn, path, mtime, size in patches:
+        header = _patch_headers.get((path, mtime, size))
+        if header is None:
+            c = cached.get(fn)
+            if c and c[0] == mtime and c[1] == size:
+                header = tuple(c[2:])
+        if header is None:
+            missing.append((fn, path, mtime, size))
+        else:
+            headers[fn] = header
+
+    if missing:
+        paths = [m[1] for m in missing]
+        if len(paths) > 1:
+            workers = min(PATCH_SCAN_WORKERS, len(paths))
+            with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(read_patch_header, paths))
+        else:
+            results = [read_patch_header(paths[0])]
+        for (fn, path, mtime, size), header in zip(missing, results):
+            _patch_headers[(path, mtime, size)] = header
+            headers[fn] = header
+
+    new_cached = dict((fn, [mtime, size] + list(headers[fn]))
+                      for fn, _, mtime, size in patches)
+    if new_cached != cached:
+        disk_cache.set(key, new_cached)
+    return [(fn,) + headers[fn] for fn, _, _, _ in patches]
 
 
 def version_parts(version):
@@ -155,25 +274,742 @@ def has_macros(s):
     return False
 
 
+# segments of a version string compared by rpmvercmp
+RE_VERSION_SEGMENT = re.compile(r'[A-Za-z]+|[0-9]+|~|\^')
+# sort keys of version segments and the end of a version string:
+# ~ < end < ^ < alpha < numeric
+_KEY_TILDE = (0,)
+_KEY_END = (1,)
+_KEY_CARET = (2,)
+
+
+@functools.lru_cache(maxsize=8192)
+def version_key(version):
+    """
+    Return a sort key of a version string so that comparing keys gives
+    the same result as rpmvercmp comparing the versions.
+
+    Usage: sorted(versions, key=version_key)
+    """
+    key = []
+    for seg in RE_VERSION_SEGMENT.findall(version or ''):
+        if seg == '~':
+            key.append(_KEY_TILDE)
+        elif seg == '^':
+            key.append(_KEY_CARET)
+        elif seg[0].isdigit():
+            key.append((4, int(seg)))
+        else:
+            key.append((3, seg))
+    key.append(_KEY_END)
+    return tuple(key)
+
+
+def rpmvercmp(v1, v2):
+    """
+    Compare two version strings like rpm does, return -1, 0 or 1.
+    """
+    if v1 == v2:
+        return 0
+    k1 = version_key(v1)
+    k2 = version_key(v2)
+    return (k1 > k2) - (k1 < k2)
+
+
+def evr_key(epoch, version, release):
+    """
+    Return a sort key of (epoch, version, release) with missing epoch
+    being equal to 0 like rpm.labelCompare does.
+    """
+    return (version_key(epoch or '0'),
+            version_key(version),
+            version_key(release))
+
+
+def label_compare(evr1, evr2):
+    """
+    Compare two (epoch, version, release) tuples, return -1, 0 or 1.
+    """
+    k1 = evr_key(*evr1)
+    k2 = evr_key(*evr2)
+    return (k1 > k2) - (k1 < k2)
+
+
+def split_nvr(nvr):
+    """
+    Split [N-][E:]V[-R] string into (name, epoch, version, release).
+
+    Missing parts are returned as ''.
+    """
+    parts = nvr.rsplit('-', 2)
+    if len(parts) == 3:
+        name, version, release = parts
+    elif len(parts) == 2:
+        name = ''
+        version, release = parts
+    else:
+        name, release = '', ''
+        version = parts[0]
+    epoch = ''
+    if ':' in version:
+        epoch, _, version = version.partition(':')
+    elif ':' in name:
+        # E:N-V-R
+        epoch, _, name = name.partition(':')
+    return name, epoch, version, release
+
+
+def nvr_key(nvr):
+    """
+    Return a sort key of [N-][E:]V[-R] string by its EVR.
+
+    Usage: sorted(nvrs, key=nvr_key)
+    """
+    _, e, v, r = split_nvr(nvr)
+    return evr_key(e, v, r)
+
+
 def nvrcmp(nvr1, nvr2):
-    if not RPM_AVAILABLE:
-        raise exception.RpmModuleNotAvailable()
-    t1 = string_to_version(nvr1)
-    t2 = string_to_version(nvr2)
-    return rpm.labelCompare(t1, t2)
+    k1 = nvr_key(nvr1)
+    k2 = nvr_key(nvr2)
+    return (k1 > k2) - (k1 < k2)
 
 
 def vcmp(v1, v2):
-    if not RPM_AVAILABLE:
-        raise exception.RpmModuleNotAvailable()
-    t1 = ('0', v1, '')
-    t2 = ('0', v2, '')
-    return rpm.labelCompare(t1, t2)
+    return rpmvercmp(v1, v2)
 
 
 def nvr2version(nvr):
-    _, v, _, _, _ = split_filename(nvr)
-    return v
+    return split_nvr(nvr)[2]
+
+
+DEPENDENCY_TAGS = ('requires', 'provides', 'conflicts', 'obsoletes')
+
+
+# global rpm macros affecting results of .spec parsing
+RPM_MACRO_STATE_PROBE = ('%{?dist}|%{?_arch}|%{?_vendor}|%{?fedora}|%{?rhel}'
+                         '|%{?centos}|%{?python3_pkgversion}')
+# macro files loaded by rpm (its default macrofiles) used when rpm doesn't
+# define %_macropath
+RPM_MACRO_FILES = ('%{_rpmconfigdir}/macros:'
+                   '%{_rpmconfigdir}/macros.d/macros.*:'
+                   '%{_rpmconfigdir}/platform/%{_target}/macros:'
+                   '%{_rpmconfigdir}/fileattrs/*.attr:'
+                   '%{_rpmconfigdir}/redhat/macros:'
+                   '/etc/rpm/macros.*:/etc/rpm/macros:'
+                   '/etc/rpm/%{_target}/macros:'
+                   '~/.config/rpm/macros:~/.rpmmacros')
+# .spec files including other files aren't cached
+RE_SPEC_INCLUDE = re.compile(br'^\s*%include\b|%\{?load\b', flags=re.M)
+_rpm_macro_state = None
+
+
+def rpm_macro_files_state():
+    """
+    Return [(path, mtime, size)] of rpm macro files.
+    """
+    paths = rpm.expandMacro('%{?_macropath}') or rpm.expandMacro(
+        RPM_MACRO_FILES)
+    state = []
+    for pattern in paths.split(':'):
+        for path in sorted(glob.glob(os.path.expanduser(pattern))):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            state.append((path, st.st_mtime, st.st_size))
+    return state
+
+
+def rpm_macro_state():
+    """
+    Return state of rpm relevant for .spec parsing for use in cache keys.
+
+    It covers rpm version, values of common macros and all macro files so
+    that changes of system macros (like %bcond defaults or python version)
+    aren't hidden by cached results.
+    """
+    global _rpm_macro_state
+    if not RPM_AVAILABLE:
+        return None
+    if _rpm_macro_state is None:
+        _rpm_macro_state = [rpm.__version__,
+                            rpm.expandMacro(RPM_MACRO_STATE_PROBE),
+                            rpm_macro_files_state()]
+    return _rpm_macro_state
+
+
+def get_spec_cache(enabled=None):
+    """
+    Return cache of .spec data parsed by rpm.
+    """
+    if enabled is None:
+        enabled = cfg['SPEC_CACHE']
+    return cache.FileCache(os.path.join(cfg['HOME_DIR'], 'cache', 'spec'),
+                           max_size=cfg['SPEC_CACHE_MAX_SIZE'],
+                           max_age=cfg['SPEC_CACHE_MAX_AGE'],
+                           enabled=enabled)
+
+
+class SpecIndex(object):
+    """
+    Line index of .spec file text built in a single pass.
+
+    Line numbers of preamble tags, %global/%define macros, magic comments,
+    SourceN/PatchN lines, sections and %if conditionals are recorded so that
+    Spec lookups don't need to scan the whole text over and over again.
+
+    The index also serves as an edit buffer: lines can be replaced, inserted
+    and deleted in place while the index is kept up to date and the text is
+    only joined back together when it's requested.
+    """
+
+    RE_TAG = re.compile(r'([A-Za-z][\w()-]*):')
+    RE_SOURCE = re.compile(r'Source\d*$')
+    RE_PATCH = re.compile(r'\s*Patch\d+:')
+    RE_MACRO = re.compile(r'%(global|define)\s+(\w+)')
+    RE_MAGIC_COMMENT = re.compile(r'#\s*(.+?)\s?=(\s?)(\S*)')
+    RE_SECTION = re.compile(
+        r'%(package|description|prep|build|install|check|clean|files'
+        r'|changelog|pre|post|preun|postun|pretrans|posttrans'
+        r'|verifyscript|trigger\w*|filetrigger\w*|transfiletrigger\w*'
+        r'|generate_buildrequires|conf)(?:\s|$)', flags=re.I)
+
+    def __init__(self, txt=None, lines=None):
+        if lines is None:
+            lines = txt.split('\n')
+        self._txt = txt
+        self.lines = lines
+        # True when lines were edited since the text was last synchronized
+        self.modified = txt is None
+        self.build()
+
+    @property
+    def txt(self):
+        """ Text of indexed lines, joined only when needed. """
+        if self._txt is None:
+            self._txt = '\n'.join(self.lines)
+        return self._txt
+
+    def classify(self, line):
+        """Return a tuple of (attribute, key) index entries for a line."""
+        if not line:
+            return ()
+        c = line[0]
+        if c == '#':
+            m = self.RE_MAGIC_COMMENT.match(line)
+            if m:
+                return (('magic_comments', m.group(1)),)
+            return ()
+        if c == '%':
+            # key of a conditional is its effect on %if nesting depth
+            if line.startswith('%if'):
+                return (('conditionals', 1),)
+            if line.startswith('%endif'):
+                return (('conditionals', -1),)
+            if line.startswith('%el'):
+                return (('conditionals', 0),)
+            m = self.RE_MACRO.match(line)
+            if m:
+                return (('macros', m.group(2)),)
+            m = self.RE_SECTION.match(line)
+            if m:
+                return (('sections', m.group(1).lower()),)
+            return ()
+        entries = []
+        m = self.RE_TAG.match(line)
+        if m:
+            tag = m.group(1)
+            entries.append(('tags', tag))
+            if self.RE_SOURCE.match(tag):
+                entries.append(('sources', None))
+        if self.RE_PATCH.match(line):
+            entries.append(('patches', None))
+        return tuple(entries)
+
+    def build(self):
+        # tag name -> [line numbers]
+        self.tags = defaultdict(list)
+        # macro name -> [line numbers]
+        self.macros = defaultdict(list)
+        # magic comment name -> [line numbers]
+        self.magic_comments = defaultdict(list)
+        self.sources = []
+        self.patches = []
+        # [(line number, lowercase section name)]
+        self.sections = []
+        self.conditionals = []
+        # %if nesting depth before each line
+        self.depth = []
+        depth = 0
+        for i, line in enumerate(self.lines):
+            self.depth.append(depth)
+            for attr, key in self.classify(line):
+                self._add_entry(i, attr, key)
+                if attr == 'conditionals':
+                    depth += key
+        self.end_depth = depth
+
+    def _add_entry(self, i, attr, key):
+        if attr == 'sections':
+            bisect.insort(self.sections, (i, key))
+        elif attr in ('sources', 'patches', 'conditionals'):
+            bisect.insort(getattr(self, attr), i)
+        else:
+            bisect.insort(getattr(self, attr)[key], i)
+
+    def _remove_entry(self, i, attr, key):
+        if attr == 'sections':
+            self.sections.remove((i, key))
+        elif attr in ('sources', 'patches', 'conditionals'):
+            getattr(self, attr).remove(i)
+        else:
+            d = getattr(self, attr)
+            d[key].remove(i)
+            if not d[key]:
+                del d[key]
+
+    def _shift(self, start, delta):
+        """Shift indexed line numbers >= start by delta."""
+        def shift(ns):
+            return [n + delta if n >= start else n for n in ns]
+
+        for d in (self.tags, self.macros, self.magic_comments):
+            for key in d:
+                d[key] = shift(d[key])
+        self.sources = shift(self.sources)
+        self.patches = shift(self.patches)
+        self.conditionals = shift(self.conditionals)
+        self.sections = [(n + delta if n >= start else n, s)
+                         for n, s in self.sections]
+
+    def replace_line(self, i, line):
+        old_entries = self.classify(self.lines[i])
+        self.lines[i] = line
+        self._txt = None
+        self.modified = True
+        new_entries = self.classify(line)
+        if new_entries == old_entries:
+            return
+        if any(attr == 'conditionals'
+               for attr, _ in old_entries + new_entries):
+            self.build()
+            return
+        for attr, key in old_entries:
+            self._remove_entry(i, attr, key)
+        for attr, key in new_entries:
+            self._add_entry(i, attr, key)
+
+    def insert_lines(self, i, lines):
+        """Insert lines before line number i."""
+        self.lines[i:i] = lines
+        self._txt = None
+        self.modified = True
+        if any(line.startswith('%') for line in lines):
+            # sections and conditionals change the structure, start over
+            self.build()
+            return
+        if i < len(self.depth):
+            depth = self.depth[i]
+        else:
+            depth = self.end_depth
+        self.depth[i:i] = [depth] * len(lines)
+        self._shift(i, len(lines))
+        for n, line in enumerate(lines, start=i):
+            for attr, key in self.classify(line):
+                self._add_entry(n, attr, key)
+
+    def splice(self, i, j, lines):
+        """Replace lines i to j (exclusive) with lines."""
+        old = self.lines[i:j]
+        # only touch lines which actually changed
+        while old and lines and old[-1] == lines[-1]:
+            old, lines = old[:-1], lines[:-1]
+        while old and lines and old[0] == lines[0]:
+            old, lines = old[1:], lines[1:]
+            i += 1
+        for n, line in enumerate(lines[:len(old)]):
+            self.replace_line(i + n, line)
+        if len(lines) > len(old):
+            self.insert_lines(i + len(old), lines[len(old):])
+        for _ in range(len(old) - len(lines)):
+            self.delete_line(i + len(lines))
+
+    def delete_line(self, i):
+        line = self.lines.pop(i)
+        self._txt = None
+        self.modified = True
+        if line.startswith('%'):
+            self.build()
+            return
+        for attr, key in self.classify(line):
+            self._remove_entry(i, attr, key)
+        del self.depth[i]
+        self._shift(i + 1, -1)
+
+    def window_end(self, i, n=1):
+        """
+        Return number of the line after the n-th line following line i with
+        non-whitespace content.
+        """
+        j = i + 1
+        while j < len(self.lines) and n > 0:
+            if self.lines[j].strip():
+                n -= 1
+            j += 1
+        return j
+
+    def window(self, i, n=1):
+        """
+        Return text starting at line i with enough of following lines for
+        regexes with \\s which can match across lines.
+        """
+        j = self.window_end(i, n)
+        txt = '\n'.join(self.lines[i:j])
+        if j < len(self.lines):
+            txt += '\n'
+        return txt
+
+    def get_tag(self, tag):
+        """Return value of first `tag: value` line or None."""
+        n = len(tag) + 1
+        for i in self.tags.get(tag, []):
+            line = self.lines[i]
+            if not line[n:].strip():
+                line = self.window(i)
+            m = re.match(r'\s+(\S.*)$', line[n:], flags=re.M)
+            if m:
+                return m.group(1).rstrip()
+        return None
+
+    def get_tag_align_ws(self, tag):
+        n = len(tag) + 1
+        for i in self.tags.get(tag, []):
+            line = self.lines[i]
+            if not line[n:].strip():
+                line = self.window(i)
+            return re.match(r'\s*', line[n:]).group(0)
+        return None
+
+    def get_magic_comment(self, name):
+        """Return value of first `# name=value` comment line or None."""
+        for i in self.magic_comments.get(name, []):
+            line = self.lines[i]
+            m = self.RE_MAGIC_COMMENT.match(line)
+            if m.group(3):
+                return m.group(3)
+            if not m.group(2) and m.end() == len(line):
+                # value on the following line, just like ^#\s*name\s?=\s?\S+
+                try:
+                    m = re.match(r'\S+', self.lines[i + 1])
+                except IndexError:
+                    continue
+                if m:
+                    return m.group(0)
+        return None
+
+    def get_global_macro(self, macro):
+        """Return raw value of first `%global macro value` line or None."""
+        rex = r'%%global\s+%s\s+(.*)$' % re.escape(macro)
+        for i in self.macros.get(macro, []):
+            line = self.lines[i]
+            if re.match(r'%%global\s+%s\s*$' % re.escape(macro), line):
+                line = self.window(i)
+            m = re.match(rex, line, flags=re.M)
+            if m:
+                return m.group(1)
+        return None
+
+    def get_patch_fns(self):
+        fns = []
+        for i in self.patches:
+            m = re.match(r'\s*Patch\d+:\s*(\S+)\s*$', self.lines[i])
+            if m:
+                fns.append(m.group(1))
+        return fns
+
+    def get_n_patches(self):
+        return len([i for i in self.patches if self.lines[i][0] == 'P'])
+
+    def get_section_lines(self, section):
+        return [i for i, s in self.sections if s == section]
+
+    def get_tag_lines(self, tag, start=0, end=None):
+        """Return numbers of `tag:` lines between start and end inclusive."""
+        lines = self.tags.get(tag, [])
+        lo = bisect.bisect_left(lines, start)
+        if end is None:
+            return lines[lo:]
+        return lines[lo:bisect.bisect_right(lines, end)]
+
+    def get_package_spans(self):
+        """
+        Return [(line number, %package arguments, end)] for subpackages
+        where end is the line number of following %description.
+
+        When there is no following %description, end is carried over from
+        previous subpackage ('' for the first one).
+        """
+        spans = []
+        descriptions = self.get_section_lines('description')
+        end = ''
+        for i in self.get_section_lines('package'):
+            m = re.match(r'%package\s+(.*)', self.lines[i])
+            if not m:
+                continue
+            n = bisect.bisect_left(descriptions, i)
+            if n < len(descriptions):
+                end = descriptions[n]
+            spans.append((i, m.group(1), end))
+        return spans
+
+    def get_changelog(self):
+        """Return text following %changelog line or None if missing."""
+        starts = [i for i, s in self.sections
+                  if s == 'changelog' and self.lines[i].lower() == '%changelog'
+                  and i + 1 < len(self.lines)]
+        if len(starts) > 1:
+            raise exception.MultipleChangelog()
+        if not starts:
+            return None
+        return '\n'.join(self.lines[starts[0] + 1:])
+
+
+class SpecMacros(object):
+    """
+    Pure python expander of macros defined in .spec file.
+
+    Common %global/%define macros and macros defined by main package
+    preamble tags such as %{name}, %{version}, %{epoch} or %{url} are
+    expanded without rpm including conditional expansions like %{?macro},
+    %{?macro:text} and %{!?macro:text}.
+
+    Macros not defined in .spec file are looked up in global rpm context if
+    rpm module is available. Without rpm, such macros are considered
+    undefined in conditional expansions.
+
+    exception.UnsupportedMacro is raised for constructs which require rpm
+    such as shell and lua expansions, parametric macros and built-in macros
+    or macros defined conditionally.
+    """
+
+    RE_DEFINITION = re.compile(
+        r'%(global|define)\s+(\w+)(\()?\s*(.*?)\s*$')
+    # %{!?macro: %global macro value} sets a default value
+    RE_DEFAULT_DEFINITION = re.compile(
+        r'%\{!\?(\w+):\s*%(global|define)\s+(\w+)\s+(.*?)\s*\}\s*$')
+    # macro definitions not at the start of a line and %undefine
+    RE_IRREGULAR = re.compile(
+        r'^(?!%(?:global|define)\s).*%\{?(?:global|define)\b|%\{?undefine\b',
+        flags=re.M)
+    RE_NAME = re.compile(r'[A-Za-z_]\w*')
+    # macros rpm defines for preamble tags (lowercase tag names)
+    PREAMBLE_MACROS = frozenset([
+        'bugurl', 'distribution', 'disturl', 'epoch', 'group', 'license',
+        'modularitylabel', 'name', 'packager', 'release', 'summary', 'url',
+        'vcs', 'vendor', 'version',
+    ])
+    # %{SOURCE0}, %{PATCH1}, ... defined by rpm from Source/Patch tags
+    RE_SOURCE_MACRO = re.compile(r'(SOURCE|PATCH)\d*$')
+    BUILTINS = {
+        'nil': '',
+    }
+    MAX_DEPTH = 64
+
+    def __init__(self, index):
+        self.index = index
+        # macro name -> [(line number, raw value, eager)]
+        self._defaults = None
+        self._depth = 0
+
+    def unsupported(self, macro):
+        raise exception.UnsupportedMacro(macro=macro)
+
+    def definition(self, name):
+        """
+        Return (line number, raw value, eager) of .spec macro definition,
+        None when not defined by .spec file.
+
+        eager is True when the value is expanded where it's defined (%global
+        and tags) as opposed to where it's used (%define).
+        """
+        index = self.index
+        if self._defaults is None:
+            self._scan()
+        changelog = index.get_section_lines('changelog')
+        if changelog:
+            changelog = changelog[0]
+        else:
+            changelog = len(index.lines)
+        defs = [i for i in index.macros.get(name, []) if i < changelog]
+        if self.RE_SOURCE_MACRO.match(name):
+            self.unsupported(name)
+        # rpm tags are case insensitive
+        tags = {i: tag for tag, lines in index.tags.items()
+                if tag.lower() == name for i in lines}
+        if tags:
+            if name not in self.PREAMBLE_MACROS:
+                # tag might define a macro unknown to us
+                self.unsupported(name)
+            defs += sorted(tags)
+        defaults = self._defaults.get(name)
+        if defaults:
+            if not defs:
+                return defaults[0]
+            if defs[-1] > defaults[0][0]:
+                self.unsupported(name)
+            # default isn't used when already defined
+        if not defs:
+            return None
+        if len(defs) > 1:
+            self.unsupported(name)
+        i = defs[0]
+        if index.depth[i]:
+            # defined conditionally
+            self.unsupported(name)
+        if i in tags:
+            value = index.get_tag(tags[i])
+            if value is None:
+                self.unsupported(name)
+            return i, value, True
+        m = self.RE_DEFINITION.match(index.lines[i])
+        if not m or m.group(3) or not m.group(4) or m.group(4)[-1] == '\\':
+            # parametric or multi-line macro
+            self.unsupported(name)
+        return i, m.group(4), m.group(1) == 'global'
+
+    def _scan(self):
+        """
+        Find %{!?macro: %global macro value} default definitions and make
+        sure there are no other definitions outside of the index.
+        """
+        index = self.index
+        txt = index.txt
+        self._defaults = defaultdict(list)
+        for m in self.RE_IRREGULAR.finditer(txt):
+            i = txt.count('\n', 0, m.start())
+            d = self.RE_DEFAULT_DEFINITION.match(index.lines[i])
+            if (m.start() and txt[m.start() - 1] != '\n'
+                    or not d or d.group(1) != d.group(3) or index.depth[i]):
+                self._defaults = None
+                self.unsupported(m.group(0))
+            self._defaults[d.group(1)].append(
+                (i, d.group(4), d.group(2) == 'global'))
+
+    def lookup(self, name, before=None):
+        """
+        Return expanded value of a macro or None when it's not defined.
+
+        :param before: only definitions before this line are visible
+        """
+        if name in self.BUILTINS:
+            return self.BUILTINS[name]
+        d = self.definition(name)
+        if d:
+            i, value, eager = d
+            if before is not None and i >= before:
+                # not defined yet
+                return None
+            if eager:
+                # expanded where defined and again where used
+                value = self.expand(value, before=i)
+            return self.expand(value, before=before)
+        if name in self.PREAMBLE_MACROS:
+            # tag isn't set so rpm doesn't define the macro
+            return None
+        if RPM_AVAILABLE:
+            if rpm.expandMacro('%{?' + name + ':1}') != '1':
+                return None
+            return rpm.expandMacro('%{' + name + '}')
+        return None
+
+    def expand(self, s, before=None):
+        """
+        Return string s with macros expanded.
+        """
+        self._depth += 1
+        try:
+            if self._depth > self.MAX_DEPTH:
+                self.unsupported(s)
+            return self._expand(s, before)
+        finally:
+            self._depth -= 1
+
+    def _expand(self, s, before):
+        out = []
+        i = 0
+        n = len(s)
+        while i < n:
+            j = s.find('%', i)
+            if j < 0 or j == n - 1:
+                out.append(s[i:])
+                break
+            out.append(s[i:j])
+            c = s[j + 1]
+            if c == '%':
+                out.append('%')
+                i = j + 2
+            elif c == '{':
+                end = self._closing_brace(s, j + 2)
+                out.append(self._expand_body(s[j + 2:end], s[j:end + 1],
+                                             before))
+                i = end + 1
+            elif c in '?!':
+                m = re.match(r'(!?\??!?)([A-Za-z_]\w*)', s[j + 1:])
+                if not m or '?' not in m.group(1):
+                    self.unsupported(s[j:])
+                out.append(self._expand_body(m.group(0), s[j:j + 1 + m.end()],
+                                             before))
+                i = j + 1 + m.end()
+            else:
+                m = self.RE_NAME.match(s, j + 1)
+                if not m:
+                    # %(shell), %[expression], ...
+                    self.unsupported(s[j:])
+                out.append(self._expand_body(m.group(0), s[j:m.end()],
+                                             before))
+                i = m.end()
+        return ''.join(out)
+
+    def _closing_brace(self, s, i):
+        level = 1
+        while i < len(s):
+            c = s[i]
+            if c == '{':
+                level += 1
+            elif c == '}':
+                level -= 1
+                if not level:
+                    return i
+            i += 1
+        self.unsupported(s)
+
+    def _expand_body(self, body, macro, before):
+        m = re.match(r'(!?\??!?)([A-Za-z_]\w*)(?::(.*))?$', body, flags=re.S)
+        if not m:
+            # arguments, built-ins like %{lua:...}, ...
+            self.unsupported(macro)
+        flags, name, text = m.groups()
+        if '?' not in flags:
+            if flags or text is not None:
+                self.unsupported(macro)
+            value = self.lookup(name, before=before)
+            if value is None:
+                if not RPM_AVAILABLE and not self.definition(name):
+                    # might be defined by system rpm macros
+                    self.unsupported(macro)
+                # rpm leaves undefined macros as they are
+                return macro
+            return value
+        value = self.lookup(name, before=before)
+        defined = value is not None
+        if '!' in flags:
+            defined = not defined
+        if not defined:
+            return ''
+        if text is None:
+            return '' if '!' in flags else value
+        return self.expand(text, before=before)
 
 
 class Spec(object):
@@ -189,8 +1025,11 @@ class Spec(object):
     RE_IN_MAGIC_COMMENTS = (
         r'((?:^|\n)(?:#[ \t]*\n)+)(#\s*[^0-9\n]*\s*=[^\n]*\n)')
     RE_MACRO_BASE = r'%global\s+{0}\s+'
+    # DNEVR string of a versioned dependency: 'R name >= version'
+    RE_DEPENDENCY = re.compile(r'\w\s(\S+)\s+([=<>!]+)\s*(\S+)')
+    RE_PY23 = re.compile(r'^python[23]-')
 
-    def __init__(self, fn=None, txt=None):
+    def __init__(self, fn=None, txt=None, cache=None):
         """
         Spec file reader/writer/parser.
 
@@ -202,11 +1041,23 @@ class Spec(object):
         :param txt: The textual contents of a .spec file. If not provided, we
                     will read the contents from disk.
         :type  txt: ``str``
+
+        :param cache: Use on-disk cache of data parsed by rpm. If not
+                      provided, cfg['SPEC_CACHE'] is used.
+        :type  cache: ``bool``
         """
         self._fn = fn
         self._txt = txt
+        self._cache = cache
         self._rpmspec = None
+        self._rpmdata = None
+        self._rpmdata_key = None
+        # macros changed in rpm by set_macro()
+        self._rpm_macros = {}
+        self._index = None
         self._contains_subpkg = None
+        # dependency table parsed from rpmdata
+        self._dependencies = None
 
     @property
     def fn(self):
@@ -218,11 +1069,68 @@ class Spec(object):
     @property
     def txt(self):
         """ The textual contents of this .spec file. """
-        if not self._txt:
+        if self._index is not None and self._index.modified:
+            # apply pending line edits
+            self._txt = self._index.txt
+            self._index.modified = False
+        elif not self._txt:
             with codecs.open(self.fn, 'r', encoding='utf-8') as fp:
                 self._txt = fp.read()
         return self._txt
 
+    @property
+    def index(self):
+        """ Line index of this .spec file, rebuilt when the text changes. """
+        index = self._index
+        if index is None or (not index.modified and index.txt is not self.txt):
+            self._index = SpecIndex(self.txt)
+        return self._index
+
+    def _sub_lines(self, pattern, repl, line_numbers, flags=re.M,
+                   skip_adjacent=False):
+        """
+        Substitute pattern matches starting at the beginning of selected
+        lines just like re.subn('^' + pattern, repl, self.txt, flags=re.M)
+        would but without rewriting the whole text.
+
+        Only a few following lines are considered for each match which is
+        enough for patterns used here even when \\s matches across lines.
+
+        With skip_adjacent, a match can't start right after previous one
+        which emulates patterns starting with (^|\\n).
+
+        Return number of substitutions.
+        """
+        index = self.index
+        rex = re.compile(pattern, flags)
+        n = 0
+        # lines are renumbered by substitutions changing number of lines
+        shift = 0
+        allowed = 0
+        for i in sorted(line_numbers):
+            if i < allowed:
+                continue
+            start = i + shift
+            end = index.window_end(start, 3)
+            txt = '\n'.join(index.lines[start:end])
+            if end < len(index.lines):
+                txt += '\n'
+            m = rex.match(txt)
+            if not m:
+                continue
+            new = m.expand(repl) + txt[m.end():]
+            new_lines = new.split('\n')
+            if end < len(index.lines):
+                new_lines.pop()
+            consumed = txt.count('\n', 0, m.end())
+            allowed = i + consumed
+            if skip_adjacent or (m.end() and txt[m.end() - 1] != '\n'):
+                allowed += 1
+            index.splice(start, end, new_lines)
+            shift += len(new_lines) - (end - start)
+            n += 1
+        return n
+
     def load_rpmspec(self):
         if not RPM_AVAILABLE:
             raise exception.RpmModuleNotAvailable()
@@ -240,48 +1148,117 @@ class Spec(object):
             self.load_rpmspec()
         return self._rpmspec
 
+    @property
+    def rpm_cache(self):
+        return get_spec_cache(enabled=self._cache)
+
+    def rpm_cache_key(self):
+        """
+        Return a cache key of data parsed by rpm from this .spec file or None
+        when the .spec file can't be read.
+
+        The key covers .spec file contents on disk (that's what rpm parses),
+        its location and the state of rpm macros. .spec files which %include
+        or %load other files aren't cached (None is returned).
+        """
+        try:
+            with open(self.fn, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        if RE_SPEC_INCLUDE.search(data):
+            return None
+        return cache.digest(data,
+                            os.path.dirname(os.path.realpath(self.fn)),
+                            rpm_macro_state(),
+                            sorted(self._rpm_macros.items()))
+
+    @property
+    def rpmdata(self):
+        """
+        Data parsed by rpm from this .spec file, loaded from cache if
+        available and filled in as needed.
+        """
+        if self._rpmdata is None:
+            key = self.rpm_cache_key()
+            data = None
+            if key:
+                data = self.rpm_cache.get(key)
+            self._rpmdata_key = key
+            self._rpmdata = data or {}
+        return self._rpmdata
+
+    def get_rpmdata(self, name, parse):
+        """
+        Return rpmdata[name] calling parse() to get it on cache miss.
+        """
+        data = self.rpmdata
+        if name not in data:
+            data[name] = parse()
+            self.save_rpmdata()
+        return data[name]
+
+    def save_rpmdata(self):
+        if self._rpmdata_key:
+            self.rpm_cache.set(self._rpmdata_key, self._rpmdata)
+
     def expand_macro(self, macro):
+        """
+        Expand macros in a string.
+
+        Pure python SpecMacros expander is used if possible so that the
+        .spec file doesn't need to be parsed by rpm.
+        """
+        try:
+            return SpecMacros(self.index).expand(macro)
+        except exception.UnsupportedMacro:
+            pass
+        return self.expand_macro_rpm(macro)
+
+    def expand_macro_rpm(self, macro):
+        macros = self.rpmdata.setdefault('macros', {})
+        if macro in macros:
+            return macros[macro]
         if not self._rpmspec:
             self.load_rpmspec()
         if not RPM_AVAILABLE:
             raise exception.RpmModuleNotAvailable()
-        return rpm.expandMacro(macro)
+        value = rpm.expandMacro(macro)
+        macros[macro] = value
+        self.save_rpmdata()
+        return value
 
     def get_tag(self, tag, default=exception.SpecFileParseError,
                 expand_macros=False):
-        m = re.search(r'^%s:\s+(\S.*)$' % tag, self.txt, re.M)
-        if not m:
+        value = self.index.get_tag(tag)
+        if value is None:
             if default != exception.SpecFileParseError:
                 return default
             raise exception.SpecFileParseError(spec_fn=self.fn,
                                                error="%s tag not found" % tag)
-        tag = m.group(1).rstrip()
+        tag = value
         if expand_macros and has_macros(tag):
             # don't parse using rpm unless required
             tag = self.expand_macro(tag)
         return tag
 
     def set_tag(self, tag, value):
-        self._txt, n = re.subn(r'^(%s:\s+).*$' % re.escape(tag),
-                               r'\g<1>%s' % value, self.txt, flags=re.M)
+        n = self._sub_lines(r'(%s:\s+).*$' % re.escape(tag),
+                            r'\g<1>%s' % value,
+                            self.index.tags.get(tag, []))
         return n > 0
 
     def get_tag_align_ws(self, tag):
-        if not tag.endswith(':'):
-            tag += ':'
-        m = re.search(r'^%s(\s*)' % re.escape(tag), self.txt, flags=re.M)
-        if not m:
-            return ''
-        return m.group(1)
+        if tag.endswith(':'):
+            tag = tag[:-1]
+        return self.index.get_tag_align_ws(tag) or ''
 
     def get_magic_comment(self, name, expand_macros=False):
         """Return a value of # name=value comment in spec or None."""
-        match = re.search(r'^#\s*?%s\s?=\s?(\S+)' % re.escape(name),
-                          self.txt, flags=re.M)
-        if not match:
+        val = self.index.get_magic_comment(name)
+        if val is None:
             return None
 
-        val = match.group(1)
         if expand_macros and has_macros(val):
             # don't parse using rpm unless required
             val = self.expand_macro(val)
@@ -414,7 +1391,7 @@ class Spec(object):
         return True
 
     def get_n_patches(self):
-        return len(re.findall(r'^Patch[0-9]+:', self.txt, re.M))
+        return self.index.get_n_patches()
 
     def get_n_excluded_patches(self):
         """
@@ -425,17 +1402,22 @@ class Spec(object):
         return n_commits
 
     def get_patch_fns(self):
-        fns = []
-        for m in re.finditer(r'^\s*Patch\d+:\s*(\S+)\s*$', self.txt,
-                             flags=re.M):
-            fns.append(m.group(1))
-        return fns
+        return self.index.get_patch_fns()
 
     def wipe_patches(self):
-        self._txt = re.sub(r'\n+(?:(?:Patch|.patch)\d+[^\n]*)', '', self.txt)
+        # drop PatchXXXX: and %patchXXXX lines along with empty lines
+        # preceding them, same as re.sub(r'\n+(?:Patch|.patch)\d+[^\n]*', '')
+        lines = []
+        for i, line in enumerate(self.index.lines):
+            if i and re.match(r'(?:Patch|.patch)\d+', line):
+                while len(lines) > 1 and not lines[-1]:
+                    lines.pop()
+                continue
+            lines.append(line)
+        self._index = SpecIndex(lines=lines)
 
     def sanity_check(self):
-        hints = lint.lint(self.fn, checks=['sanity'])
+        hints = lint.lint(self.fn, checks=['sanity'], spec=self)
         lint.lint_report(hints, error_level='E')
 
     def patches_apply_method(self):
@@ -446,9 +1428,8 @@ class Spec(object):
         return 'rpm'
 
     def set_commit_ref_macro(self, ref):
-        self._txt = re.sub(
-            r'^\%global commit \w+',
-            '%%global commit %s' % ref, self.txt, flags=re.M)
+        self._sub_lines(r'\%global commit \w+', '%%global commit %s' % ref,
+                        self.index.macros.get('commit', []))
 
     def set_new_patches(self, fns):
         self.wipe_patches()
@@ -508,35 +1489,39 @@ class Spec(object):
         return False
 
     def set_macro(self, macro, value):
-        if not RPM_AVAILABLE:
-            raise exception.RpmModuleNotAvailable()
         rex = self.RE_MACRO_BASE.format(re.escape(macro))
-        rpm.delMacro(macro)
+        if RPM_AVAILABLE:
+            rpm.delMacro(macro)
+        self._rpm_macros[macro] = value or None
+        self._rpmdata = None
+        self._dependencies = None
+        line_numbers = self.index.macros.get(macro, [])
         if value:
             # replace
-            self._txt, n = re.subn(r'^(%s).*$' % rex, r'\g<1>%s' % value,
-                                   self.txt, flags=re.M)
+            n = self._sub_lines(r'(%s).*$' % rex, r'\g<1>%s' % value,
+                                line_numbers)
             if n < 1:
                 # create new
-                self._txt = u'%global {0} {1}\n{2}'.format(
-                    macro, value, self.txt)
-            rpm.addMacro(macro, value)
+                self.index.insert_lines(0, [u'%global {0} {1}'.format(
+                    macro, value)])
+            if RPM_AVAILABLE:
+                rpm.addMacro(macro, value)
         else:
             # remove
-            self._txt = re.sub(r'(^|\n)%s[^\n]+\n?' % rex, r'\g<1>', self.txt)
+            self._sub_lines(r'%s[^\n]+\n?' % rex, '', line_numbers,
+                            flags=0, skip_adjacent=True)
 
     def get_macro(self, macro, expanded=False):
         if expanded:
-            # XXX: rpm module remembers old values even after .spec change
-            # and new Spec() instance (that's why this isn't default)
+            # XXX: when expansion falls back to rpm, rpm module remembers old
+            # values even after .spec change and new Spec() instance (that's
+            # why this isn't default)
             return self.expand_macro('%{?' + macro + '}')
         else:
-            rex = self.RE_MACRO_BASE.format(re.escape(macro))
-            m = re.search('^%s(.*)$' % rex, self.txt, flags=re.M)
-            if m:
-                v = m.group(1).strip(' \t"')
-                return v
-            return None
+            v = self.index.get_global_macro(macro)
+            if v is not None:
+                v = v.strip(' \t"')
+            return v
 
     def set_milestone(self, new_milestone):
         self.set_macro('milestone', new_milestone)
@@ -652,8 +1637,11 @@ class Spec(object):
         vr = self.get_vr()
         head = "* %s %s <%s> %s" % (date, user, email, vr)
         entry = "%s\n%s\n" % (head, changes_str)
-        self._txt = re.sub(r'(^%changelog\n)', r'\g<1>%s' % entry,
-                           self.txt, count=1, flags=re.M)
+        index = self.index
+        for i in index.get_section_lines('changelog'):
+            if index.lines[i] == '%changelog' and i + 1 < len(index.lines):
+                index.insert_lines(i + 1, entry.split('\n')[:-1])
+                break
 
     def save(self):
         """ Write the textual content (self._txt) to .spec file (self.fn). """
@@ -666,11 +1654,17 @@ class Spec(object):
         f = codecs.open(self.fn, 'w', encoding='utf-8')
         f.write(self.txt)
         f.close()
+        # results of memoized commands might depend on the file
+        run_cache.invalidate()
         self._rpmspec = None
+        self._rpmdata = None
+        self._dependencies = None
 
     def get_source_urls(self):
         # arcane rpm constants, now in python!
-        sources = list(filter(lambda x: x[2] == 1, self.rpmspec.sources))
+        sources = self.get_rpmdata(
+            'sources', lambda: [list(s) for s in self.rpmspec.sources])
+        sources = list(filter(lambda x: x[2] == 1, sources))
         if len(sources) == 0:
             error = "No sources found"
             raise exception.SpecFileParseError(spec_fn=self.fn, error=error)
@@ -686,12 +1680,8 @@ class Spec(object):
         return list(map(os.path.basename, self.get_source_urls()))
 
     def get_last_changelog_entry(self, strip=False):
-        changelog = ''
-        r = re.split("^%changelog\n", self.txt, flags=re.I | re.M)
-        if len(r) > 2:
-            raise exception.MultipleChangelog()
-        if len(r) == 2:
-            changelog = r[1].strip()
+        changelog = self.index.get_changelog() or ''
+        changelog = changelog.strip()
         entries = re.split(r'\n\n+', changelog)
         entry = entries[0]
         lines = entry.split("\n")
@@ -699,33 +1689,88 @@ class Spec(object):
             lines = list(map(lambda x: x.lstrip(" -*\t"), lines))
         return lines[0], lines[1:]
 
+    def get_dependency_table(self, per_package=False):
+        """
+        Return dependencies of all packages parsed by rpm in a single pass.
+
+        Dependencies are (name, operator, version) tuples with operator and
+        version set to None for unversioned dependencies.
+
+        :param per_package: break dependencies down by (sub)package
+        :returns: {'requires': [...], 'provides': [...], 'conflicts': [...],
+                   'obsoletes': [...]} or {package: {<the same>}} with
+                  per_package
+        """
+        if self._dependencies is None:
+            def parse():
+                return [[pkg.header.format('%{NAME}'),
+                         dict((tag, [[p.DNEVR(), p.N()]
+                                     for p in rpm.ds(pkg.header, tag)])
+                              for tag in DEPENDENCY_TAGS)]
+                        for pkg in self.rpmspec.packages]
+
+            rex = self.RE_DEPENDENCY
+            table = []
+            for pkg, deps in self.get_rpmdata('dependencies', parse):
+                pkg_deps = {}
+                for tag in DEPENDENCY_TAGS:
+                    tag_deps = []
+                    for dnevr, n in deps.get(tag, []):
+                        m = rex.match(dnevr)
+                        if m:
+                            tag_deps.append(m.groups())
+                        else:
+                            tag_deps.append((n, None, None))
+                    pkg_deps[tag] = tag_deps
+                table.append((pkg, pkg_deps))
+            self._dependencies = table
+
+        if per_package:
+            return dict(self._dependencies)
+        deps = dict((tag, []) for tag in DEPENDENCY_TAGS)
+        for _, pkg_deps in self._dependencies:
+            for tag in DEPENDENCY_TAGS:
+                deps[tag] += pkg_deps[tag]
+        return deps
+
+    def _dependency_versions(self, deps, versions_as_string=False,
+                             remove_epoch=True, normalize_py23=False):
+        pkgs = defaultdict(set)
+        for name, eq, ver in deps:
+            if normalize_py23:
+                name = self.RE_PY23.sub('python-', name)
+            if eq is None:
+                pkgs[name]
+                continue
+            if eq == '=':
+                eq = '=='
+            if remove_epoch:
+                _, sep, rest = ver.partition(':')
+                if sep:
+                    ver = rest
+            pkgs[name].add(eq + ' ' + ver)
+        if versions_as_string:
+            for name in pkgs:
+                pkgs[name] = ','.join(pkgs[name])
+        return pkgs
+
     def get_pkgs_from_rpmptag(self, rpmtag, versions_as_string=False,
                               remove_epoch=True, normalize_py23=False):
-        rpmtag_pkgs = defaultdict(set)
-        for pkg in self.rpmspec.packages:
-            packages = rpm.ds(pkg.header, rpmtag)
-            for p in packages:
-                m = re.match(r'\w\s(\S+)\s+([=<>!]+)\s*(\S+)', p.DNEVR())
-                if m:
-                    name, eq, ver = m.groups()
-                    if eq == '=':
-                        eq = '=='
-                    if remove_epoch:
-                        _, sep, rest = ver.partition(':')
-                        if sep:
-                            ver = rest
-                    if normalize_py23:
-                        name = re.sub(r'^python[23]-', 'python-', name)
-                    rpmtag_pkgs[name].add(eq + ' ' + ver)
-                else:
-                    name = p.N()
-                    if normalize_py23:
-                        name = re.sub(r'^python[23]-', 'python-', name)
-                    rpmtag_pkgs[name]
-        if versions_as_string:
-            for name in rpmtag_pkgs:
-                rpmtag_pkgs[name] = ','.join(rpmtag_pkgs[name])
-        return rpmtag_pkgs
+        if rpmtag in DEPENDENCY_TAGS:
+            deps = self.get_dependency_table()[rpmtag]
+        else:
+            def parse():
+                return [[[p.DNEVR(), p.N()]
+                         for p in rpm.ds(pkg.header, rpmtag)]
+                        for pkg in self.rpmspec.packages]
+
+            deps = []
+            for packages in self.get_rpmdata(rpmtag, parse):
+                for dnevr, n in packages:
+                    m = self.RE_DEPENDENCY.match(dnevr)
+                    deps.append(m.groups() if m else (n, None, None))
+        return self._dependency_versions(deps, versions_as_string,
+                                         remove_epoch, normalize_py23)
 
     def get_requires(self, versions_as_string=False, remove_epoch=True,
                      normalize_py23=False):
@@ -739,36 +1784,33 @@ class Spec(object):
 
     def get_requires_not_provided(self, versions_as_string=False,
                                   remove_epoch=True, normalize_py23=False):
-        requires = self.get_requires(versions_as_string, remove_epoch,
-                                     normalize_py23)
-        provides = self.get_provides(versions_as_string, remove_epoch,
-                                     normalize_py23)
+        deps = self.get_dependency_table()
+        requires = self._dependency_versions(
+            deps['requires'], versions_as_string, remove_epoch,
+            normalize_py23)
+        provides = self._dependency_versions(
+            deps['provides'], False, remove_epoch, normalize_py23)
         for p in provides:
-            try:
-                requires.pop(p)
-            except KeyError:
-                pass
+            requires.pop(p, None)
         return requires
 
     def edit_python_requires_version_by_name(self, name, version=''):
         name = name.split('-', 1)[1]
         repl = r'\1 {}\3' if version else r'\1\3'
-        self._txt, n = re.subn(
-            r'^(%s:\s+python.*-%s)\s*([<>=!]*\s[,.\d\w]*)?(\n)'
+        n = self._sub_lines(
+            r'(%s:\s+python.*-%s)\s*([<>=!]*\s[,.\d\w]*)?(\n)'
             % (re.escape('Requires'), name),
             repl.format(version),
-            self.txt,
-            flags=re.M)
+            self.index.tags.get('Requires', []))
         return n > 0
 
     def remove_python_requires_by_name(self, name):
         name = name.split('-', 1)[1]
         repl = r''
-        self._txt, n = re.subn(r'^%s:\s+python.*-%s(\s+[<>=!]*\s[,.\d\w]*)?\n'
-                               % (re.escape('Requires'), name),
-                               repl,
-                               self.txt,
-                               flags=re.M)
+        n = self._sub_lines(r'%s:\s+python.*-%s(\s+[<>=!]*\s[,.\d\w]*)?\n'
+                            % (re.escape('Requires'), name),
+                            repl,
+                            self.index.tags.get('Requires', []))
         if n:
             return n > 0
         return False
@@ -780,30 +1822,21 @@ class Spec(object):
         the beginning and ending indexes of the subpkg in the .spec file
         as value.
         """
-        beginning_of_subpkg, end_of_subpkg, subpackages = '', '', {}
-        txt_list = self.txt.split('\n')
-        main_package_name = self.get_name()
-
-        all_subpkgs = re.findall(r'^%package.*$', self.txt, re.M)
-        if not all_subpkgs:
-            return None
-
-        for subpkg in all_subpkgs:
-            beginning_of_subpkg = txt_list.index(subpkg)
-            for line in txt_list[beginning_of_subpkg:]:
-                if re.match('%description', line):
-                    end_of_subpkg = txt_list.index(line, beginning_of_subpkg)
-                    break
-
+        subpackages = {}
+        main_package_name = None
+        for beginning_of_subpkg, args, end_of_subpkg in \
+                self.index.get_package_spans():
             # If there is no '-n' option to the %package directive, we prepend
             # the main package name to the subpackage one.
-            m = re.search(r'^%package\s+(-n\s+)?(.*)', subpkg)
+            m = re.match(r'(-n\s+)?(.*)', args)
             if not m.group(1):
+                if main_package_name is None:
+                    main_package_name = self.get_name()
                 subpkg = '{}-{}'.format(main_package_name, m.group(2))
             else:
                 subpkg = m.group(2)
             subpackages[subpkg] = (beginning_of_subpkg, end_of_subpkg)
-        return subpackages
+        return subpackages or None
 
     def guess_main_python_subpackage(self, main_py_subpkg=None):
         # To guess which is the main python subpackage, we can only rely on RPM
@@ -819,8 +1852,7 @@ class Spec(object):
         #    not require a subpackage.
         python_subpackages, counter = [], 0
 
-        if not self._contains_subpkg:
-            self._contains_subpkg = self.get_subpackages()
+        self._contains_subpkg = self.get_subpackages()
 
         if main_py_subpkg is None:
             try:
@@ -843,9 +1875,12 @@ class Spec(object):
             main_py_subpkg = list(self._contains_subpkg.keys())[0]
             start_index, end_index = self._contains_subpkg[main_py_subpkg]
 
-        txt_list = self.txt.split('\n')
-        for line in txt_list[start_index:end_index + 1]:
-            line = re.sub(r'%{name}', self.get_name(), line)
+        index = self.index
+        name = None
+        for i in index.get_tag_lines('Requires', start_index, end_index):
+            if name is None:
+                name = self.get_name()
+            line = re.sub(r'%{name}', name, index.lines[i])
             m = re.search(r'^Requires:\s+(.*)\s+=\s+(.*)', line)
             if not m:
                 continue
@@ -866,22 +1901,33 @@ class Spec(object):
         Dependencies which are within a conditional block are ignored.
         Return the index position of the last found dependency, else None.
         """
-        last_line_index, excluded, nested_if_statement = None, False, 0
-        txt_list = self.txt.split('\n')
+        last_line_index = None
+        index = self.index
+        lines = range(len(index.lines))
         try:
-            txt_range = txt_list[starting_index:ending_index + 1]
+            lines = lines[starting_index:ending_index + 1]
         except TypeError:
-            txt_range = txt_list
-
-        for index, line in enumerate(txt_range):
-            if line.startswith('{}:'.format(dep_type)) and not excluded:
-                last_line_index = index
-            elif line.startswith('%if'):
-                excluded = True
-                nested_if_statement += 1
-            elif line.startswith('%endif'):
-                nested_if_statement -= 1
-                excluded = False if nested_if_statement == 0 else True
+            pass
+        if not lines:
+            return None
+
+        # %if nesting depth is relative to the start of searched range
+        depth = index.depth[lines.start]
+        for i in reversed(index.get_tag_lines(dep_type, lines.start,
+                                              lines.stop - 1)):
+            if index.depth[i] != depth:
+                continue
+            # when the range starts inside a conditional block, dependencies
+            # following an %if at the relative depth 0 are excluded as well
+            n = bisect.bisect_left(index.conditionals, i) - 1
+            while (n >= 0 and index.conditionals[n] >= lines.start
+                   and index.lines[index.conditionals[n]].startswith('%el')):
+                n -= 1
+            if (n >= 0 and index.conditionals[n] >= lines.start
+                    and index.lines[index.conditionals[n]].startswith('%if')):
+                continue
+            last_line_index = i - lines.start
+            break
 
         try:
             return starting_index + last_line_index
@@ -896,7 +1942,7 @@ class Spec(object):
         It insert the dependency after the line position in the .spec file, and
         returns True if successful, else False.
         """
-        txt_list = self.txt.split('\n')
+        txt_list = self.index.lines
         try:
             last_dep = txt_list[line_position]
         except IndexError:
@@ -910,10 +1956,13 @@ class Spec(object):
         # value.
         m = re.search(r'^(.*):(\s*)(.*)', last_dep)
         nbr_of_spaces = m.group(2) if m else ' '
-        txt_list.insert(line_position + 1, '{}:{}{}'.format(dep_type,
+        position = line_position + 1
+        if position < 0:
+            # same position as list.insert() would use
+            position = max(position + len(txt_list), 0)
+        self.index.insert_lines(position, ['{}:{}{}'.format(dep_type,
                                                             nbr_of_spaces,
-                                                            dep))
-        self._txt = '\n'.join(txt_list)
+                                                            dep)])
         return True
 
     def add_python_requires(self, requires, subpkg_name=None):
@@ -925,8 +1974,7 @@ class Spec(object):
         If no BR found, it will add it after the BuildArch tag.
         The method returns True if the Requires has been added, else False.
         """
-        if not self._contains_subpkg:
-            self._contains_subpkg = self.get_subpackages()
+        self._contains_subpkg = self.get_subpackages()
 
         try:
             starting_index, ending_index = self._contains_subpkg[
@@ -0,0 +1,147 @@
+"""
+Per-process trace of external commands run by rdopkg.
+
+When enabled (rdopkg --profile or --profile-trace FILE), every command
+started by rdopkg.utils.cmd.run is recorded along with the action step
+which ran it so that slow commands can be found. Recorded trace can be
+summarized or exported as Chrome trace event JSON (chrome://tracing,
+https://ui.perfetto.dev).
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Trace(object):
+    """
+    Trace of commands and action steps.
+
+    CPU times of commands are taken from RUSAGE_CHILDREN difference so they
+    are only approximate for commands run in parallel.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        self.commands = []
+        self.steps = []
+        self.step_name = None
+
+    @contextlib.contextmanager
+    def step(self, name):
+        """
+        Attribute commands run in the context to action step `name`.
+        """
+        if not self.enabled:
+            yield
+            return
+        prev_name = self.step_name
+        self.step_name = name
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.step_name = prev_name
+            with self.lock:
+                self.steps.append({
+                    'step': name,
+                    'start': start,
+                    'wall': time.time() - start,
+                })
+
+    def record(self, cmd, start, wall, cpu_user=0.0, cpu_sys=0.0,
+               return_code=None, out_bytes=0, err_bytes=0, cwd=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.commands.append({
+                'cmd': cmd,
+                'cwd': cwd or os.getcwd(),
+                'step': self.step_name,
+                'thread': threading.current_thread().ident,
+                'start': start,
+                'wall': wall,
+                'cpu_user': cpu_user,
+                'cpu_sys': cpu_sys,
+                'return_code': return_code,
+                'out_bytes': out_bytes,
+                'err_bytes': err_bytes,
+            })
+
+    def summary(self, top=10):
+        """
+        Return a human readable report of time spent in commands by step.
+        """
+        by_step = {}
+        for c in self.commands:
+            by_step.setdefault(c['step'], []).append(c)
+        step_walls = {}
+        for s in self.steps:
+            step_walls[s['step']] = step_walls.get(s['step'], 0) + s['wall']
+        total = sum(c['wall'] for c in self.commands)
+        lines = ['%d commands took %.3f s' % (len(self.commands), total)]
+        steps = sorted(by_step.items(),
+                       key=lambda i: -sum(c['wall'] for c in i[1]))
+        for step, cmds in steps:
+            wall = sum(c['wall'] for c in cmds)
+            line = '\n%s: %d commands, %.3f s' % (
+                step or '(no step)', len(cmds), wall)
+            if step in step_walls:
+                line += ' of %.3f s step' % step_walls[step]
+            lines.append(line)
+            for c in sorted(cmds, key=lambda c: -c['wall'])[:top]:
+                lines.append(
+                    '  %8.3f s  cpu %7.3f s  %9d B  rc=%s  %s' % (
+                        c['wall'], c['cpu_user'] + c['cpu_sys'],
+                        c['out_bytes'] + c['err_bytes'],
+                        c['return_code'], c['cmd']))
+            if len(cmds) > top:
+                lines.append('  ... %d more' % (len(cmds) - top))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """
+        Return trace as Chrome trace event format dict.
+        """
+        pid = os.getpid()
+        events = []
+
+        def _us(t):
+            return int((t - self.start_time) * 1e6)
+
+        for s in self.steps:
+            events.append({
+                'name': s['step'], 'cat': 'step', 'ph': 'X',
+                'ts': _us(s['start']), 'dur': int(s['wall'] * 1e6),
+                'pid': pid, 'tid': 0,
+            })
+        for c in self.commands:
+            events.append({
+                # program and subcommand, full command is in args
+                'name': ' '.join(c['cmd'].split(' ')[:2]),
+                'cat': c['step'] or 'command', 'ph': 'X',
+                'ts': _us(c['start']), 'dur': int(c['wall'] * 1e6),
+                'pid': pid, 'tid': c['thread'],
+                'args': {
+                    'cmd': c['cmd'],
+                    'cwd': c['cwd'],
+                    'return_code': c['return_code'],
+                    'cpu_user': c['cpu_user'],
+                    'cpu_sys': c['cpu_sys'],
+                    'out_bytes': c['out_bytes'],
+                    'err_bytes': c['err_bytes'],
+                },
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+tracer = Trace()
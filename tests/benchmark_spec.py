@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Benchmark Spec edits on a synthetic 5000 lines .spec file.
+
+Edits are recorded against the line index and the text is joined only once
+on the end. For comparison, the same edits are also run with spec.txt read
+after every edit which shows the cost of joining the text.
+
+Whole text rewrites used before line edits aren't part of this script, run
+it on an older checkout to compare with them:
+
+    python tests/benchmark_spec.py
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from rdopkg.utils import specfile  # noqa
+
+
+N_LINES = 5000
+N_REQUIRES = 500
+
+
+def synthetic_spec():
+    lines = [
+        'Name:             python-foo',
+        'Version:          1.0.0',
+        'Release:          1%{?dist}',
+        'Summary:          Synthetic package',
+        'License:          ASL 2.0',
+        'Source0:          foo-1.0.0.tar.gz',
+        '',
+        'BuildArch:        noarch',
+    ]
+    for i in range(N_REQUIRES):
+        lines.append('Requires:         python3-dep%d >= 1.0' % i)
+    lines += ['', '%description', 'Synthetic package.', '', '%prep',
+              '%setup -q', '', '%build', '%{py3_build}', '', '%files']
+    while len(lines) < N_LINES - 2:
+        lines.append('%%{python3_sitelib}/foo/module%d.py' % len(lines))
+    lines += ['', '%changelog']
+    return '\n'.join(lines) + '\n'
+
+
+def edit(spec, sync):
+    for i in range(0, N_REQUIRES, 5):
+        spec.edit_python_requires_version_by_name('python-dep%d' % i,
+                                                  '>= 2.0')
+        if sync:
+            spec.txt
+    for i in range(1, N_REQUIRES, 5):
+        spec.remove_python_requires_by_name('python-dep%d' % i)
+        if sync:
+            spec.txt
+    for i in range(100):
+        last = spec.find_last_dependency('Requires')
+        spec.insert_dependency_after('python-new%d' % i, last)
+        if sync:
+            spec.txt
+    spec.set_tag('Release', '2%{?dist}')
+    return spec.txt
+
+
+def main():
+    txt = synthetic_spec()
+    results = {}
+    for sync in (False, True):
+        results[sync] = edit(specfile.Spec(txt=txt, fn='foo.spec'), sync)
+        t = min(timeit.repeat(
+            lambda: edit(specfile.Spec(txt=txt, fn='foo.spec'), sync),
+            number=1, repeat=5))
+        print("%-28s %8.1f ms" % (
+            "spec.txt after each edit:" if sync else "deferred edits:",
+            t * 1000))
+    assert results[False] == results[True]
+
+
+if __name__ == '__main__':
+    main()
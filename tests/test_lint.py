@@ -2,6 +2,8 @@ import pytest
 import subprocess
 
 from rdopkg.cli import rdopkg
+from rdopkg.utils import lint
+from rdopkg.utils import specfile
 
 import test_common as common
 
@@ -76,3 +78,100 @@ def test_lint_all(tmpdir, capsys):
     _assert_sanity_out(o)
     # linting problems are indicated by exit code 23
     assert rv == 23
+
+
+def test_sanity_check_spec_in_memory():
+    # .spec file doesn't exist, in-memory Spec is checked
+    spec = specfile.Spec(fn='nonexistent.spec', txt='\n'.join([
+        'Name: foo',
+        'BuildArch: noarch',
+        'Source0: foo.tar.gz',
+        '# patches_base=1.0',
+        '# patches_base=1.1',
+        '']))
+    hints = lint.lint(spec.fn, checks=['sanity'], spec=spec)
+    msgs = [h.msg.split(':')[0] for h in hints]
+    assert msgs == ['buildarch-before-sources', 'duplicate-patches-base']
+    assert all(h.location == 'nonexistent.spec' for h in hints)
+
+
+def test_sanity_check_custom():
+    class SectionsCheck(lint.SanityCheck):
+        def __init__(self, spec_fn):
+            super(SectionsCheck, self).__init__(spec_fn)
+            self.events = []
+
+        def on_tag(self, lineno, tag):
+            self.events.append((lineno, tag))
+
+        def on_section(self, lineno, section):
+            self.events.append((lineno, section))
+
+        def hints(self):
+            return [lint.LintHint(self.spec_fn, 'W', repr(self.events))]
+
+    index = specfile.SpecIndex('Name: foo\n%description\nfoo\n%files\n')
+    hints = lint.run_sanity_checks(index, 'foo.spec', checks=[SectionsCheck])
+    assert len(hints) == 1
+    assert hints[0].msg == repr([(0, 'Name'), (1, 'description'),
+                                 (3, 'files')])
+
+
+def test_parse_rpmlint_output():
+    out = '\n'.join([
+        '============ rpmlint session starts ============',
+        'rpmlint: 2.4.0',
+        'configuration:',
+        '    /usr/lib/python3.11/site-packages/rpmlint/configdefaults.toml',
+        'checks: 31, packages: 1',
+        '',
+        'foo.spec:12: W: macro-in-%changelog %{name}',
+        'foo.spec: E: specfile-error error: bad',
+        '= 0 packages and 1 specfiles checked; 1 errors, 1 warnings =',
+        'garbage',
+    ])
+    hints = lint.parse_rpmlint_output(out)
+    assert [repr(h) for h in hints] == [
+        'foo.spec:12: W: macro-in-%changelog %{name}',
+        'foo.spec: E: specfile-error error: bad',
+        'rpmlint: W: Failed to parse rpmlint output: garbage',
+    ]
+
+
+def test_rpmlint_cache(tmpdir, monkeypatch):
+    # fake rpmlint counting its runs
+    bin_path = tmpdir.mkdir('bin')
+    runs = tmpdir.join('runs')
+    rpmlint = bin_path.join('rpmlint')
+    rpmlint.write('#!/bin/sh\necho run >> %s\n'
+                  'echo "$1: W: fake-warning"\nexit 64\n' % runs)
+    rpmlint.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_path), prepend=':')
+    monkeypatch.setattr(lint, '_rpmlint_version', None)
+    monkeypatch.setitem(lint.cfg, 'HOME_DIR', str(tmpdir.join('home')))
+    spec = tmpdir.join('foo.spec')
+    spec.write('Name: foo\n')
+    specs = [str(spec), str(tmpdir.join('bar.spec'))]
+    tmpdir.join('bar.spec').write('Name: bar\n')
+
+    hints = lint.lint_many(specs, checks=['rpmlint'])
+    assert [h.location for h in hints] == specs
+    assert len(runs.readlines()) == 2
+    # unchanged .spec files are served from cache
+    hints = lint.lint_many(specs, checks=['rpmlint'])
+    assert [h.msg for h in hints] == ['fake-warning'] * 2
+    assert len(runs.readlines()) == 2
+    # changed .spec file is checked again
+    spec.write('Name: foo\nVersion: 1.0\n')
+    lint.lint(str(spec), checks=['rpmlint'])
+    assert len(runs.readlines()) == 3
+    # so is .spec with new or changed rpmlintrc filters next to it
+    rpmlintrc = tmpdir.join('foo.rpmlintrc')
+    rpmlintrc.write('addFilter("fake-warning")\n')
+    lint.lint(str(spec), checks=['rpmlint'])
+    assert len(runs.readlines()) == 4
+    rpmlintrc.write('addFilter("other-warning")\n')
+    lint.lint(str(spec), checks=['rpmlint'])
+    assert len(runs.readlines()) == 5
+    lint.lint(str(spec), checks=['rpmlint'])
+    assert len(runs.readlines()) == 5
@@ -0,0 +1,91 @@
+import os
+
+from rdopkg.actionmods import mirror
+from rdopkg import exception
+from rdopkg import helpers
+from rdopkg.utils.git import git
+
+import test_common as common
+
+
+def _prep_mirrors(tmpdir, monkeypatch):
+    monkeypatch.setitem(mirror.cfg, 'HOME_DIR', str(tmpdir.join('home')))
+    monkeypatch.setitem(mirror.cfg, 'MIRRORS', True)
+    remote = common.prep_spec_test(tmpdir, 'patched')
+    return 'file://%s' % remote, remote
+
+
+def test_mirror_clone(tmpdir, monkeypatch):
+    url, remote = _prep_mirrors(tmpdir, monkeypatch)
+    clone_path = str(tmpdir.join('clone'))
+    mirror.clone(url, clone_path)
+    mirror_path = mirror.mirror_path(url)
+    assert os.path.isdir(mirror_path)
+    assert (git('--git-dir', mirror_path, 'rev-parse', 'master')
+            == git('--git-dir', str(remote.join('.git')),
+                   'rev-parse', 'master'))
+    # clone doesn't depend on the mirror
+    assert not os.path.exists(os.path.join(
+        clone_path, '.git', 'objects', 'info', 'alternates'))
+    with helpers.cdir(clone_path):
+        assert git('remote', 'get-url', 'origin') == url
+        assert git.is_clean()
+
+
+def test_mirror_refresh(tmpdir, monkeypatch):
+    url, remote = _prep_mirrors(tmpdir, monkeypatch)
+    path = mirror.update_mirror(url)
+    with remote.as_cwd():
+        common.do_patch('foofile', '#change\n', 'Change')
+        head = git('rev-parse', 'HEAD')
+    # fresh mirror isn't fetched again
+    mirror.update_mirror(url, period=3600)
+    assert git('--git-dir', path, 'rev-parse', 'master') != head
+    mirror.update_mirror(url, period=0)
+    assert git('--git-dir', path, 'rev-parse', 'master') == head
+
+
+def test_mirror_borrowed_objects(tmpdir, monkeypatch):
+    url, remote = _prep_mirrors(tmpdir, monkeypatch)
+    local = tmpdir.mkdir('local')
+    with local.as_cwd():
+        git('init', '-q')
+        git('remote', 'add', 'upstream', url)
+        with mirror.borrowed_objects([url]):
+            assert os.path.exists('.git/objects/info/alternates')
+            git('fetch', '--all')
+        assert not os.path.exists('.git/objects/info/alternates')
+        git('fsck', '--connectivity-only')
+        assert git('rev-parse', 'upstream/master') == git(
+            '--git-dir', str(remote.join('.git')), 'rev-parse', 'master')
+
+
+def test_mirror_prune(tmpdir, monkeypatch):
+    url, _ = _prep_mirrors(tmpdir, monkeypatch)
+    path = mirror.update_mirror(url)
+    assert mirror.prune_mirrors(max_age=3600) == []
+    os.utime(os.path.join(path, mirror.USED_STAMP), (0, 0))
+    assert mirror.prune_mirrors(max_age=3600) == [path]
+    assert not os.path.exists(path)
+    # lock file might be in use by another process
+    assert os.path.exists(path + '.lock')
+
+
+def test_mirror_borrowed_objects_repack_fail(tmpdir, monkeypatch):
+    url, _ = _prep_mirrors(tmpdir, monkeypatch)
+    local = tmpdir.mkdir('local')
+
+    def _git(*args, **kwargs):
+        if 'repack' in args:
+            raise exception.CommandFailed(cmd=args)
+        return git(*args, **kwargs)
+
+    with local.as_cwd():
+        git('init', '-q')
+        git('remote', 'add', 'upstream', url)
+        with mirror.borrowed_objects([url]):
+            git('fetch', '--all')
+            monkeypatch.setattr(mirror, 'git', _git)
+        # objects are only in the mirror, repository must stay usable
+        assert os.path.exists('.git/objects/info/alternates')
+        git('fsck', '--connectivity-only')
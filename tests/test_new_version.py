@@ -53,3 +53,17 @@ def test_new_version_milestone(tmpdir):
         ('4.0.0', '4.0.0', ('1', '', DIST_POSTFIX), None),
     ]
     _test_new_version('some', tmpdir, steps)
+
+
+def test_new_version_fetch(tmpdir):
+    from rdopkg.actions.distgit import actions
+    upstream = common.prep_spec_test(tmpdir, 'patched')
+    dist_path = tmpdir.join('dist')
+    git('clone', '-q', str(upstream), str(dist_path))
+    with dist_path.as_cwd():
+        git('remote', 'add', 'upstream', str(upstream))
+        actions.fetch_new_version_remotes(no_fetch=True)
+        actions.fetch_new_version_remotes(bump_only=True)
+        assert not git.ref_exists('refs/remotes/upstream/master')
+        actions.fetch_new_version_remotes()
+        assert git.ref_exists('refs/remotes/upstream/master')
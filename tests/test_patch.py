@@ -1,6 +1,7 @@
 # -*- encoding: utf-8 -*-
 from __future__ import unicode_literals
 
+from rdopkg.actions.distgit.actions import check_new_patches
 from rdopkg.cli import rdopkg
 from rdopkg.utils.git import git, git_branch
 from rdopkg.utils import log
@@ -213,3 +214,18 @@ def test_patch_unicode(tmpdir):
         git_clean = git.is_clean()
     assert commit_before != commit_after, "New commit not created"
     assert git_clean, "git not clean after action"
+
+
+def test_check_new_patches_detect(tmpdir):
+    dist_path = common.prep_spec_test(tmpdir, 'patched')
+    with dist_path.as_cwd():
+        common.prep_patches_branch()
+        common.add_patches()
+        with git_branch('master-patches'):
+            # reworded patch is matched by patch-id
+            git('commit', '--amend', '-m', 'Epic bugfix of doom MK3',
+                isolated=True)
+            common.do_patch('foofile', '#new\n', 'Fix things\n\nrhbz#123')
+        r = check_new_patches('1.2.3', 'master-patches',
+                              local_patches=True, changelog='detect')
+    assert r == {'changes': ['Fix things (rhbz#123)']}
@@ -353,6 +353,34 @@ def test_get_pkgs_from_upstream_refs_2(tmpdir):
     assert 'python-pbr' in got
 
 
+def test_get_upstream_first_ref_of_stable_releases(tmpdir):
+    dist_path = common.prep_spec_test(tmpdir, 'reqcheck')
+    dist_path_remote = common.prep_spec_test(tmpdir, 'reqcheck-excess')
+    with dist_path_remote.as_cwd():
+        for rel in ('rel-1', 'rel-2', 'rel-3'):
+            git('checkout', '-b', 'stable/' + rel, 'master')
+            common.do_patch('foofile', '# %s' % rel, 'Branch %s' % rel)
+            common.do_patch('foofile', '# %s fix' % rel, 'Fix %s' % rel)
+        # no commits on top of master
+        git('branch', 'stable/rel-4', 'master')
+        git('checkout', 'master')
+
+    with dist_path.as_cwd():
+        git('remote', 'add', 'upstream', dist_path_remote.__str__())
+        git('fetch', 'upstream')
+        branches = ['upstream/stable/rel-%d' % i for i in range(1, 5)]
+        first_commits = git.get_first_commits_of_branches(branches)
+        for branch in branches[:3]:
+            assert first_commits[branch] == git.get_commits_of_branch(
+                branch)[0]
+        assert 'upstream/stable/rel-4' not in first_commits
+        got = get_upstream_first_ref_of_stable_releases_before()
+        assert got == [first_commits[b]['hash'] for b in branches[:3]]
+        txt = get_reqs_txt_from_commit(got[0])
+        assert txt.rstrip() == git.get_file_content(got[0], 'requirements.txt')
+        assert get_reqs_txt_from_commit(got[0]) is txt
+
+
 def test_parse_reqs_txt_with_environment_marker_01(caplog):
     requirements_txt = '\n'.join(["ipaddress==1.0.17;python_version=='3.5'\
                                   or python_version=='3.6'"])
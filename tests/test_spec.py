@@ -373,6 +373,18 @@ def test_get_last_changelog_entry_multiple_sections():
         assert False, r
 
 
+def test_new_changelog_entry_backslashes(tmpdir):
+    txt = ('Name: foo\nVersion: 1.2.3\nRelease: 1\n\n'
+           '%changelog\n* Mon Jan 01 2018 Old <old@x> 1.2.2-1\n- old\n')
+    spec_path = tmpdir.join('foo.spec')
+    spec_path.write(txt)
+    spec = specfile.Spec(fn=str(spec_path))
+    spec.new_changelog_entry('Foo', 'foo@x', [r'Match \d+ in C:\new'])
+    _, changes = spec.get_last_changelog_entry(strip=True)
+    assert changes == [r'Match \d+ in C:\new']
+    assert spec.txt.endswith('\n- old\n')
+
+
 @pytest.mark.skipif('RPM_AVAILABLE == False')
 def test_get_source_urls(tmpdir):
     dist_path = common.prep_spec_test(tmpdir, 'empty')
@@ -391,6 +403,86 @@ def test_get_source_fns(tmpdir):
     assert fns == ['foo-1.2.3.tar.gz']
 
 
+def test_rpm_cache(tmpdir, monkeypatch):
+    monkeypatch.setitem(specfile.cfg, 'HOME_DIR', str(tmpdir))
+    spec_path = tmpdir.join('foo.spec')
+    spec_path.write('Name: foo\nVersion: 1.2.3\nRelease: 1%{?dist}\n')
+    spec = specfile.Spec(fn=str(spec_path))
+    key = spec.rpm_cache_key()
+    spec.rpm_cache.set(key, {
+        'macros': {'%(echo foo)': 'foo'},
+        'dependencies': [['foo', {
+            'requires': [['R python3-foo >= 1:1.0', 'python3-foo'],
+                         ['R bar', 'bar']],
+            'provides': [['P foo = 1.2.3-1', 'foo']]}]],
+        'sources': [['http://foo/foo-1.2.3.tar.gz', 0, 1]],
+    })
+    # cached data are used without parsing the .spec using rpm
+    spec = specfile.Spec(fn=str(spec_path))
+    assert spec.get_requires(normalize_py23=True) == {
+        'python-foo': {'>= 1.0'}, 'bar': set()}
+    assert spec.get_source_fns() == ['foo-1.2.3.tar.gz']
+    assert spec.expand_macro('%(echo foo)') == 'foo'
+    # changed .spec means different cache entry
+    spec_path.write('Name: foo\nVersion: 1.2.4\nRelease: 1%{?dist}\n')
+    assert specfile.Spec(fn=str(spec_path)).rpm_cache_key() != key
+    # cache can be bypassed
+    spec_path.write('Name: foo\nVersion: 1.2.3\nRelease: 1%{?dist}\n')
+    spec = specfile.Spec(fn=str(spec_path), cache=False)
+    assert spec.rpm_cache_key() == key
+    assert spec.rpm_cache.get(key) is None
+    # results of .spec files including other files can't be cached
+    for include in ('%include foo.inc', '%{load:foo.macros}'):
+        spec_path.write('Name: foo\n%s\nVersion: 1.2.3\n' % include)
+        assert specfile.Spec(fn=str(spec_path)).rpm_cache_key() is None
+
+
+@pytest.mark.skipif('RPM_AVAILABLE == False')
+def test_rpm_macro_files_state(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    rpmmacros = tmpdir.join('.rpmmacros')
+    rpmmacros.write('%_with_foo 1\n')
+    state = specfile.rpm_macro_files_state()
+    assert str(rpmmacros) in [path for path, _, _ in state]
+    rpmmacros.write('%_with_foo 1\n%_with_bar 1\n')
+    assert specfile.rpm_macro_files_state() != state
+
+
+def test_get_dependency_table(tmpdir, monkeypatch):
+    monkeypatch.setitem(specfile.cfg, 'HOME_DIR', str(tmpdir))
+    spec_path = tmpdir.join('foo.spec')
+    spec_path.write('Name: foo\nVersion: 1.2.3\nRelease: 1\n')
+    spec = specfile.Spec(fn=str(spec_path))
+    spec.rpm_cache.set(spec.rpm_cache_key(), {
+        'dependencies': [
+            ['foo', {
+                'requires': [['R python3-foo >= 1:1.0', 'python3-foo'],
+                             ['R foo-common = 1.2.3-1', 'foo-common']],
+                'provides': [['P foo = 1.2.3-1', 'foo']],
+                'obsoletes': [['O foo-old < 1.0', 'foo-old']]}],
+            ['foo-common', {
+                'requires': [['R bar', 'bar']],
+                'provides': [['P foo-common = 1.2.3-1', 'foo-common']],
+                'conflicts': [['C baz', 'baz']]}],
+        ]})
+    spec = specfile.Spec(fn=str(spec_path))
+    assert spec.get_dependency_table() == {
+        'requires': [('python3-foo', '>=', '1:1.0'),
+                     ('foo-common', '=', '1.2.3-1'),
+                     ('bar', None, None)],
+        'provides': [('foo', '=', '1.2.3-1'),
+                     ('foo-common', '=', '1.2.3-1')],
+        'conflicts': [('baz', None, None)],
+        'obsoletes': [('foo-old', '<', '1.0')],
+    }
+    table = spec.get_dependency_table(per_package=True)
+    assert sorted(table) == ['foo', 'foo-common']
+    assert table['foo-common']['requires'] == [('bar', None, None)]
+    assert table['foo-common']['obsoletes'] == []
+    assert spec.get_requires_not_provided(True, True, True) == {
+        'python-foo': '>= 1.0', 'bar': ''}
+
+
 def test_set_magic_modify():
     txt = ('Version: 1.2.3\n\nSource0: test.tar.gz\n# patches_ignore='
            'DROP-IN-RPM\n# patches_base=1.2.3\n#\nPatch0=foo.patch\n')
@@ -709,6 +801,59 @@ def test_get_subpackages_2(tmpdir):
     assert spec.get_subpackages() is None
 
 
+def test_get_subpackages_duplicate_lines():
+    txt = '\n'.join(['Name:            openstack-foo',
+                     '%if 0%{?fedora}',
+                     '%package        doc',
+                     'Requires:        python-bar1',
+                     '%description    doc',
+                     '%else',
+                     '%package        doc',
+                     'Requires:        python-bar2',
+                     '%description    doc',
+                     '%endif'])
+    spec = specfile.Spec(txt=txt)
+    subpkgs = spec.get_subpackages()
+    assert subpkgs == {'openstack-foo-doc': (6, 8)}
+
+
+def test_index_follows_txt():
+    spec = specfile.Spec(txt='Name: foo\nVersion: 1.0\n')
+    assert spec.get_tag('Version') == '1.0'
+    spec._txt = 'Name: foo\nVersion: 2.0\n'
+    assert spec.get_tag('Version') == '2.0'
+
+
+def test_line_edits():
+    txt = '\n'.join(['%global commit abc',
+                     'Name:            openstack-foo',
+                     'Release:         1%{?dist}',
+                     'Requires:        python3-bar >= 1.0',
+                     'Requires:        python3-baz',
+                     '',
+                     'Patch0001:       a.patch',
+                     '',
+                     'Patch0002:       b.patch',
+                     '%description',
+                     ''])
+    spec = specfile.Spec(txt=txt)
+    assert spec.set_tag('Release', '2%{?dist}')
+    assert spec.edit_python_requires_version_by_name('python-bar', '>= 2.0')
+    assert spec.remove_python_requires_by_name('python-baz')
+    assert spec.insert_dependency_after('python-qux', 3)
+    spec.set_commit_ref_macro('def')
+    spec.wipe_patches()
+    assert spec.get_tag('Release') == '2%{?dist}'
+    assert spec.txt == '\n'.join(['%global commit def',
+                                  'Name:            openstack-foo',
+                                  'Release:         2%{?dist}',
+                                  'Requires:        python3-bar >= 2.0',
+                                  'Requires:        python3-qux',
+                                  '%description',
+                                  ''])
+    assert spec.find_last_dependency('Requires') == 4
+
+
 def test_find_last_dependency_1(tmpdir):
     txt = '\n'.join(['Requires:      python-foo1',
                      'Requires:      python-foo2',
@@ -779,6 +924,40 @@ def test_insert_dependency_after_3(tmpdir):
     assert spec.insert_dependency_after('python-bar2', 1) is False
 
 
+def test_find_last_dependency_5_conditional_subpkg(tmpdir):
+    txt = '\n'.join(['Name:          foo',
+                     '%package       doc',
+                     'Requires:      python-foo1',
+                     '%if 0%{?fedora}',
+                     'Requires:      python-foo2',
+                     '%endif',
+                     'Requires:      python-foo3',
+                     '%description   doc',
+                     'Requires:      python-foo4'])
+    spec = specfile.Spec(txt=txt)
+    assert spec.find_last_dependency('Requires', 1, 7) == 6
+    assert spec.find_last_dependency('Requires', 4, 5) == 4
+    assert spec.find_last_dependency('Requires', 5, 8) is None
+
+
+def test_add_python_requires_updates_subpkg_spans(tmpdir):
+    txt = '\n'.join(['Name:          foo',
+                     'Requires:      python3-foo1',
+                     '%package -n    python3-foo',
+                     'Requires:      python3-bar1',
+                     '%description -n python3-foo',
+                     '%package       doc',
+                     'Requires:      python3-baz1',
+                     '%description   doc'])
+    spec = specfile.Spec(txt=txt)
+    assert spec.add_python_requires('python-bar2', 'python3-foo')
+    assert spec.add_python_requires('python-baz2', 'foo-doc')
+    assert spec.get_subpackages() == {'python3-foo': (2, 5),
+                                      'foo-doc': (6, 9)}
+    assert spec.txt.split('\n')[4] == 'Requires:      python3-bar2'
+    assert spec.txt.split('\n')[8] == 'Requires:      python3-baz2'
+
+
 def test_add_python_requires_1_in_subpkg_after_last_found_requires(tmpdir):
     txt = '\n'.join(['Name:              openstack-foo',
                      '%package -n        python3-foo',
@@ -955,3 +1134,222 @@ def test_guess_main_python_subpackage_7(tmpdir):
     spec = specfile.Spec(txt=txt)
     got = spec.guess_main_python_subpackage()
     assert got == 'python3-foo'
+
+
+MACROS_SPEC = '\n'.join([
+    '%global milestone .0rc1',
+    '%{!?upstream_version: %global upstream_version %{version}%{?milestone}}',
+    '%global pypi_name foo',
+    '%define desc_name %{pypi_name} library',
+    'Name:             python-%{pypi_name}',
+    'Version:          1.2.3',
+    'Release:          0.1%{?milestone}%{?dist}',
+    '',
+    '%description',
+    '%{desc_name}',
+    ''])
+
+
+@pytest.mark.parametrize('macro,expanded', [
+    ('%{name}', 'python-foo'),
+    ('%name-%version', 'python-foo-1.2.3'),
+    ('%{upstream_version}', '1.2.3.0rc1'),
+    ('%{desc_name}', 'foo library'),
+    ('%{?milestone}', '.0rc1'),
+    ('%?milestone', '.0rc1'),
+    ('%{?milestone:ms}', 'ms'),
+    ('%{!?milestone:none}', ''),
+    ('%{?nonexistent_macro}', ''),
+    ('%{!?nonexistent_macro:none}', 'none'),
+    ('%{nil}', ''),
+    ('100%%', '100%'),
+])
+def test_spec_macros(macro, expanded):
+    spec = specfile.Spec(txt=MACROS_SPEC)
+    assert specfile.SpecMacros(spec.index).expand(macro) == expanded
+
+
+@pytest.mark.parametrize('macro', [
+    '%(echo foo)',
+    '%{lua: print("foo")}',
+    '%{expand:%{name}}',
+    '%[1 + 1]',
+])
+def test_spec_macros_unsupported(macro):
+    spec = specfile.Spec(txt=MACROS_SPEC)
+    with pytest.raises(exception.UnsupportedMacro):
+        specfile.SpecMacros(spec.index).expand(macro)
+
+
+def test_spec_macros_conditional_definition():
+    txt = '\n'.join(['%if 0%{?rhel}',
+                     '%global pyver 3',
+                     '%endif',
+                     'Name: python%{pyver}-foo',
+                     ''])
+    spec = specfile.Spec(txt=txt)
+    with pytest.raises(exception.UnsupportedMacro):
+        specfile.SpecMacros(spec.index).expand('%{name}')
+
+
+@pytest.mark.parametrize('macro,expanded', [
+    ('%{?epoch}', '2'),
+    ('%{epoch}:%{version}', '2:1.0'),
+    ('%{url}/archive/%{version}.tar.gz',
+     'https://example.com/foo/archive/1.0.tar.gz'),
+    ('%{?url:yes}', 'yes'),
+    ('%{summary}', 'Foo library'),
+    ('%{!?vendor:none}', 'none'),
+])
+def test_spec_macros_preamble_tags(macro, expanded):
+    txt = '\n'.join(['Name: foo',
+                     'Epoch: 2',
+                     'Version: 1.0',
+                     'Release: 1',
+                     'summary: Foo library',
+                     'URL: https://example.com/%{name}',
+                     ''])
+    spec = specfile.Spec(txt=txt)
+    assert specfile.SpecMacros(spec.index).expand(macro) == expanded
+
+
+@pytest.mark.parametrize('macro', [
+    # Summary is also set by subpackage
+    '%{summary}',
+    '%{SOURCE0}',
+    # unknown tag which might define a macro
+    '%{foo}',
+])
+def test_spec_macros_preamble_tags_unsupported(macro):
+    txt = '\n'.join(['Name: foo',
+                     'Summary: Foo',
+                     'Source0: foo.tar.gz',
+                     'Foo: bar',
+                     '%package -n foo-libs',
+                     'Summary: Foo libraries',
+                     ''])
+    spec = specfile.Spec(txt=txt)
+    with pytest.raises(exception.UnsupportedMacro):
+        specfile.SpecMacros(spec.index).expand(macro)
+
+
+def test_get_nvr_without_rpm(monkeypatch):
+    # pure python macro expansion doesn't need rpm
+    monkeypatch.setattr(specfile, 'RPM_AVAILABLE', False)
+    spec = specfile.Spec(txt=MACROS_SPEC, fn='python-foo.spec')
+    assert spec.get_nvr() == 'python-foo-1.2.3-0.1.0rc1'
+    assert spec.get_tag('Name', expand_macros=True) == 'python-foo'
+    spec.set_milestone('.0rc2')
+    assert spec.get_vr() == '1.2.3-0.1.0rc2'
+    assert spec.get_macro('upstream_version', expanded=True) == '1.2.3.0rc2'
+
+
+# from rpm test suite (rpmvercmp.at)
+RPMVERCMP_CASES = [
+    ('1.0', '1.0', 0),
+    ('1.0', '2.0', -1),
+    ('2.0.1', '2.0', 1),
+    ('2.0.1a', '2.0.1', 1),
+    ('5.5p1', '5.5p10', -1),
+    ('10xyz', '10.1xyz', -1),
+    ('xyz10', 'xyz10.1', -1),
+    ('xyz.4', '8', -1),
+    ('8', 'xyz.4', 1),
+    ('6.0.rc1', '6.0', 1),
+    ('10b2', '10a1', 1),
+    ('1.0a', '1.0aa', -1),
+    ('10.0001', '10.1', 0),
+    ('10.0001', '10.0039', -1),
+    ('4.999.9', '5.0', -1),
+    ('2.0', '2_0', 0),
+    ('a+', 'a_', 0),
+    ('+_', '_+', 0),
+    ('+', '_', 0),
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~rc1', '1.0~rc2', -1),
+    ('1.0~rc1~git123', '1.0~rc1', -1),
+    ('1.0^', '1.0', 1),
+    ('1.0^git1', '1.0^git2', -1),
+    ('1.0^git1', '1.01', -1),
+    ('1.0^20160101', '1.0.1', -1),
+    ('1.0~rc1^git1', '1.0~rc1', 1),
+    ('1.0^git1~pre', '1.0^git1', -1),
+]
+
+
+@pytest.mark.parametrize('v1,v2,expected', RPMVERCMP_CASES)
+def test_rpmvercmp(v1, v2, expected):
+    assert specfile.rpmvercmp(v1, v2) == expected
+    assert specfile.rpmvercmp(v2, v1) == -expected
+    assert specfile.vcmp(v1, v2) == expected
+
+
+@pytest.mark.skipif('RPM_AVAILABLE == False')
+@pytest.mark.parametrize('v1,v2,expected', RPMVERCMP_CASES)
+def test_rpmvercmp_librpm(v1, v2, expected):
+    got = specfile.label_compare(('0', v1, '1'), ('0', v2, '1'))
+    assert got == rpm.labelCompare(('0', v1, '1'), ('0', v2, '1'))
+
+
+@pytest.mark.parametrize('nvr1,nvr2,expected', [
+    ('foo-1.0-1', 'foo-1.0-2', -1),
+    ('foo-bar-1.10-1.el9', 'foo-bar-1.9-3.el9', 1),
+    ('foo-1:1.0-1', 'foo-2.0-1', 1),
+    ('1:1.0-1', '1.0-1', 1),
+    ('0:1.0-1', '1.0-1', 0),
+    ('1.0-1', '1.0-1', 0),
+])
+def test_nvrcmp(nvr1, nvr2, expected):
+    assert specfile.nvrcmp(nvr1, nvr2) == expected
+
+
+def test_nvr_key_sort():
+    nvrs = ['foo-1.0-1', 'foo-1.0~rc1-1', 'foo-1:0.1-1', 'foo-1.0.1-1',
+            'foo-1.0-10']
+    assert sorted(nvrs, key=specfile.nvr_key) == [
+        'foo-1.0~rc1-1', 'foo-1.0-1', 'foo-1.0-10', 'foo-1.0.1-1',
+        'foo-1:0.1-1']
+
+
+def test_split_filenames():
+    assert specfile.split_filenames([
+        'foo-1.0-1.i386.rpm',
+        '1:bar-9-123a.ia64.rpm',
+        'python3-foo-bar-1.2.3-0.1.el9.noarch.rpm',
+    ]) == [
+        ('foo', '1.0', '1', '', 'i386'),
+        ('bar', '9', '123a', '1', 'ia64'),
+        ('python3-foo-bar', '1.2.3', '0.1.el9', '', 'noarch'),
+    ]
+    assert specfile.nvr2version('python3-foo-1.2.3-0.1.el9') == '1.2.3'
+
+
+def test_get_patches_from_files(tmpdir, monkeypatch):
+    monkeypatch.setitem(specfile.cfg, 'HOME_DIR', str(tmpdir.join('home')))
+    patches = tmpdir.mkdir('patches')
+    patches.join('0001-foo.patch').write(
+        'From 0123abcd Mon Sep 17 00:00:00 2001\n'
+        'From: Foo Bar <foo@example.com>\n'
+        'Subject: [PATCH] Fix a bug with a subject long enough to be\n'
+        ' folded\n'
+        '\n'
+        'Subject: not a header\n')
+    patches.join('0002-bar.patch').write_binary(
+        b'From 4567ef Mon Sep 17 00:00:00 2001\n'
+        b'Subject: =?UTF-8?q?[PATCH]=20Na=C3=AFve=20fix?=\n'
+        b'\n')
+    patches.join('0003-plain.patch').write('--- a/foo\n+++ b/foo\n')
+    patches.join('README').write('not a patch\n')
+    expected = [
+        ('0001-foo.patch', '0123abcd',
+         '[PATCH] Fix a bug with a subject long enough to be folded'),
+        ('0002-bar.patch', '4567ef', '[PATCH] Naïve fix'),
+        ('0003-plain.patch', None, None),
+    ]
+    got = specfile.get_patches_from_files(str(patches))
+    assert sorted(got) == expected
+    # headers are cached on disk
+    specfile._patch_headers.clear()
+    monkeypatch.setattr(specfile, 'read_patch_header', None)
+    got = specfile.get_patches_from_files(str(patches))
+    assert sorted(got) == expected
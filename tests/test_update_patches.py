@@ -204,3 +204,51 @@ def test_update_double_patches_base(tmpdir):
                            local_patches_branch='master-patches',
                            version='1.2.3')
     common.assert_distgit(dist_path, 'double-patches')
+
+
+def test_update_unchanged_patches(tmpdir):
+    dist_path = common.prep_spec_test(tmpdir, 'empty')
+    spec_path = dist_path.join('foo.spec')
+    with dist_path.as_cwd():
+        common.prep_patches_branch()
+        git('checkout', 'master-patches')
+        common.do_patch('foofile', "#huehue, change\n", 'Crazy first patch')
+        common.do_patch('barfile', "#new file\n", 'Add barfile')
+        git('checkout', 'master')
+        update_patches('master',
+                       local_patches_branch='master-patches',
+                       version='1.2.3')
+        git('commit', '-a', '-m', 'Update patches', isolated=True)
+        first = dist_path.join('0001-Crazy-first-patch.patch').read()
+        second = dist_path.join('0002-Add-barfile.patch').read()
+        spec_before = spec_path.read()
+        # rewrite the first patch, second one is rebased but the same
+        git('checkout', 'master-patches')
+        old_head = git('rev-parse', 'HEAD', log_cmd=False)
+        git('reset', '--hard', '1.2.3')
+        common.do_patch('foofile', "#hue, change\n", 'Crazy first patch')
+        git('cherry-pick', old_head, isolated=True)
+        git('checkout', 'master')
+        update_patches('master',
+                       local_patches_branch='master-patches',
+                       version='1.2.3')
+        assert spec_path.read() == spec_before
+        assert dist_path.join('0001-Crazy-first-patch.patch').read() != first
+        assert dist_path.join('0002-Add-barfile.patch').read() == second
+        changed = git('diff', '--name-only', 'HEAD', log_cmd=False)
+        assert changed.split('\n') == ['0001-Crazy-first-patch.patch']
+        git('commit', '-a', '-m', 'Update patches again', isolated=True)
+        second = dist_path.join('0002-Add-barfile.patch').read()
+        # whitespace only change of the second patch is exported
+        git('checkout', 'master-patches')
+        git('reset', '--hard', 'HEAD~')
+        common.do_patch('barfile', "  #new file\n", 'Add barfile')
+        git('checkout', 'master')
+        update_patches('master',
+                       local_patches_branch='master-patches',
+                       version='1.2.3')
+        patch = dist_path.join('0002-Add-barfile.patch').read()
+        assert patch != second
+        assert '+  #new file' in patch
+        changed = git('diff', '--name-only', 'HEAD', log_cmd=False)
+        assert changed.split('\n') == ['0002-Add-barfile.patch']
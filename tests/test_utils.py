@@ -1,4 +1,8 @@
+import os
+import time
+
 from rdopkg import utils
+from rdopkg.utils import cache
 
 
 def test_url_tidying():
@@ -35,3 +39,451 @@ def test_gerrit_query(monkeypatch):
     mock_result = """{"type":"stats","rowCount":0,"runTimeMilliseconds":4,"moreChanges":false}"""  # noqa
     r = g('project:ironic')
     assert r is None
+
+
+def test_file_cache(tmpdir):
+    c = cache.FileCache(str(tmpdir.join('cache')))
+    key = cache.digest('foo', b'bar', ['baz', 1])
+    assert key != cache.digest('foob', b'ar', ['baz', 1])
+    assert c.get(key) is None
+    c.set(key, {'foo': ['bar']})
+    assert c.get(key) == {'foo': ['bar']}
+    c.delete(key)
+    assert c.get(key, 'default') == 'default'
+
+
+def test_file_cache_evict(tmpdir):
+    c = cache.FileCache(str(tmpdir))
+    now = time.time()
+    for i, key in enumerate(['old', 'older', 'oldest']):
+        c.set(key, 'x' * 20)
+        t = now - 60 * (i + 1)
+        os.utime(str(tmpdir.join(key + '.json')), (t, t))
+    c.max_size = 50
+    c.max_age = 3600
+    c.evict()
+    # least recently used entry removed to fit max_size
+    assert c.get('oldest') is None
+    assert c.get('older') == 'x' * 20
+    t = now - 7200
+    os.utime(str(tmpdir.join('old.json')), (t, t))
+    c.set('new', 'y')
+    assert c.get('old') is None
+    assert c.get('older') == 'x' * 20
+    assert c.get('new') == 'y'
+
+
+def test_git_cat_file_batch(tmpdir, monkeypatch):
+    from rdopkg.utils.git import Git
+    import test_common as common
+    dist_path = common.prep_spec_test(tmpdir, 'patched')
+    g = Git()
+    with dist_path.as_cwd():
+        common.prep_patches_branch()
+
+        def queries():
+            return [
+                g.object_type('1.2.3'),
+                g.object_type('master:foo.spec'),
+                g.object_type('nonexistent'),
+                g.ref_exists('refs/heads/master-patches'),
+                g.ref_exists('refs/tags/1.2.3'),
+                g.ref_exists('refs/tags/nonexistent'),
+                g.get_latest_commit_hash('master-patches'),
+                g.get_latest_commit_hash('nonexistent'),
+                g.get_file_content('master', 'foo.spec'),
+                g.get_timestamp_by_ref('master'),
+            ]
+
+        batched = queries()
+        assert g._batches
+        g.use_batch = False
+        assert queries() == batched
+        # new objects and refs are visible to running coprocesses
+        g.use_batch = True
+        common.add_patches(tag='1.2.4')
+        assert g.ref_exists('refs/tags/1.2.4')
+        assert (g.get_latest_commit_hash('1.2.4')
+                == g('rev-parse', '1.2.4^{commit}'))
+    g.close_batches()
+    assert not g._batches
+
+
+def test_git_refs_snapshot(tmpdir):
+    from rdopkg.utils.cmd import run
+    from rdopkg.utils.git import git
+    import test_common as common
+    dist_path = common.prep_spec_test(tmpdir, 'patched')
+    with dist_path.as_cwd():
+        common.prep_patches_branch()
+        git('remote', 'add', 'upstream', str(dist_path))
+        git('fetch', 'upstream')
+        assert git.local_branches() == ['master', 'master-patches']
+        assert git.remote_branches() == ['upstream/master',
+                                         'upstream/master-patches']
+        assert git.ref_exists('refs/tags/1.2.3')
+        # snapshot is reused by read-only queries
+        refs = git.refs()
+        assert git.refs() is refs
+        git('log', '-n1')
+        assert git.refs() is refs
+        # and invalidated by ref changes
+        git('tag', '1.2.4')
+        assert git.refs() is not refs
+        assert git.ref_exists('refs/tags/1.2.4')
+        assert git.branch_exists('master-patches')
+        assert not git.branch_exists('nonexistent')
+        # also by git run outside of the Git instance
+        refs = git.refs()
+        run('git', 'tag', '1.2.5')
+        assert git.refs() is not refs
+        assert git.ref_exists('refs/tags/1.2.5')
+
+
+def test_git_config_snapshot(tmpdir):
+    from rdopkg.utils.git import git
+    import test_common as common
+    dist_path = common.prep_spec_test(tmpdir, 'patched')
+    with dist_path.as_cwd():
+        git('config', 'rdopkg.Foo-Bar.patches-branch', 'a')
+        git('config', '--add', 'rdopkg.Foo-Bar.patches-branch', 'b')
+        git('config', 'foo.UserName', 'Přikrášlený Žluťoučký Kůň')
+        assert git.config_get('rdopkg.Foo-Bar.patches-branch') == 'b'
+        assert git.config_get('RDOPKG.Foo-Bar.PATCHES-BRANCH') == 'b'
+        assert git.config_get('rdopkg.foo-bar.patches-branch') is None
+        assert git.config_get('foo.username') == 'Přikrášlený Žluťoučký Kůň'
+        assert git.config_get('foo.nonexistent', 'x') == 'x'
+        # snapshot is loaded once
+        config = git.config()
+        git.config_get('foo.username')
+        assert git.config() is config
+        # written through
+        git.config_set('foo.username', 'Foo')
+        assert git.config() is config
+        assert git.config_get('foo.username') == 'Foo'
+        assert git('config', '--get', 'foo.username') == 'Foo'
+        # other config changes invalidate the snapshot
+        git('config', 'foo.username', 'Bar')
+        assert git.config_get('foo.username') == 'Bar'
+
+
+def test_git_log_records(tmpdir):
+    from rdopkg import exception
+    from rdopkg.utils.git import git
+    import pytest
+    import test_common as common
+    dist_path = common.prep_spec_test(tmpdir, 'patched')
+    with dist_path.as_cwd():
+        common.prep_patches_branch()
+        common.add_n_patches(3)
+        common.do_patch('foofile', '#bz\n',
+                        'Fix a bug\n\nResolves: rhbz#12345\n'
+                        'Note: \x1f is not a separator here')
+        commits = list(git.get_commits('1.2.3', 'master-patches'))
+        assert [s for _, s in commits] == [
+            'Extra patch 3', 'Extra patch 2', 'Extra patch 1']
+        assert git.get_commit_subjects('1.2.3', 'master-patches') == [
+            'Extra patch 3', 'Extra patch 2', 'Extra patch 1']
+        assert (git.get_commit_hashes('1.2.3', 'master-patches')
+                == [h for h, _ in commits])
+        bzs = git.get_commit_bzs('master-patches~1', 'master')
+        assert bzs[0][1:] == ('Fix a bug', ['12345'])
+        # records are streamed and the reader can stop early
+        records = git.log_records('master-patches',
+                                  fields=('hash', 'parents', 'timestamp'))
+        first = next(records)
+        assert first.hash == git('rev-parse', 'master-patches')
+        assert first.parents == git('rev-parse', 'master-patches~1')
+        assert first.timestamp.isdigit()
+        records.close()
+        with pytest.raises(exception.CommandFailed):
+            list(git.log_records('nonexistent'))
+        assert git.get_commit_bzs('nonexistent') == []
+
+
+def test_git_fetch_many(tmpdir):
+    from rdopkg.utils.git import Fetch, git
+    import test_common as common
+    upstream = common.prep_spec_test(tmpdir, 'patched')
+    with upstream.as_cwd():
+        git('tag', '1.2.4')
+    patches = common.prep_spec_test(tmpdir, 'empty')
+    with patches.as_cwd():
+        git('branch', 'master-patches')
+        git('branch', 'other-patches')
+        git('tag', 'patches-tag')
+    local = tmpdir.mkdir('local')
+    with local.as_cwd():
+        git('init', '-q')
+        git('remote', 'add', 'upstream', str(upstream))
+        git('remote', 'add', 'patches', str(patches))
+        fetches = [
+            Fetch('upstream', [], True),
+            Fetch('patches', ['+refs/heads/master-patches:'
+                              'refs/remotes/patches/master-patches'], False),
+        ]
+        assert git.fetch_many(fetches, period=600) == fetches
+        assert git.ref_exists('refs/remotes/upstream/master')
+        assert git.ref_exists('refs/tags/1.2.4')
+        assert git.ref_exists('refs/remotes/patches/master-patches')
+        assert not git.ref_exists('refs/remotes/patches/other-patches')
+        assert not git.ref_exists('refs/tags/patches-tag')
+        # recent fetches are skipped
+        assert git.fetch_many(fetches, period=600) == []
+        assert git.fetch_many(fetches[:1], period=0) == fetches[:1]
+
+
+def test_git_ref_reader(tmpdir):
+    from rdopkg.utils.git import RefReader, git
+    import test_common as common
+
+    def _check(path):
+        # answers match git
+        with path.as_cwd():
+            reader = RefReader.discover('.')
+            assert reader
+            git.use_ref_reader = False
+            try:
+                branch = git.current_branch()
+                commit = git.current_commit()
+                refs = git.refs()
+            finally:
+                git.use_ref_reader = True
+            abbrev = reader.head_abbrev()
+            assert abbrev is None or abbrev == branch
+            assert reader.head_commit() == commit
+            for ref in list(refs) + ['refs/heads/nope', 'refs/tags/nope']:
+                assert reader.ref_exists(ref) == (ref in refs)
+            assert git.current_branch() == branch
+            assert git.current_commit() == commit
+        return abbrev
+
+    repo = common.prep_spec_test(tmpdir, 'patched')
+    with repo.as_cwd():
+        git('tag', '1.2.3')
+        git('branch', 'feature')
+        git('remote', 'add', 'origin', str(repo))
+        git('fetch', 'origin')
+    assert _check(repo) == 'master'
+    with repo.as_cwd():
+        git('pack-refs', '--all')
+        git('branch', 'loose')
+        assert RefReader.discover('.').packed_refs()
+    assert _check(repo) == 'master'
+    subdir = repo.mkdir('subdir')
+    assert _check(subdir) == 'master'
+    # linked worktree
+    wt = tmpdir.join('wt')
+    with repo.as_cwd():
+        git('worktree', 'add', str(wt), 'feature')
+    assert _check(wt) == 'feature'
+    # detached HEAD
+    with wt.as_cwd():
+        git('checkout', '--detach')
+    assert _check(wt) == 'HEAD'
+    # ambiguous name is left to git
+    with repo.as_cwd():
+        git('tag', 'master')
+    assert _check(repo) is None
+
+
+def test_run_cache(tmpdir):
+    from rdopkg.utils.git import git
+    from rdopkg.utils.runcache import run_cache
+    import test_common as common
+
+    repo = common.prep_spec_test(tmpdir, 'patched')
+    with repo.as_cwd():
+        git('config', 'user.name', 'Test')
+        head = git('rev-parse', 'HEAD')
+        # nothing is memoized outside of a session
+        run_cache.reset_stats()
+        git('rev-parse', 'HEAD')
+        assert run_cache.stats()['hits'] == 0
+        with run_cache.session():
+            assert git('rev-parse', 'HEAD') == head
+            assert git('rev-parse', 'HEAD') == head
+            assert git('config', 'user.name') == 'Test'
+            assert git('config', 'user.name') == 'Test'
+            assert git('remote') == git('remote')
+            assert run_cache.stats()['hits'] == 3
+            # failures are memoized too
+            for _ in range(2):
+                out = git('rev-parse', '--verify', '-q', 'nope',
+                          fatal=False, log_fail=False)
+                assert out.return_code != 0
+            assert run_cache.stats()['hits'] == 4
+            # listing remotes doesn't invalidate
+            git.remotes()
+            assert run_cache.stats()['invalidations'] == 0
+            git('rev-parse', 'HEAD')
+            assert run_cache.stats()['hits'] == 5
+            # format-patch writes files so it's always run
+            patches = tmpdir.join('patches')
+            for _ in range(2):
+                git('format-patch', '-1', '-o', str(patches))
+                assert len(patches.listdir()) == 1
+                patches.remove()
+            # mutating commands invalidate
+            common.do_patch('foofile', '#change\n', 'Change')
+            assert git('rev-parse', 'HEAD') != head
+            git('config', 'user.name', 'Memo Test')
+            assert git('config', 'user.name') == 'Memo Test'
+            # file writes through Spec.save invalidate
+            git('rev-parse', 'HEAD')
+            spec = common.Spec()
+            spec.set_tag('Version', '9.9.9')
+            spec.save()
+            assert run_cache.stats()['entries'] == 0
+        assert run_cache.stats()['entries'] == 0
+        assert run_cache.summary().startswith('memoized commands: 5 hits')
+
+
+def test_profile_trace(tmpdir, monkeypatch, caplog):
+    import json
+    import logging
+    from rdopkg.cli import rdopkg
+    from rdopkg.conf import cfg
+    from rdopkg.utils.trace import tracer
+    import test_common as common
+    bin_path = tmpdir.mkdir('bin')
+    rpmlint = bin_path.join('rpmlint')
+    rpmlint.write('#!/bin/sh\necho "$1: W: fake-warning"\nexit 64\n')
+    rpmlint.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_path), prepend=':')
+    monkeypatch.setitem(cfg, 'RPMLINT_CACHE', False)
+    dist_path = common.prep_spec_test(tmpdir, 'patched')
+    trace_path = tmpdir.join('trace.json')
+    caplog.set_level(logging.INFO)
+    with dist_path.as_cwd():
+        rv = rdopkg('--profile', '--profile-trace', str(trace_path),
+                    'lint', '--lint-checks', 'rpmlint')
+    assert rv == 0
+    assert not tracer.enabled
+    assert 'lint: 1 commands' in caplog.text
+    trace = json.loads(trace_path.read())
+    events = trace['traceEvents']
+    assert [e['name'] for e in events if e['cat'] == 'step'] == ['lint']
+    cmds = [e for e in events if e['cat'] == 'lint']
+    assert len(cmds) == 1
+    assert cmds[0]['ph'] == 'X'
+    assert cmds[0]['name'].startswith('rpmlint ')
+    assert cmds[0]['args']['return_code'] == 64
+    assert cmds[0]['args']['out_bytes'] > 0
+
+
+def test_run_iter():
+    import itertools
+    import pytest
+    from rdopkg import exception
+    from rdopkg.utils.cmd import run_iter
+    assert list(run_iter('printf', 'a\\nb\\n\\nc', log_cmd=False)) == [
+        'a', 'b', '', 'c']
+    assert list(run_iter('printf', 'a\\0b', sep='\0', log_cmd=False)) == [
+        'a', 'b']
+    # endless output can be consumed partially
+    lines = run_iter('yes', log_cmd=False)
+    assert list(itertools.islice(lines, 3)) == ['y', 'y', 'y']
+    lines.close()
+    # lots of stderr doesn't block stdout
+    out = run_iter('sh', '-c', 'head -c 1000000 /dev/zero | tr "\\0" x >&2;'
+                   ' seq 1000', log_cmd=False)
+    assert len(list(out)) == 1000
+    # failure is reported with output tail after the last record
+    records = []
+    with pytest.raises(exception.CommandFailed) as ex:
+        for r in run_iter('sh', '-c', 'seq 100; echo oops >&2; exit 2',
+                          tail=3, log_cmd=False, log_fail=False):
+            records.append(r)
+    assert len(records) == 100
+    out = ex.value.kwargs['out']
+    assert out == '98\n99\n100'
+    assert out.stderr == b'oops'
+    assert out.return_code == 2
+
+
+def test_run_many():
+    import time
+    import pytest
+    from rdopkg import exception
+    from rdopkg.utils.cmd import run_many
+    cmds = [('sh', '-c', 'sleep 0.3; echo %d' % i) for i in range(4)]
+    start = time.time()
+    outs = run_many(cmds, jobs=4, log_cmd=False)
+    assert time.time() - start < 1.0
+    assert outs == ['0', '1', '2', '3']
+    assert all(o.success for o in outs)
+    # failures are collected in order
+    cmds = [('sh', '-c', 'echo ok'), ('sh', '-c', 'echo err >&2; exit 3'),
+            ('sh', '-c', 'exit 4')]
+    outs = run_many(cmds, fatal=False, log_cmd=False, log_fail=False)
+    assert [o.return_code for o in outs] == [0, 3, 4]
+    assert outs[1].stderr == b'err'
+    with pytest.raises(exception.CommandFailed) as ex:
+        run_many(cmds, jobs=1, log_cmd=False, log_fail=False)
+    assert ex.value.kwargs['out'].return_code == 3
+    with pytest.raises(exception.CommandNotFound):
+        run_many([('sh', '-c', 'true'), ('rdopkg-no-such-command',)],
+                 log_cmd=False)
+
+
+def test_query_repos(tmpdir, monkeypatch):
+    from rdopkg.actionmods import query
+    bin_path = tmpdir.mkdir('bin')
+    repoquery = bin_path.join('repoquery')
+    # print NVR based on --repoid, fail for repo "missing"
+    repoquery.write('#!/bin/sh\ncase "$3" in\n'
+                    '  *missing) exit 1;;\n'
+                    '  *old) echo foo-1.0-1.el8;;\n'
+                    '  *) echo foo-2.0-1.el8;;\n'
+                    'esac\n')
+    repoquery.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_path), prepend=':')
+    repos = [{'name': n, 'url': 'http://%s' % n}
+             for n in ('old', 'missing', 'new')]
+    assert query.query_repos(repos, 'foo') == [
+        ('new', 'foo-2.0-1.el8'), ('old', 'foo-1.0-1.el8')]
+
+
+def test_lazy_startup(capsys):
+    import subprocess
+    import sys
+    import pytest
+    import rdopkg
+    from rdopkg.cli import rdopkg as rdopkg_cli
+    # building the parser doesn't load version nor slow optional modules
+    code = ("import sys\n"
+            "from rdopkg import cli, shell\n"
+            "shell.get_parser(cli.rdopkg_runner(),"
+            " version=cli.get_version)\n"
+            "print(' '.join(m for m in ('pbr', 'yaml', 'asyncio')"
+            " if m in sys.modules))\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    out = subprocess.check_output([sys.executable, '-c', code], env=env)
+    assert out.strip() == b''
+    with pytest.raises(SystemExit):
+        rdopkg_cli('--version')
+    assert capsys.readouterr().out.strip() == str(rdopkg.get_version())
+    assert rdopkg.__version__ == rdopkg.get_version()
+
+
+def test_patch_ids_traced(tmpdir):
+    from rdopkg.utils.git import git
+    from rdopkg.utils.trace import tracer
+    import test_common as common
+    repo = common.prep_spec_test(tmpdir, 'patched')
+    with repo.as_cwd():
+        common.prep_patches_branch()
+        common.add_patches()
+        tracer.reset()
+        tracer.enabled = True
+        try:
+            ids = git.get_commit_patch_ids('1.2.3', 'master-patches')
+            assert len(git.get_patch_ids([b'', b'nope'])) == 2
+        finally:
+            tracer.enabled = False
+        assert len(ids) == len(git.get_commit_hashes('1.2.3',
+                                                     'master-patches'))
+        cmds = [c['cmd'].split(' ')[1] for c in tracer.commands]
+        assert cmds == ['log', 'patch-id', 'patch-id']